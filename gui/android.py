@@ -24,7 +24,7 @@ import android
 from decimal import Decimal
 import datetime, re
 
-from electrum import SimpleConfig, Wallet, WalletStorage, format_satoshis
+from electrum import SimpleConfig, Wallet, get_storage, format_satoshis
 from electrum.bitcoin import is_address, COIN, TYPE_ADDRESS
 from electrum import util
 
@@ -911,7 +911,7 @@ class ElectrumGui:
 
         contacts = util.StoreDict(config, 'contacts')
 
-        storage = WalletStorage(config.get_wallet_path())
+        storage = get_storage(config.get_wallet_path(), config)
         if not storage.file_exists:
             action = self.restore_or_create()
             if not action:
@@ -6,7 +6,7 @@ import traceback
 from decimal import Decimal
 
 import electrum
-from electrum import WalletStorage, Wallet
+from electrum import Wallet, get_storage
 from electrum_gui.kivy.i18n import _
 from electrum.contacts import Contacts
 from electrum.paymentrequest import InvoiceStore
@@ -329,7 +329,7 @@ class ElectrumWindow(App):
         if not wallet_path:
             return
         config = self.electrum_config
-        storage = WalletStorage(wallet_path)
+        storage = get_storage(wallet_path, config)
         Logger.info('Electrum: Check for existing wallet')
         if storage.file_exists:
             wallet = Wallet(storage)
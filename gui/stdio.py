@@ -1,7 +1,7 @@
 from decimal import Decimal
 _ = lambda x:x
 #from i18n import _
-from electrum.wallet import WalletStorage, Wallet
+from electrum.wallet import Wallet, get_storage
 from electrum.util import format_satoshis, set_verbosity, StoreDict
 from electrum.bitcoin import is_valid, COIN, TYPE_ADDRESS
 from electrum.network import filter_protocol
@@ -15,7 +15,7 @@ class ElectrumGui:
     def __init__(self, config, daemon, plugins):
         self.config = config
         network = daemon.network
-        storage = WalletStorage(config.get_wallet_path())
+        storage = get_storage(config.get_wallet_path(), config)
         if not storage.file_exists:
             print "Wallet not found. try 'electrum create'"
             exit()
@@ -5,7 +5,7 @@ from decimal import Decimal
 from electrum.util import format_satoshis, set_verbosity
 from electrum.util import StoreDict
 from electrum.bitcoin import is_valid, COIN, TYPE_ADDRESS
-from electrum import Wallet, WalletStorage
+from electrum import Wallet, get_storage
 
 _ = lambda x:x
 
@@ -17,7 +17,7 @@ class ElectrumGui:
 
         self.config = config
         self.network = daemon.network
-        storage = WalletStorage(config.get_wallet_path())
+        storage = get_storage(config.get_wallet_path(), config)
         if not storage.file_exists:
             print "Wallet not found. try 'electrum create'"
             exit()
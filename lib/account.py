@@ -16,6 +16,8 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
+import json
+
 import bitcoin
 from bitcoin import *
 from i18n import _
@@ -23,13 +25,77 @@ from transaction import Transaction, is_extended_pubkey
 from util import print_msg, InvalidPassword
 
 
+# optional process pool for key derivation, see set_derivation_processes
+derivation_pool = None
+derivation_processes = 0
+# ranges shorter than this are derived in the calling process
+min_pool_range = 50
+
+def set_derivation_processes(n):
+    '''Derives long ranges of BIP32 public keys (wallet restore, large gap
+    limits) in a pool of n processes.  n = 0 disables the pool.  The pool
+    should be created before any thread is started.'''
+    global derivation_pool, derivation_processes
+    if derivation_pool is not None:
+        derivation_pool.terminate()
+        derivation_pool = None
+    derivation_processes = n
+    if n > 0:
+        import multiprocessing
+        derivation_pool = multiprocessing.Pool(n)
+
+def derive_range(args):
+    return CKD_pub_range(*args)
+
+def derive_range_in_pool(cK, c, start, count):
+    pool = derivation_pool
+    if pool is None or count < min_pool_range:
+        return CKD_pub_range(cK, c, start, count)
+    # several chunks per process, so that they finish about together;
+    # map returns the results in order
+    size = max(min_pool_range / 2, -(-count // (derivation_processes * 4)))
+    end = start + count
+    chunks = [(cK, c, i, min(size, end - i)) for i in range(start, end, size)]
+    return sum(pool.map(derive_range, chunks), [])
+
+
 class Account(object):
     def __init__(self, v):
         self.receiving_pubkeys   = v.get('receiving', [])
         self.change_pubkeys      = v.get('change', [])
-        # addresses will not be stored on disk
-        self.receiving_addresses = map(self.pubkeys_to_address, self.receiving_pubkeys)
-        self.change_addresses    = map(self.pubkeys_to_address, self.change_pubkeys)
+        # addresses are cached on disk, with a digest of the pubkeys
+        # they were derived from (see get_address_cache)
+        cache = v.get('address_cache')
+        self.address_cache_valid = bool(cache) and cache.get('digest') == self.get_pubkeys_digest()
+        if self.address_cache_valid:
+            self.receiving_addresses = cache['receiving']
+            self.change_addresses    = cache['change']
+        else:
+            self.receiving_addresses = map(self.pubkeys_to_address, self.receiving_pubkeys)
+            self.change_addresses    = map(self.pubkeys_to_address, self.change_pubkeys)
+        self.build_address_index()
+
+    def get_pubkeys_digest(self):
+        s = json.dumps([self.receiving_pubkeys, self.change_pubkeys])
+        return hashlib.sha256(s).hexdigest()
+
+    def get_address_cache(self):
+        return {
+            'digest': self.get_pubkeys_digest(),
+            'receiving': self.receiving_addresses,
+            'change': self.change_addresses,
+        }
+
+    def build_address_index(self):
+        # address -> (for_change, n)
+        self.address_index = {}
+        for for_change, addr_list in enumerate([self.receiving_addresses, self.change_addresses]):
+            for n, address in enumerate(addr_list):
+                self.address_index[address] = (for_change, n)
+
+    def get_address_index(self, address):
+        '''Returns (for_change, n) if address belongs to this account, None otherwise'''
+        return self.address_index.get(address)
 
     def dump(self):
         return {'receiving':self.receiving_pubkeys, 'change':self.change_pubkeys}
@@ -52,16 +118,25 @@ class Account(object):
     def derive_pubkeys(self, for_change, n):
         pass
 
+    def derive_pubkeys_range(self, for_change, start, count):
+        return [self.derive_pubkeys(for_change, n) for n in range(start, start + count)]
+
     def create_new_address(self, for_change):
+        return self.create_new_addresses(for_change, 1)[0]
+
+    def create_new_addresses(self, for_change, count):
         pubkeys_list = self.change_pubkeys if for_change else self.receiving_pubkeys
         addr_list = self.change_addresses if for_change else self.receiving_addresses
-        n = len(pubkeys_list)
-        pubkeys = self.derive_pubkeys(for_change, n)
-        address = self.pubkeys_to_address(pubkeys)
-        pubkeys_list.append(pubkeys)
-        addr_list.append(address)
-        print_msg(address)
-        return address
+        start = len(pubkeys_list)
+        addresses = []
+        for n, pubkeys in enumerate(self.derive_pubkeys_range(for_change, start, count), start):
+            address = self.pubkeys_to_address(pubkeys)
+            pubkeys_list.append(pubkeys)
+            addr_list.append(address)
+            self.address_index[address] = (for_change, n)
+            print_msg(address)
+            addresses.append(address)
+        return addresses
 
     def pubkeys_to_address(self, pubkey):
         return public_key_to_bc_address(pubkey.decode('hex'))
@@ -84,14 +159,15 @@ class Account(object):
         while True:
             addresses = self.get_addresses(for_change)
             if len(addresses) < limit:
-                address = self.create_new_address(for_change)
-                wallet.add_address(address)
-                continue
-            if map( lambda a: wallet.address_is_old(a), addresses[-limit:] ) == limit*[False]:
-                break
+                count = limit - len(addresses)
             else:
-                address = self.create_new_address(for_change)
-                wallet.add_address(address)
+                # new addresses are unused: derive enough of them at once
+                # to follow the last used one with limit unused addresses
+                old = [i for i, a in enumerate(addresses[-limit:]) if wallet.address_is_old(a)]
+                if not old:
+                    break
+                count = old[-1] + 1
+            wallet.add_addresses(self.create_new_addresses(for_change, count))
 
     def synchronize(self, wallet):
         self.synchronize_sequence(wallet, False)
@@ -101,6 +177,8 @@ class Account(object):
 class ImportedAccount(Account):
     def __init__(self, d):
         self.keypairs = d['imported']
+        # built on demand, because sequence numbers follow the sorted order
+        self.address_index = None
 
     def synchronize(self, wallet):
         return
@@ -108,6 +186,16 @@ class ImportedAccount(Account):
     def get_addresses(self, for_change):
         return [] if for_change else sorted(self.keypairs.keys())
 
+    def build_address_index(self):
+        self.address_index = dict((address, (0, n)) for n, address in enumerate(self.get_addresses(0)))
+
+    def get_address_index(self, address):
+        if address not in self.keypairs:
+            return None
+        if self.address_index is None:
+            self.build_address_index()
+        return self.address_index[address]
+
     def get_pubkey(self, *sequence):
         for_change, i = sequence
         assert for_change == 0
@@ -134,9 +222,11 @@ class ImportedAccount(Account):
     def add(self, address, pubkey, privkey, password):
         from wallet import pw_encode
         self.keypairs[address] = (pubkey, pw_encode(privkey, password ))
+        self.address_index = None
 
     def remove(self, address):
         self.keypairs.pop(address)
+        self.address_index = None
 
     def dump(self):
         return {'imported':self.keypairs}
@@ -211,7 +301,9 @@ class OldAccount(Account):
 
 
     def check_seed(self, seed):
-        secexp = self.stretch_key(seed)
+        return self.check_stretched_exponent(self.stretch_key(seed))
+
+    def check_stretched_exponent(self, secexp):
         master_private_key = ecdsa.SigningKey.from_secret_exponent( secexp, curve = SECP256k1 )
         master_public_key = master_private_key.get_verifying_key().to_string()
         if master_public_key != self.mpk:
@@ -251,8 +343,8 @@ class BIP32_Account(Account):
     def __init__(self, v):
         Account.__init__(self, v)
         self.xpub = v['xpub']
-        self.xpub_receive = None
-        self.xpub_change = None
+        # (xpub, for_change) -> (c, cK), see get_branch_key
+        self.branch_keys = {}
 
     def dump(self):
         d = Account.dump(self)
@@ -280,18 +372,23 @@ class BIP32_Account(Account):
         pubkeys = self.get_pubkeys(for_change, n)
         return pubkeys[i]
 
+    def get_branch_key(self, xpub, for_change):
+        '''Returns the decoded (c, cK) of branch for_change of xpub'''
+        key = (xpub, for_change)
+        if key not in self.branch_keys:
+            _, _, _, c, cK = deserialize_xkey(xpub)
+            self.branch_keys[key] = CKD_pub(cK, c, for_change)[::-1]
+        return self.branch_keys[key]
+
+    def derive_branch_pubkeys(self, xpub, for_change, start, count):
+        c, cK = self.get_branch_key(xpub, for_change)
+        return [pubkey.encode('hex') for pubkey in derive_range_in_pool(cK, c, start, count)]
+
     def derive_pubkeys(self, for_change, n):
-        xpub = self.xpub_change if for_change else self.xpub_receive
-        if xpub is None:
-            xpub = bip32_public_derivation(self.xpub, "", "/%d"%for_change)
-            if for_change:
-                self.xpub_change = xpub
-            else:
-                self.xpub_receive = xpub
-        _, _, _, c, cK = deserialize_xkey(xpub)
-        cK, c = CKD_pub(cK, c, n)
-        result = cK.encode('hex')
-        return result
+        return self.derive_pubkeys_range(for_change, n, 1)[0]
+
+    def derive_pubkeys_range(self, for_change, start, count):
+        return self.derive_branch_pubkeys(self.xpub, for_change, start, count)
 
 
     def get_private_key(self, sequence, wallet, password):
@@ -343,6 +440,7 @@ class Multisig_Account(BIP32_Account):
         self.m = v.get('m', 2)
         Account.__init__(self, v)
         self.xpub_list = v['xpubs']
+        self.branch_keys = {}
 
     def dump(self):
         d = Account.dump(self)
@@ -353,8 +451,15 @@ class Multisig_Account(BIP32_Account):
     def get_pubkeys(self, for_change, n):
         return self.get_pubkey(for_change, n)
 
-    def derive_pubkeys(self, for_change, n):
-        return map(lambda x: self.derive_pubkey_from_xpub(x, for_change, n), self.get_master_pubkeys())
+    def get_pubkeys_digest(self):
+        # addresses also depend on m
+        s = json.dumps([self.m, self.receiving_pubkeys, self.change_pubkeys])
+        return hashlib.sha256(s).hexdigest()
+
+    def derive_pubkeys_range(self, for_change, start, count):
+        branches = [self.derive_branch_pubkeys(xpub, for_change, start, count)
+                    for xpub in self.get_master_pubkeys()]
+        return map(list, zip(*branches))
 
     def redeem_script(self, for_change, n):
         pubkeys = self.get_pubkeys(for_change, n)
@@ -19,14 +19,19 @@
 
 import hashlib
 import base64
+import os
 import re
 import hmac
+import threading
+from collections import OrderedDict
 
 import version
 from util import print_error, InvalidPassword
 
 import ecdsa
 import aes
+import ecc_fast
+import ecc_native
 
 ################################## transactions
 
@@ -41,9 +46,6 @@ TYPE_SCRIPT  = 2
 
 
 # AES encryption
-EncodeAES = lambda secret, s: base64.b64encode(aes.encryptData(secret,s))
-DecodeAES = lambda secret, e: aes.decryptData(secret, base64.b64decode(e))
-
 def strip_PKCS7_padding(s):
     """return s stripped of PKCS7 padding"""
     if len(s)%16 or not s:
@@ -58,7 +60,7 @@ def strip_PKCS7_padding(s):
 # backport padding fix to AES module
 aes.strip_PKCS7_padding = strip_PKCS7_padding
 
-def aes_encrypt_with_iv(key, iv, data):
+def slowaes_encrypt_with_iv(key, iv, data):
     mode = aes.AESModeOfOperation.modeOfOperation["CBC"]
     key = map(ord, key)
     iv = map(ord, iv)
@@ -69,7 +71,7 @@ def aes_encrypt_with_iv(key, iv, data):
     (mode, length, ciph) = moo.encrypt(data, mode, key, keysize, iv)
     return ''.join(map(chr, ciph))
 
-def aes_decrypt_with_iv(key, iv, data):
+def slowaes_decrypt_with_iv(key, iv, data):
     mode = aes.AESModeOfOperation.modeOfOperation["CBC"]
     key = map(ord, key)
     iv = map(ord, iv)
@@ -81,6 +83,61 @@ def aes_decrypt_with_iv(key, iv, data):
     decr = strip_PKCS7_padding(decr)
     return decr
 
+# name -> (encrypt, decrypt), from the fastest available to slowaes
+aes_backends = OrderedDict()
+
+try:
+    from Crypto.Cipher import AES as Crypto_AES
+except ImportError:
+    pass
+else:
+    def pycrypto_encrypt_with_iv(key, iv, data):
+        return Crypto_AES.new(key, Crypto_AES.MODE_CBC, iv).encrypt(aes.append_PKCS7_padding(data))
+
+    def pycrypto_decrypt_with_iv(key, iv, data):
+        return strip_PKCS7_padding(Crypto_AES.new(key, Crypto_AES.MODE_CBC, iv).decrypt(data))
+
+    aes_backends['pycryptodome'] = (pycrypto_encrypt_with_iv, pycrypto_decrypt_with_iv)
+
+try:
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    from cryptography.hazmat.backends import default_backend
+except ImportError:
+    pass
+else:
+    def cryptography_encrypt_with_iv(key, iv, data):
+        encryptor = Cipher(algorithms.AES(key), modes.CBC(iv), backend=default_backend()).encryptor()
+        return encryptor.update(aes.append_PKCS7_padding(data)) + encryptor.finalize()
+
+    def cryptography_decrypt_with_iv(key, iv, data):
+        decryptor = Cipher(algorithms.AES(key), modes.CBC(iv), backend=default_backend()).decryptor()
+        return strip_PKCS7_padding(decryptor.update(data) + decryptor.finalize())
+
+    aes_backends['cryptography'] = (cryptography_encrypt_with_iv, cryptography_decrypt_with_iv)
+
+aes_backends['slowaes'] = (slowaes_encrypt_with_iv, slowaes_decrypt_with_iv)
+
+aes_backend = aes_backends.keys()[0]
+
+def set_aes_backend(name):
+    global aes_backend
+    if name not in aes_backends:
+        raise BaseException('AES backend not available: %s' % name)
+    aes_backend = name
+
+def aes_encrypt_with_iv(key, iv, data):
+    return aes_backends[aes_backend][0](key, iv, data)
+
+def aes_decrypt_with_iv(key, iv, data):
+    return aes_backends[aes_backend][1](key, iv, data)
+
+def EncodeAES(secret, s):
+    iv = os.urandom(16)
+    return base64.b64encode(iv + aes_encrypt_with_iv(secret, iv, s))
+
+def DecodeAES(secret, e):
+    e = base64.b64decode(e)
+    return aes_decrypt_with_iv(secret, e[:16], e[16:])
 
 
 def pw_encode(s, password):
@@ -136,6 +193,30 @@ def op_push(i):
         return '4e' + int_to_hex(i,4)
 
 
+def var_int_size(i):
+    '''len(var_int(i)) / 2'''
+    if i<0xfd:
+        return 1
+    elif i<=0xffff:
+        return 3
+    elif i<=0xffffffff:
+        return 5
+    else:
+        return 9
+
+
+def op_push_size(i):
+    '''len(op_push(i)) / 2'''
+    if i<0x4c:
+        return 1
+    elif i<0xff:
+        return 2
+    elif i<0xffff:
+        return 3
+    else:
+        return 5
+
+
 def sha256(x):
     return hashlib.sha256(x).digest()
 
@@ -231,49 +312,47 @@ __b43chars = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ$*+-./:'
 assert len(__b43chars) == 43
 
 
+# digit values, and the digit pairs of the numbers below base**2
+__b58values = dict((c, i) for i, c in enumerate(__b58chars))
+__b43values = dict((c, i) for i, c in enumerate(__b43chars))
+__b58pairs = [a + b for a in __b58chars for b in __b58chars]
+__b43pairs = [a + b for a in __b43chars for b in __b43chars]
+
+
 def base_encode(v, base):
     """ encode v, which is a string of bytes, to base58."""
     if base == 58:
-        chars = __b58chars
+        chars, pairs = __b58chars, __b58pairs
     elif base == 43:
-        chars = __b43chars
-    long_value = 0L
-    for (i, c) in enumerate(v[::-1]):
-        long_value += (256**i) * ord(c)
-    result = ''
-    while long_value >= base:
-        div, mod = divmod(long_value, base)
-        result = chars[mod] + result
-        long_value = div
-    result = chars[long_value] + result
+        chars, pairs = __b43chars, __b43pairs
+    long_value = int(v.encode('hex'), 16) if v else 0
+    base2 = base * base
+    digits = []
+    while long_value >= base2:
+        long_value, mod = divmod(long_value, base2)
+        digits.append(pairs[mod])
+    digits.append(pairs[long_value] if long_value >= base else chars[long_value])
+    result = ''.join(reversed(digits))
     # Bitcoin does a little leading-zero-compression:
     # leading 0-bytes in the input become leading-1s
-    nPad = 0
-    for c in v:
-        if c == '\0': nPad += 1
-        else: break
+    nPad = len(v) - len(v.lstrip('\0'))
     return (chars[0]*nPad) + result
 
 
 def base_decode(v, length, base):
     """ decode v into a string of len bytes."""
     if base == 58:
-        chars = __b58chars
+        chars, values = __b58chars, __b58values
     elif base == 43:
-        chars = __b43chars
+        chars, values = __b43chars, __b43values
     long_value = 0L
-    for (i, c) in enumerate(v[::-1]):
-        long_value += chars.find(c) * (base**i)
-    result = ''
-    while long_value >= 256:
-        div, mod = divmod(long_value, 256)
-        result = chr(mod) + result
-        long_value = div
-    result = chr(long_value) + result
-    nPad = 0
     for c in v:
-        if c == chars[0]: nPad += 1
-        else: break
+        long_value = long_value * base + values.get(c, -1)
+    if long_value < 0:
+        raise ValueError("invalid base%d string" % base)
+    result = '%x' % long_value
+    result = (('0' + result) if len(result) % 2 else result).decode('hex')
+    nPad = len(v) - len(v.lstrip(chars[0]))
     result = chr(0)*nPad + result
     if length is not None and len(result) != length:
         return None
@@ -285,7 +364,17 @@ def EncodeBase58Check(vchIn):
     return base_encode(vchIn + hash[0:4], base=58)
 
 
+# recently decoded extended public keys, see DecodeBase58Check
+xpub_cache = OrderedDict()
+xpub_cache_size = 64
+xpub_cache_lock = threading.Lock()
+
 def DecodeBase58Check(psz):
+    with xpub_cache_lock:
+        key = xpub_cache.pop(psz, None)
+        if key is not None:
+            xpub_cache[psz] = key
+            return key
     vchRet = base_decode(psz, None, base=58)
     key = vchRet[0:-4]
     csum = vchRet[-4:]
@@ -293,8 +382,13 @@ def DecodeBase58Check(psz):
     cs32 = hash[0:4]
     if cs32 != csum:
         return None
-    else:
-        return key
+    # only public keys are kept
+    if len(key) == 78 and key[0:4].encode('hex') in (BITCOIN_HEADER_PUB, TESTNET_HEADER_PUB):
+        with xpub_cache_lock:
+            xpub_cache[psz] = key
+            if len(xpub_cache) > xpub_cache_size:
+                xpub_cache.popitem(last=False)
+    return key
 
 
 def PrivKeyToSecret(privkey):
@@ -396,6 +490,49 @@ from ecdsa.curves import SECP256k1
 from ecdsa.ellipticcurve import Point
 from ecdsa.util import string_to_number, number_to_string
 
+# Use ecc_fast for the scalar multiplications on secp256k1, instead of
+# the affine arithmetic of python-ecdsa.  ecc_fast is not constant-time,
+# and is used with private keys: it is only enabled by the 'fast_ecc'
+# option, see set_fast_ecc.
+use_fast_ecc = False
+# Use libsecp256k1 where it can do the job, if it is installed.  The
+# functions below fall back to the switch above when it fails.
+use_libsecp256k1 = ecc_native.libsecp256k1 is not None
+
+def set_fast_ecc(enabled):
+    global use_fast_ecc
+    use_fast_ecc = enabled
+
+def ec_point(xy):
+    # secp256k1 has cofactor 1, so the order check of Point is not needed
+    if xy is None:
+        return ecdsa.ellipticcurve.INFINITY
+    return Point(curve_secp256k1, xy[0], xy[1])
+
+def generator_mul(k):
+    if use_libsecp256k1 and 0 < k < generator_secp256k1.order():
+        xy = ecc_native.pubkey_create(number_to_string(k, generator_secp256k1.order()))
+        if xy:
+            return ec_point(xy)
+    if use_fast_ecc:
+        return ec_point(ecc_fast.mul_generator(k))
+    return generator_secp256k1 * k
+
+def point_mul(point, k):
+    if use_fast_ecc:
+        return ec_point(ecc_fast.mul((point.x(), point.y()), k))
+    return point * k
+
+def generator_mul_add(k, point):
+    '''k * G + point'''
+    if use_libsecp256k1 and 0 <= k < generator_secp256k1.order() and point != ecdsa.ellipticcurve.INFINITY:
+        xy = ecc_native.pubkey_tweak_add((point.x(), point.y()), number_to_string(k, generator_secp256k1.order()))
+        if xy:
+            return ec_point(xy)
+    if use_fast_ecc:
+        return ec_point(ecc_fast.point_add(ecc_fast.mul_generator(k), (point.x(), point.y())))
+    return k * generator_secp256k1 + point
+
 def msg_magic(message):
     varint = var_int(len(message))
     encoded_varint = "".join([chr(int(varint[i:i+2], 16)) for i in xrange(0, len(varint), 2)])
@@ -450,17 +587,53 @@ def ser_to_point(Aser):
     generator = generator_secp256k1
     _r  = generator.order()
     assert Aser[0] in ['\x02','\x03','\x04']
+    if use_fast_ecc or use_libsecp256k1:
+        _r = None
     if Aser[0] == '\x04':
         return Point( curve, string_to_number(Aser[1:33]), string_to_number(Aser[33:]), _r )
     Mx = string_to_number(Aser[1:])
     return Point( curve, Mx, ECC_YfromX(Mx, curve, Aser[0]=='\x03')[0], _r )
 
 
+class MyPublicKey(ecdsa.ecdsa.Public_key):
+    """Public_key without the n * point check of the constructor, and
+    with verification on libsecp256k1 or ecc_fast"""
+
+    def __init__(self, generator, point):
+        if not (use_fast_ecc or use_libsecp256k1):
+            ecdsa.ecdsa.Public_key.__init__(self, generator, point)
+            return
+        self.curve = generator.curve()
+        self.generator = generator
+        self.point = point
+
+    def verifies(self, hash, signature):
+        if not (use_fast_ecc or use_libsecp256k1):
+            return ecdsa.ecdsa.Public_key.verifies(self, hash, signature)
+        n = self.generator.order()
+        r = signature.r
+        s = signature.s
+        if r < 1 or r > n-1 or s < 1 or s > n-1:
+            return False
+        if use_libsecp256k1 and hash < 2**256:
+            sig_string = number_to_string(r, n) + number_to_string(s, n)
+            return ecc_native.verify(sig_string, ('%064x' % hash).decode('hex'), (self.point.x(), self.point.y()))
+        c = ecdsa.numbertheory.inverse_mod(s, n)
+        u1 = (hash * c) % n
+        u2 = (r * c) % n
+        xy = ecc_fast.mul_add(u1, u2, (self.point.x(), self.point.y()))
+        return xy is not None and xy[0] % n == r
+
+
 
 class MyVerifyingKey(ecdsa.VerifyingKey):
     @classmethod
     def from_signature(klass, sig, recid, h, curve):
         """ See http://www.secg.org/download/aid-780/sec1-v2.pdf, chapter 4.1.6 """
+        if use_libsecp256k1 and len(sig) == 64 and len(h) == 32:
+            xy = ecc_native.recover(sig, recid, h)
+            if xy:
+                return klass.from_public_point(ec_point(xy), curve)
         from ecdsa import util, numbertheory
         import msqr
         curveFp = curve.curve
@@ -475,24 +648,69 @@ class MyVerifyingKey(ecdsa.VerifyingKey):
         beta = msqr.modular_sqrt(alpha, curveFp.p())
         y = beta if (beta - recid) % 2 == 0 else curveFp.p() - beta
         # 1.4 the constructor checks that nR is at infinity
-        R = Point(curveFp, x, y, order)
+        R = Point(curveFp, x, y, None if use_fast_ecc or use_libsecp256k1 else order)
         # 1.5 compute e from message:
         e = string_to_number(h)
         minus_e = -e % order
         # 1.6 compute Q = r^-1 (sR - eG)
         inv_r = numbertheory.inverse_mod(r,order)
-        Q = inv_r * ( s * R + minus_e * G )
+        if use_fast_ecc:
+            Q = ec_point(ecc_fast.mul_add(minus_e * inv_r, s * inv_r, (x, y)))
+        else:
+            Q = inv_r * ( s * R + minus_e * G )
         return klass.from_public_point( Q, curve )
 
+    @classmethod
+    def from_public_point(klass, point, curve=SECP256k1, hashfunc=hashlib.sha1):
+        self = klass(_error__please_use_generate=True)
+        self.curve = curve
+        self.default_hashfunc = hashfunc
+        self.pubkey = MyPublicKey(curve.generator, point)
+        self.pubkey.order = curve.order
+        return self
+
 
 class MySigningKey(ecdsa.SigningKey):
     """Enforce low S values in signatures"""
 
+    @classmethod
+    def from_secret_exponent(klass, secexp, curve=SECP256k1, hashfunc=hashlib.sha1):
+        self = klass(_error__please_use_generate=True)
+        self.curve = curve
+        self.default_hashfunc = hashfunc
+        self.baselen = curve.baselen
+        n = curve.order
+        assert 1 <= secexp < n
+        self.verifying_key = MyVerifyingKey.from_public_point(generator_mul(secexp), curve, hashfunc)
+        self.privkey = ecdsa.ecdsa.Private_key(self.verifying_key.pubkey, secexp)
+        self.privkey.order = n
+        return self
+
+    def sign_digest_deterministic(self, digest, hashfunc=None, sigencode=ecdsa.util.sigencode_string):
+        # libsecp256k1 derives k with RFC 6979 and sha256 as well
+        if use_libsecp256k1 and hashfunc is hashlib.sha256 and len(digest) == 32:
+            order = self.privkey.order
+            sig = ecc_native.sign(digest, number_to_string(self.privkey.secret_multiplier, order))
+            if sig:
+                r, s = ecdsa.util.sigdecode_string(sig, order)
+                return sigencode(r, s, order)
+        return ecdsa.SigningKey.sign_digest_deterministic(self, digest, hashfunc, sigencode)
+
     def sign_number(self, number, entropy=None, k=None):
         curve = SECP256k1
         G = curve.generator
         order = G.order()
-        r, s = ecdsa.SigningKey.sign_number(self, number, entropy, k)
+        if use_fast_ecc:
+            k = (k or ecdsa.util.randrange(order, entropy)) % order
+            r = generator_mul(k).x() % order
+            if r == 0:
+                raise RuntimeError("amazingly unlucky random number r")
+            secexp = self.privkey.secret_multiplier
+            s = (ecdsa.numbertheory.inverse_mod(k, order) * (number + (secexp * r) % order)) % order
+            if s == 0:
+                raise RuntimeError("amazingly unlucky random number s")
+        else:
+            r, s = ecdsa.SigningKey.sign_number(self, number, entropy, k)
         if s > order/2:
             s = order - s
         return r, s
@@ -502,7 +720,7 @@ class EC_KEY(object):
 
     def __init__( self, k ):
         secret = string_to_number(k)
-        self.pubkey = ecdsa.ecdsa.Public_key( generator_secp256k1, generator_secp256k1 * secret )
+        self.pubkey = MyPublicKey( generator_secp256k1, generator_mul(secret) )
         self.privkey = ecdsa.ecdsa.Private_key( self.pubkey, secret )
         self.secret = secret
 
@@ -564,7 +782,7 @@ class EC_KEY(object):
 
         ephemeral_exponent = number_to_string(ecdsa.util.randrange(pow(2,256)), generator_secp256k1.order())
         ephemeral = EC_KEY(ephemeral_exponent)
-        ecdh_key = point_to_ser(pk * ephemeral.privkey.secret_multiplier)
+        ecdh_key = point_to_ser(point_mul(pk, ephemeral.privkey.secret_multiplier))
         key = hashlib.sha512(ecdh_key).digest()
         iv, key_e, key_m = key[0:16], key[16:32], key[32:]
         ciphertext = aes_encrypt_with_iv(key_e, iv, message)
@@ -598,7 +816,7 @@ class EC_KEY(object):
         if not ecdsa.ecdsa.point_is_valid(generator_secp256k1, ephemeral_pubkey.x(), ephemeral_pubkey.y()):
             raise Exception('invalid ciphertext: invalid ephemeral pubkey')
 
-        ecdh_key = point_to_ser(ephemeral_pubkey * self.privkey.secret_multiplier)
+        ecdh_key = point_to_ser(point_mul(ephemeral_pubkey, self.privkey.secret_multiplier))
         key = hashlib.sha512(ecdh_key).digest()
         iv, key_e, key_m = key[0:16], key[16:32], key[32:]
         if mac != hmac.new(key_m, encrypted[:-32], hashlib.sha256).digest():
@@ -615,7 +833,7 @@ BIP32_PRIME = 0x80000000
 
 def get_pubkeys_from_secret(secret):
     # public key
-    private_key = ecdsa.SigningKey.from_string( secret, curve = SECP256k1 )
+    private_key = MySigningKey.from_string( secret, curve = SECP256k1 )
     public_key = private_key.get_verifying_key()
     K = public_key.to_string()
     K_compressed = GetPubKey(public_key.pubkey,True)
@@ -658,13 +876,26 @@ def CKD_pub(cK, c, n):
 def _CKD_pub(cK, c, s):
     order = generator_secp256k1.order()
     I = hmac.new(c, cK + s, hashlib.sha512).digest()
-    curve = SECP256k1
-    pubkey_point = string_to_number(I[0:32])*curve.generator + ser_to_point(cK)
-    public_key = ecdsa.VerifyingKey.from_public_point( pubkey_point, curve = SECP256k1 )
+    pubkey_point = generator_mul_add(string_to_number(I[0:32]), ser_to_point(cK))
+    public_key = MyVerifyingKey.from_public_point( pubkey_point, curve = SECP256k1 )
     c_n = I[32:]
     cK_n = GetPubKey(public_key.pubkey,True)
     return cK_n, c_n
 
+def CKD_pub_range(cK, c, start, count):
+    '''Returns the public keys of the children start to start+count-1 of
+    (cK, c), without their chain codes.  The parent point is decoded
+    once.'''
+    parent_point = ser_to_point(cK)
+    out = []
+    for n in range(start, start + count):
+        if n & BIP32_PRIME: raise
+        s = rev_hex(int_to_hex(n,4)).decode('hex')
+        I = hmac.new(c, cK + s, hashlib.sha512).digest()
+        pubkey_point = generator_mul_add(string_to_number(I[0:32]), parent_point)
+        out.append(point_to_ser(pubkey_point, True))
+    return out
+
 
 BITCOIN_HEADER_PRIV = "0488ade4"
 BITCOIN_HEADER_PUB = "0488b21e"
@@ -192,8 +192,9 @@ class CoinChooserBase(PrintError):
         tx_size = base_size + sum(bucket.size for bucket in buckets)
 
         # This takes a count of change outputs and returns a tx fee;
-        # each pay-to-bitcoin-address output serializes as 34 bytes
-        fee = lambda count: fee_estimator(tx_size + count * 34)
+        # the change addresses all have the same type
+        change_size = Transaction.estimated_output_size((TYPE_ADDRESS, change_addrs[0], 0))
+        fee = lambda count: fee_estimator(tx_size + count * change_size)
         change = self.change_outputs(tx, change_addrs, fee, dust_threshold)
         tx.add_outputs(change)
 
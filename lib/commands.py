@@ -220,7 +220,9 @@ class Commands:
     @command('')
     def deserialize(self, tx):
         """Deserialize a serialized transaction"""
-        return Transaction(tx).deserialize()
+        d = Transaction(tx).deserialize()
+        d['inputs'] = map(dict, d['inputs'])
+        return d
 
     @command('n')
     def broadcast(self, tx):
@@ -679,7 +681,16 @@ config_variables = {
     },
     'listrequests':{
         'url_rewrite': 'Parameters passed to str.replace(), in order to create the r= part of bitcoin: URIs. Example: \"(\'file:///var/www/\',\'https://electrum.org/\')\"',
-    }
+    },
+    'sweep': {
+        'signing_processes': 'Number of processes that sign the inputs of large transactions. 0 (the default) signs in the calling process.',
+    },
+    'payto': {
+        'signing_processes': 'Number of processes that derive the keys and sign the inputs of large transactions. 0 (the default) signs in the calling process.',
+    },
+    'paytomany': {
+        'signing_processes': 'Number of processes that derive the keys and sign the inputs of large transactions. 0 (the default) signs in the calling process.',
+    },
 }
 
 def set_default_subparser(self, name, args=None):
@@ -27,7 +27,10 @@ from jsonrpclib.SimpleJSONRPCServer import SimpleJSONRPCServer, SimpleJSONRPCReq
 from network import Network
 from util import json_decode, DaemonThread
 from util import print_msg, print_error, print_stderr
-from wallet import WalletStorage, Wallet
+from wallet import WalletStorage, Wallet, get_storage
+from account import set_derivation_processes
+from transaction import set_signing_processes
+from bitcoin import set_fast_ecc
 from wizard import WizardBase
 from commands import known_commands, Commands
 from simple_config import SimpleConfig
@@ -96,6 +99,12 @@ class Daemon(DaemonThread):
 
         DaemonThread.__init__(self)
         self.config = config
+        if config.get('derivation_processes'):
+            set_derivation_processes(int(config.get('derivation_processes')))
+        if config.get('signing_processes'):
+            set_signing_processes(int(config.get('signing_processes')))
+        if config.get('fast_ecc'):
+            set_fast_ecc(True)
         if config.get('offline'):
             self.network = None
         else:
@@ -166,7 +175,7 @@ class Daemon(DaemonThread):
         if path in self.wallets:
             wallet = self.wallets[path]
         else:
-            storage = WalletStorage(path)
+            storage = get_storage(path, self.config)
             if get_wizard:
                 if storage.file_exists:
                     wallet = Wallet(storage)
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+#
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2016 The Electrum developers
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+'''secp256k1 point arithmetic in pure Python.
+
+Points are affine (x, y) tuples, and None is the point at infinity.
+Internally, points are in Jacobian coordinates (X, Y, Z), so that an
+addition does not need a modular inversion.  Multiples of the generator
+are sums of entries of a precomputed table with one row per 4-bit
+window of the scalar; multiples of other points use a width-5 NAF.
+
+This code is NOT constant-time: the table lookups, the NAF digits and
+Python's big integers all depend on the scalar, so the time of an
+operation leaks information about it.  Since it is used for private
+keys and signing nonces, it is off unless the 'fast_ecc' option is set
+(see bitcoin.set_fast_ecc).'''
+
+P = 2**256 - 2**32 - 977
+N = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141
+G = (0x79BE667EF9DCBBAC55A06295CE870B07029BFCDB2DCE28D959F2815B16F81798,
+     0x483ADA7726A3C4655DA4FBFC0E1108A8FD17B448A68554199C47D08FFB10D4B8)
+
+INFINITY = (0, 1, 0)
+WINDOW = 4
+WNAF_WIDTH = 5
+
+
+def inverse(a, n=P):
+    lm, hm = 1, 0
+    low, high = a % n, n
+    while low > 1:
+        r = high // low
+        lm, low, hm, high = hm - lm * r, high - low * r, lm, low
+    return lm % n
+
+
+def is_on_curve(point):
+    x, y = point
+    return (y * y - x * x * x - 7) % P == 0
+
+
+def to_affine(p):
+    X, Y, Z = p
+    if Z == 0:
+        return None
+    z = inverse(Z)
+    z2 = z * z % P
+    return X * z2 % P, Y * z2 * z % P
+
+
+def to_affine_batch(points):
+    '''to_affine of points that are not at infinity, with one inversion'''
+    acc = 1
+    products = []
+    for X, Y, Z in points:
+        products.append(acc)
+        acc = acc * Z % P
+    acc = inverse(acc)
+    out = [None] * len(points)
+    for i in range(len(points) - 1, -1, -1):
+        X, Y, Z = points[i]
+        z = acc * products[i] % P
+        acc = acc * Z % P
+        z2 = z * z % P
+        out[i] = (X * z2 % P, Y * z2 * z % P)
+    return out
+
+
+def double(p):
+    X, Y, Z = p
+    if Z == 0 or Y == 0:
+        return INFINITY
+    # dbl-2009-l, for a = 0
+    A = X * X % P
+    B = Y * Y % P
+    C = B * B % P
+    D = 2 * ((X + B) * (X + B) - A - C) % P
+    E = 3 * A
+    X3 = (E * E - 2 * D) % P
+    Y3 = (E * (D - X3) - 8 * C) % P
+    Z3 = 2 * Y * Z % P
+    return X3, Y3, Z3
+
+
+def add(p, q):
+    X1, Y1, Z1 = p
+    X2, Y2, Z2 = q
+    if Z1 == 0:
+        return q
+    if Z2 == 0:
+        return p
+    # add-2007-bl
+    Z1Z1 = Z1 * Z1 % P
+    Z2Z2 = Z2 * Z2 % P
+    U1 = X1 * Z2Z2 % P
+    U2 = X2 * Z1Z1 % P
+    S1 = Y1 * Z2 * Z2Z2 % P
+    S2 = Y2 * Z1 * Z1Z1 % P
+    H = (U2 - U1) % P
+    r = 2 * (S2 - S1) % P
+    if H == 0:
+        return double(p) if r == 0 else INFINITY
+    I = 4 * H * H % P
+    J = H * I % P
+    V = U1 * I % P
+    X3 = (r * r - J - 2 * V) % P
+    Y3 = (r * (V - X3) - 2 * S1 * J) % P
+    Z3 = ((Z1 + Z2) * (Z1 + Z2) - Z1Z1 - Z2Z2) * H % P
+    return X3, Y3, Z3
+
+
+def add_affine(p, q):
+    '''p + q, where q is affine and not at infinity'''
+    X1, Y1, Z1 = p
+    x2, y2 = q
+    if Z1 == 0:
+        return x2, y2, 1
+    # madd-2007-bl
+    Z1Z1 = Z1 * Z1 % P
+    U2 = x2 * Z1Z1 % P
+    S2 = y2 * Z1 * Z1Z1 % P
+    H = (U2 - X1) % P
+    r = 2 * (S2 - Y1) % P
+    if H == 0:
+        return double(p) if r == 0 else INFINITY
+    HH = H * H % P
+    I = 4 * HH
+    J = H * I % P
+    V = X1 * I % P
+    X3 = (r * r - J - 2 * V) % P
+    Y3 = (r * (V - X3) - 2 * Y1 * J) % P
+    Z3 = ((Z1 + H) * (Z1 + H) - Z1Z1 - HH) % P
+    return X3, Y3, Z3
+
+
+# G_TABLE[i][d] = d * 2**(WINDOW*i) * G, built on first use
+G_TABLE = None
+
+def build_generator_table():
+    global G_TABLE
+    rows = []
+    base = G + (1,)
+    for i in range(256 // WINDOW):
+        row = [base]
+        for d in range(2, 1 << WINDOW):
+            row.append(add(row[-1], base))
+        base = add(row[-1], base)
+        rows.append(row)
+    flat = to_affine_batch([p for row in rows for p in row])
+    size = (1 << WINDOW) - 1
+    G_TABLE = [[None] + flat[i * size:(i + 1) * size] for i in range(len(rows))]
+
+
+def mul_generator(k):
+    '''k * G'''
+    if G_TABLE is None:
+        build_generator_table()
+    k %= N
+    mask = (1 << WINDOW) - 1
+    acc = INFINITY
+    for row in G_TABLE:
+        d = k & mask
+        if d:
+            acc = add_affine(acc, row[d])
+        k >>= WINDOW
+    return to_affine(acc)
+
+
+def wnaf(k, w=WNAF_WIDTH):
+    '''Digits of k in width-w NAF, least significant first'''
+    digits = []
+    while k:
+        if k & 1:
+            d = k & ((1 << w) - 1)
+            if d >= 1 << (w - 1):
+                d -= 1 << w
+            k -= d
+        else:
+            d = 0
+        digits.append(d)
+        k >>= 1
+    return digits
+
+
+def mul(point, k):
+    '''k * point'''
+    k %= N
+    if point is None or k == 0:
+        return None
+    p = point + (1,)
+    twice = double(p)
+    odd = [p]
+    for i in range(1, 1 << (WNAF_WIDTH - 2)):
+        odd.append(add(odd[-1], twice))
+    odd = to_affine_batch(odd)
+    neg = [(x, P - y) for x, y in odd]
+    acc = INFINITY
+    for d in reversed(wnaf(k)):
+        acc = double(acc)
+        if d > 0:
+            acc = add_affine(acc, odd[d >> 1])
+        elif d < 0:
+            acc = add_affine(acc, neg[-d >> 1])
+    return to_affine(acc)
+
+
+def point_add(p, q):
+    '''p + q'''
+    if p is None:
+        return q
+    if q is None:
+        return p
+    return to_affine(add_affine(p + (1,), q))
+
+
+def mul_add(a, b, point):
+    '''a * G + b * point'''
+    return point_add(mul_generator(a), mul(point, b))
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+#
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2016 The Electrum developers
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+'''Bindings to the libsecp256k1 shared library, if it is installed.
+
+The library must be built with the recovery module.  Secrets, tweaks
+and message hashes are 32 byte strings, public keys are (x, y) tuples
+and signatures are 64 byte strings r || s.  The functions return None
+where libsecp256k1 reports a failure.'''
+
+import os
+import sys
+import ctypes
+import ctypes.util
+from ctypes import byref, c_char_p, c_int, c_size_t, c_uint, c_void_p, create_string_buffer
+
+from util import print_error
+
+SECP256K1_FLAGS_TYPE_CONTEXT = 1 << 0
+SECP256K1_FLAGS_TYPE_COMPRESSION = 1 << 1
+SECP256K1_FLAGS_BIT_CONTEXT_VERIFY = 1 << 8
+SECP256K1_FLAGS_BIT_CONTEXT_SIGN = 1 << 9
+
+SECP256K1_CONTEXT_VERIFY = SECP256K1_FLAGS_TYPE_CONTEXT | SECP256K1_FLAGS_BIT_CONTEXT_VERIFY
+SECP256K1_CONTEXT_SIGN = SECP256K1_FLAGS_TYPE_CONTEXT | SECP256K1_FLAGS_BIT_CONTEXT_SIGN
+SECP256K1_EC_UNCOMPRESSED = SECP256K1_FLAGS_TYPE_COMPRESSION
+
+
+def library_names():
+    if sys.platform == 'darwin':
+        names = ['libsecp256k1.0.dylib', 'libsecp256k1.dylib']
+    elif sys.platform in ('windows', 'win32'):
+        names = ['libsecp256k1.dll']
+    else:
+        names = ['libsecp256k1.so.0', 'libsecp256k1.so']
+    found = ctypes.util.find_library('secp256k1')
+    if found and found not in names:
+        names.append(found)
+    return names
+
+
+def load_library():
+    for name in library_names():
+        try:
+            lib = ctypes.CDLL(name)
+        except OSError:
+            continue
+        try:
+            lib.secp256k1_context_create.argtypes = [c_uint]
+            lib.secp256k1_context_create.restype = c_void_p
+
+            lib.secp256k1_context_randomize.argtypes = [c_void_p, c_char_p]
+            lib.secp256k1_context_randomize.restype = c_int
+
+            lib.secp256k1_ec_pubkey_create.argtypes = [c_void_p, c_void_p, c_char_p]
+            lib.secp256k1_ec_pubkey_create.restype = c_int
+
+            lib.secp256k1_ec_pubkey_parse.argtypes = [c_void_p, c_void_p, c_char_p, c_size_t]
+            lib.secp256k1_ec_pubkey_parse.restype = c_int
+
+            lib.secp256k1_ec_pubkey_serialize.argtypes = [c_void_p, c_char_p, c_void_p, c_void_p, c_uint]
+            lib.secp256k1_ec_pubkey_serialize.restype = c_int
+
+            lib.secp256k1_ec_pubkey_tweak_add.argtypes = [c_void_p, c_void_p, c_char_p]
+            lib.secp256k1_ec_pubkey_tweak_add.restype = c_int
+
+            lib.secp256k1_ecdsa_sign.argtypes = [c_void_p, c_char_p, c_char_p, c_char_p, c_void_p, c_void_p]
+            lib.secp256k1_ecdsa_sign.restype = c_int
+
+            lib.secp256k1_ecdsa_verify.argtypes = [c_void_p, c_char_p, c_char_p, c_void_p]
+            lib.secp256k1_ecdsa_verify.restype = c_int
+
+            lib.secp256k1_ecdsa_signature_parse_compact.argtypes = [c_void_p, c_char_p, c_char_p]
+            lib.secp256k1_ecdsa_signature_parse_compact.restype = c_int
+
+            lib.secp256k1_ecdsa_signature_serialize_compact.argtypes = [c_void_p, c_char_p, c_char_p]
+            lib.secp256k1_ecdsa_signature_serialize_compact.restype = c_int
+
+            lib.secp256k1_ecdsa_signature_normalize.argtypes = [c_void_p, c_char_p, c_char_p]
+            lib.secp256k1_ecdsa_signature_normalize.restype = c_int
+
+            lib.secp256k1_ecdsa_recoverable_signature_parse_compact.argtypes = [c_void_p, c_char_p, c_char_p, c_int]
+            lib.secp256k1_ecdsa_recoverable_signature_parse_compact.restype = c_int
+
+            lib.secp256k1_ecdsa_recover.argtypes = [c_void_p, c_void_p, c_char_p, c_char_p]
+            lib.secp256k1_ecdsa_recover.restype = c_int
+        except AttributeError:
+            print_error('[ecc_native] %s was built without the recovery module' % name)
+            continue
+        lib.ctx = lib.secp256k1_context_create(SECP256K1_CONTEXT_SIGN | SECP256K1_CONTEXT_VERIFY)
+        if not lib.ctx:
+            continue
+        lib.secp256k1_context_randomize(lib.ctx, os.urandom(32))
+        return lib
+    return None
+
+
+libsecp256k1 = load_library()
+
+
+def _parse_pubkey(xy):
+    pubkey = create_string_buffer(64)
+    ser = '\x04' + ('%064x%064x' % xy).decode('hex')
+    if not libsecp256k1.secp256k1_ec_pubkey_parse(libsecp256k1.ctx, pubkey, ser, len(ser)):
+        return None
+    return pubkey
+
+def _serialize_pubkey(pubkey):
+    out = create_string_buffer(65)
+    size = c_size_t(65)
+    libsecp256k1.secp256k1_ec_pubkey_serialize(libsecp256k1.ctx, out, byref(size), pubkey, SECP256K1_EC_UNCOMPRESSED)
+    ser = out.raw
+    return int(ser[1:33].encode('hex'), 16), int(ser[33:65].encode('hex'), 16)
+
+
+def pubkey_create(secret):
+    '''secret * G'''
+    pubkey = create_string_buffer(64)
+    if not libsecp256k1.secp256k1_ec_pubkey_create(libsecp256k1.ctx, pubkey, secret):
+        return None
+    return _serialize_pubkey(pubkey)
+
+
+def pubkey_tweak_add(xy, tweak):
+    '''tweak * G + xy'''
+    pubkey = _parse_pubkey(xy)
+    if pubkey is None or not libsecp256k1.secp256k1_ec_pubkey_tweak_add(libsecp256k1.ctx, pubkey, tweak):
+        return None
+    return _serialize_pubkey(pubkey)
+
+
+def sign(msg_hash, secret):
+    '''Deterministic (RFC 6979) signature, with a low S'''
+    sig = create_string_buffer(64)
+    if not libsecp256k1.secp256k1_ecdsa_sign(libsecp256k1.ctx, sig, msg_hash, secret, None, None):
+        return None
+    out = create_string_buffer(64)
+    libsecp256k1.secp256k1_ecdsa_signature_serialize_compact(libsecp256k1.ctx, out, sig)
+    return out.raw
+
+
+def verify(sig_string, msg_hash, xy):
+    '''Accepts signatures with a high S, as python-ecdsa does'''
+    pubkey = _parse_pubkey(xy)
+    if pubkey is None:
+        return False
+    sig = create_string_buffer(64)
+    if not libsecp256k1.secp256k1_ecdsa_signature_parse_compact(libsecp256k1.ctx, sig, sig_string):
+        return False
+    libsecp256k1.secp256k1_ecdsa_signature_normalize(libsecp256k1.ctx, sig, sig)
+    return bool(libsecp256k1.secp256k1_ecdsa_verify(libsecp256k1.ctx, sig, msg_hash, pubkey))
+
+
+def recover(sig_string, recid, msg_hash):
+    '''The public key that made sig_string, given the recovery id'''
+    sig = create_string_buffer(65)
+    if not libsecp256k1.secp256k1_ecdsa_recoverable_signature_parse_compact(libsecp256k1.ctx, sig, sig_string, recid):
+        return None
+    pubkey = create_string_buffer(64)
+    if not libsecp256k1.secp256k1_ecdsa_recover(libsecp256k1.ctx, pubkey, sig, msg_hash):
+        return None
+    return _serialize_pubkey(pubkey)
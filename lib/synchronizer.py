@@ -179,3 +179,6 @@ class Synchronizer(ThreadJob):
         if up_to_date != self.wallet.is_up_to_date():
             self.wallet.set_up_to_date(up_to_date)
             self.network.trigger_callback('updated')
+
+        # 4. Save the changes received, if due
+        self.wallet.maybe_save_transactions()
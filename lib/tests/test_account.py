@@ -3,6 +3,12 @@ import unittest
 from lib import account
 from lib import wallet
 
+
+def make_storage(data):
+    storage = wallet.WalletStorage(None)
+    storage.data = data
+    return storage
+
 class Test_Account(unittest.TestCase):
 
     def test_bip32_account(self):
@@ -46,11 +52,11 @@ class Test_Account(unittest.TestCase):
                           ('1EtJphMVpes4UKm8bYu5D1fGvNoTSJM3ZL', v['receiving'][0]))
 
         xprv = 'xprv9s21ZrQH143K2eGb6FZ81nLW44cyy7mrAiqg4VB4pQKDrmizjc1pSuynnpeiaMPdZxvrfvdBi5oqFi9hmsV7MrsVquKkruQ7TJPCfVuPSdw'
-        storage = dict(
+        storage = make_storage(dict(
             master_public_keys={0: a.xpub},
             master_private_keys={0: xprv},
             wallet_type='standard'
-        )
+        ))
         w = wallet.BIP32_Wallet(storage)
         self.assertEquals(a.get_private_key(sequence=[0, 0], wallet=w, password=None),
                           ['KxuBFG13CPUBwPAUWvZSQ3mjNNjHoDghfxnax6RbwS3Rw8tqSzCk'])
@@ -68,6 +74,34 @@ class Test_Account(unittest.TestCase):
                 self.assertEquals(xpub, a.xpub)
                 self.assertEquals(seq, [for_change, n])
 
+    def test_derive_pubkeys_range(self):
+        xpub = 'xpub661MyMwAqRbcF8M4CH68NvHEc6TUNaVhXwmGrsagNjrCja49H9L4ziJGe8YmaSBPbY4ZmQPQeW5CK6fiwx2EH6VxQab3zwDzZVWVApDSVNh'
+        a = account.BIP32_Account({'xpub': xpub})
+        for for_change in [0, 1]:
+            expected = [a.derive_pubkey_from_xpub(xpub, for_change, n) for n in range(3, 8)]
+            self.assertEquals(a.derive_pubkeys_range(for_change, 3, 5), expected)
+        self.assertEquals(a.create_new_addresses(1, 2), [a.get_address(1, 0), a.get_address(1, 1)])
+        self.assertEquals(a.get_address_index(a.get_address(1, 1)), (1, 1))
+
+        xpub2 = 'xpub68AQwon69GmEs4VW5cqNq1xdMz8Bu2vp9TKxafoGtpyjz5S4UB6yGuHucPC9vUr4jEDg39Zof7Pk3nS3wvqxR8ngo9TE7itaPdUgRqqxnPE'
+        m = account.Multisig_Account({'xpubs': [xpub, xpub2], 'm': 2})
+        self.assertEquals(m.derive_pubkeys_range(0, 0, 2),
+                          [[a.derive_pubkey_from_xpub(x, 0, n) for x in [xpub, xpub2]] for n in range(2)])
+
+    def test_derivation_pool(self):
+        xpub = 'xpub661MyMwAqRbcF8M4CH68NvHEc6TUNaVhXwmGrsagNjrCja49H9L4ziJGe8YmaSBPbY4ZmQPQeW5CK6fiwx2EH6VxQab3zwDzZVWVApDSVNh'
+        expected = account.BIP32_Account({'xpub': xpub}).derive_pubkeys_range(0, 2, 9)
+        min_pool_range = account.min_pool_range
+        account.min_pool_range = 4
+        account.set_derivation_processes(2)
+        try:
+            a = account.BIP32_Account({'xpub': xpub})
+            self.assertEquals(a.derive_pubkeys_range(0, 2, 9), expected)
+        finally:
+            account.set_derivation_processes(0)
+            account.min_pool_range = min_pool_range
+        self.assertEquals(account.derivation_pool, None)
+
     def test_old_account(self):
         v = {
             'change': [
@@ -99,14 +133,18 @@ class Test_Account(unittest.TestCase):
         self.assertEquals(a.get_address(for_change=1, n=0), '16RyjNDNEwwWkv6mvptvxT9qNN5shJxcxo')
         self.assertEquals(a.get_address(for_change=1, n=3), '1M6kHXnzmiUNsoYKZgzPDVpsSmMcfKFiiM')
 
+        self.assertEquals(a.get_address_index('1Got6wbjxQ592WfwLcfLLxn3aTetLzpTom'), (0, 2))
+        self.assertEquals(a.get_address_index('1M6kHXnzmiUNsoYKZgzPDVpsSmMcfKFiiM'), (1, 3))
+        self.assertEquals(a.get_address_index('1EtJphMVpes4UKm8bYu5D1fGvNoTSJM3ZL'), None)
+
         self.assertTrue(a.check_seed(seed))
         with self.assertRaises(account.InvalidPassword):
             a.check_seed('1' * len(seed))
 
-        storage = {
+        storage = make_storage({
             'seed': '00000000000000000000000000000000',
             'wallet_type': 'old'
-        }
+        })
         w = wallet.OldWallet(storage)
         privkey = a.get_private_key(sequence=[0, 0], wallet=w, password=None)
         self.assertEquals(privkey, ['5Khs7w6fBkogoj1v71Mdt4g8m5kaEyRaortmK56YckgTubgnrhz'])
@@ -121,3 +159,37 @@ class Test_Account(unittest.TestCase):
                 mpk, seq = a.parse_xpubkey(pubkey)
                 self.assertEquals(mpk, v['mpk'])
                 self.assertEquals(seq, [for_change, n])
+
+    def test_address_cache(self):
+        v = {
+            'receiving': ['02f0eaac8dde84cf80ebdb3b136cb29d8c7954c869c6c8fdf9d72a82323a72a30e'],
+            'change': ['02d2967089cbcecf308f133cdec7e97eeeb53a1d8d76fc3656eaa55dac67b7694c'],
+            'xpub': 'xpub661MyMwAqRbcF8M4CH68NvHEc6TUNaVhXwmGrsagNjrCja49H9L4ziJGe8YmaSBPbY4ZmQPQeW5CK6fiwx2EH6VxQab3zwDzZVWVApDSVNh'
+        }
+        a = account.BIP32_Account(v)
+        self.assertFalse(a.address_cache_valid)
+        cache = a.get_address_cache()
+        self.assertEquals(cache['receiving'], ['1EtJphMVpes4UKm8bYu5D1fGvNoTSJM3ZL'])
+
+        # a valid cache is used as it is
+        v['address_cache'] = dict(cache, receiving=['x'])
+        a = account.BIP32_Account(v)
+        self.assertTrue(a.address_cache_valid)
+        self.assertEquals(a.get_address_index('x'), (0, 0))
+
+        # the cache is ignored if the pubkeys have changed
+        v['receiving'] = v['receiving'] + ['02a6f4acc94dc4496a78fad745897fec3b334b182a376ac7abe40975b9333ef67c']
+        a = account.BIP32_Account(v)
+        self.assertFalse(a.address_cache_valid)
+        self.assertEquals(a.get_address(0, 0), '1EtJphMVpes4UKm8bYu5D1fGvNoTSJM3ZL')
+        self.assertEquals(len(a.get_addresses(0)), 2)
+
+    def test_imported_account_address_index(self):
+        a = account.ImportedAccount({'imported': {}})
+        a.add('1FHsTashEBUNPQwC1CwVjnKUxzwgw73pU4', None, None, None)
+        a.add('16RyjNDNEwwWkv6mvptvxT9qNN5shJxcxo', None, None, None)
+        self.assertEquals(a.get_address_index('16RyjNDNEwwWkv6mvptvxT9qNN5shJxcxo'), (0, 0))
+        self.assertEquals(a.get_address_index('1FHsTashEBUNPQwC1CwVjnKUxzwgw73pU4'), (0, 1))
+        a.remove('16RyjNDNEwwWkv6mvptvxT9qNN5shJxcxo')
+        self.assertEquals(a.get_address_index('16RyjNDNEwwWkv6mvptvxT9qNN5shJxcxo'), None)
+        self.assertEquals(a.get_address_index('1FHsTashEBUNPQwC1CwVjnKUxzwgw73pU4'), (0, 0))
@@ -8,6 +8,8 @@ from lib.bitcoin import (
     pw_decode, Hash, public_key_from_private_key, address_from_private_key,
     is_valid, is_private_key, xpub_from_xprv, is_new_seed, is_old_seed,
     var_int, op_push)
+from lib.util import InvalidPassword
+from lib import bitcoin, ecc_fast, ecc_native
 
 try:
     import ecdsa
@@ -112,6 +114,29 @@ class Test_bitcoin(unittest.TestCase):
         enc = pw_encode(payload, password)
         self.assertRaises(Exception, pw_decode, enc, wrong_password)
 
+    def test_aes_backends_are_compatible(self):
+        key, iv = Hash('key'), Hash('iv')[:16]
+        for data in ['', 'a', 'a' * 15, 'a' * 16, 'a' * 17, chr(255) * 100]:
+            ciphertexts = []
+            for name, (encrypt, decrypt) in bitcoin.aes_backends.items():
+                ciphertexts.append(encrypt(key, iv, data))
+                for name2, (encrypt2, decrypt2) in bitcoin.aes_backends.items():
+                    self.assertEqual(data, decrypt2(key, iv, ciphertexts[-1]))
+            self.assertEqual(len(set(ciphertexts)), 1)
+
+    def test_pw_decode_with_each_aes_backend(self):
+        # encrypted with slowaes.encryptData
+        enc = '0XQRmHHdpT9lK+k+M5CHnZcqfQYVnMKNM+ieYXr/ZLk2ydHplgaFHbgYYxED0juusfmLDhraVHT74W1uyKYQBRtTZCOXo4B4GzQlgs3TgTU='
+        backend = bitcoin.aes_backend
+        try:
+            for name in bitcoin.aes_backends:
+                bitcoin.set_aes_backend(name)
+                self.assertEqual(pw_decode(enc, 'secret'), 'L52XzL2cMkHxqxBXRyEpnPQZGUs3uKiL3R11XbAdHigRzDozKZeW')
+                self.assertRaises(InvalidPassword, pw_decode, enc, 'wrong password')
+                self.assertEqual(pw_decode(pw_encode(u'\u66f4', 'secret'), 'secret'), u'\u66f4')
+        finally:
+            bitcoin.set_aes_backend(backend)
+
     def test_hash(self):
         """Make sure the Hash function does sha256 twice"""
         payload = u"test"
@@ -166,6 +191,71 @@ class Test_bitcoin(unittest.TestCase):
         self.assertEqual(op_push(0x12345678), '4e78563412')
 
 
+class Test_base58(unittest.TestCase):
+    """ base_encode and base_decode against the digit by digit codec
+    they replaced """
+
+    def reference_encode(self, v, chars):
+        base = len(chars)
+        long_value = 0L
+        for (i, c) in enumerate(v[::-1]):
+            long_value += (256**i) * ord(c)
+        result = ''
+        while long_value >= base:
+            div, mod = divmod(long_value, base)
+            result = chars[mod] + result
+            long_value = div
+        result = chars[long_value] + result
+        nPad = 0
+        for c in v:
+            if c == '\0': nPad += 1
+            else: break
+        return (chars[0]*nPad) + result
+
+    def reference_decode(self, v, chars):
+        base = len(chars)
+        long_value = 0L
+        for (i, c) in enumerate(v[::-1]):
+            long_value += chars.find(c) * (base**i)
+        result = ''
+        while long_value >= 256:
+            div, mod = divmod(long_value, 256)
+            result = chr(mod) + result
+            long_value = div
+        result = chr(long_value) + result
+        nPad = 0
+        for c in v:
+            if c == chars[0]: nPad += 1
+            else: break
+        return chr(0)*nPad + result
+
+    def test_same_as_reference(self):
+        import random
+        r = random.Random(1)
+        values = ['', '\0', '\0\0', '\x01', '\0\x01', '\xff' * 33]
+        values += [''.join(chr(r.randrange(256)) for i in range(r.randrange(1, 82))) for j in range(200)]
+        values += ['\0' * r.randrange(3) + v for v in values[-20:]]
+        for base, chars in [(58, '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'), (43, '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ$*+-./:')]:
+            for v in values:
+                encoded = bitcoin.base_encode(v, base=base)
+                self.assertEqual(self.reference_encode(v, chars), encoded)
+                self.assertEqual(self.reference_decode(encoded, chars), bitcoin.base_decode(encoded, None, base=base))
+            for v in ['', chars[0], chars[0] * 3, chars[1] + '!', chars[-1] * 40]:
+                self.assertEqual(self.reference_decode(v, chars), bitcoin.base_decode(v, None, base=base))
+            self.assertRaises(ValueError, bitcoin.base_decode, '!' + chars[1], None, base)
+
+    def test_xpub_cache(self):
+        xpub = 'xpub661MyMwAqRbcF8M4CH68NvHEc6TUNaVhXwmGrsagNjrCja49H9L4ziJGe8YmaSBPbY4ZmQPQeW5CK6fiwx2EH6VxQab3zwDzZVWVApDSVNh'
+        key = bitcoin.DecodeBase58Check(xpub)
+        self.assertEqual(bitcoin.EncodeBase58Check(key), xpub)
+        self.assertEqual(bitcoin.xpub_cache[xpub], key)
+        self.assertEqual(bitcoin.DecodeBase58Check(xpub), key)
+        # private keys are not kept
+        sec = 'L52XzL2cMkHxqxBXRyEpnPQZGUs3uKiL3R11XbAdHigRzDozKZeW'
+        self.assertTrue(bitcoin.DecodeBase58Check(sec))
+        self.assertFalse(sec in bitcoin.xpub_cache)
+
+
 class Test_keyImport(unittest.TestCase):
     """ The keys used in this class are TEST keys from
         https://en.bitcoin.it/wiki/BIP_0032_TestVectors"""
@@ -191,6 +281,145 @@ class Test_keyImport(unittest.TestCase):
         self.assertFalse(is_private_key(self.public_key_hex))
 
 
+class Test_ecc_fast(unittest.TestCase):
+
+    def test_mul_generator(self):
+        G = generator_secp256k1
+        for k in [1, 2, 15, 16, 17, 2**128 + 1, G.order() - 1, ecdsa.util.randrange(G.order())]:
+            P = k * G
+            self.assertEqual((P.x(), P.y()), ecc_fast.mul_generator(k))
+        self.assertEqual(None, ecc_fast.mul_generator(G.order()))
+
+    def test_mul(self):
+        G = generator_secp256k1
+        Q = ecdsa.util.randrange(G.order()) * G
+        for k in [1, 2, 3, 31, 2**255, G.order() - 1, ecdsa.util.randrange(G.order())]:
+            P = k * Q
+            self.assertEqual((P.x(), P.y()), ecc_fast.mul((Q.x(), Q.y()), k))
+        self.assertEqual(None, ecc_fast.mul((Q.x(), Q.y()), G.order()))
+
+    def test_mul_add(self):
+        G = generator_secp256k1
+        Q = ecdsa.util.randrange(G.order()) * G
+        a, b = ecdsa.util.randrange(G.order()), ecdsa.util.randrange(G.order())
+        P = a * G + b * Q
+        self.assertEqual((P.x(), P.y()), ecc_fast.mul_add(a, b, (Q.x(), Q.y())))
+        # Q + (-Q)
+        self.assertEqual(None, ecc_fast.mul_add(G.order() - 1, 1, (G.x(), G.y())))
+
+    def test_signatures_match(self):
+        eck = EC_KEY(number_to_string(ecdsa.util.randrange(generator_secp256k1.order()), generator_secp256k1.order()))
+        msg_hash = Hash('test')
+        native = bitcoin.use_libsecp256k1
+        bitcoin.use_libsecp256k1 = False
+        try:
+            sig = eck.sign(msg_hash)
+            bitcoin.set_fast_ecc(True)
+            self.assertEqual(sig, eck.sign(msg_hash))
+        finally:
+            bitcoin.set_fast_ecc(False)
+            bitcoin.use_libsecp256k1 = native
+
+
+class Test_bitcoin_fast_ecc(Test_bitcoin):
+    """ Test_bitcoin with the ecc_fast arithmetic """
+
+    def setUp(self):
+        self.native = bitcoin.use_libsecp256k1
+        bitcoin.use_libsecp256k1 = False
+        bitcoin.set_fast_ecc(True)
+
+    def tearDown(self):
+        bitcoin.set_fast_ecc(False)
+        bitcoin.use_libsecp256k1 = self.native
+
+
+class Test_keyImport_fast_ecc(Test_keyImport):
+
+    def setUp(self):
+        self.native = bitcoin.use_libsecp256k1
+        bitcoin.use_libsecp256k1 = False
+        bitcoin.set_fast_ecc(True)
+
+    def tearDown(self):
+        bitcoin.set_fast_ecc(False)
+        bitcoin.use_libsecp256k1 = self.native
+
+
+@unittest.skipIf(ecc_native.libsecp256k1 is None, "libsecp256k1 is not installed")
+class Test_ecc_native(unittest.TestCase):
+    """ libsecp256k1 and the Python code on the same vectors """
+
+    secrets = [1, 2, 0xdeadbeef, 2**128 + 7, generator_secp256k1.order() - 1]
+    messages = ["", "Chancellor on brink of second bailout for banks", chr(255)*512]
+
+    def setUp(self):
+        bitcoin.use_libsecp256k1 = True
+
+    def tearDown(self):
+        bitcoin.use_libsecp256k1 = True
+
+    def python_backend(self):
+        bitcoin.use_libsecp256k1 = False
+
+    def test_pubkey_create(self):
+        for k in self.secrets:
+            secret = number_to_string(k, generator_secp256k1.order())
+            self.assertEqual(ecc_fast.mul_generator(k), ecc_native.pubkey_create(secret))
+        self.assertEqual(None, ecc_native.pubkey_create('\0' * 32))
+
+    def test_tweak_add(self):
+        G = generator_secp256k1
+        for k in self.secrets:
+            P = k * G
+            for tweak in [0, 1, 0xcafe, G.order() - k]:
+                Q = tweak * G + P
+                expected = None if Q == ecdsa.ellipticcurve.INFINITY else (Q.x(), Q.y())
+                self.assertEqual(expected, ecc_native.pubkey_tweak_add((P.x(), P.y()), number_to_string(tweak, G.order())))
+
+    def test_sign_verify_recover(self):
+        order = generator_secp256k1.order()
+        for k in self.secrets:
+            eck = EC_KEY(number_to_string(k, order))
+            xy = (eck.pubkey.point.x(), eck.pubkey.point.y())
+            for message in self.messages:
+                msg_hash = Hash(message)
+                sig = ecc_native.sign(msg_hash, number_to_string(k, order))
+                self.python_backend()
+                self.assertEqual(eck.sign(msg_hash), sig)
+                bitcoin.use_libsecp256k1 = True
+                self.assertTrue(ecc_native.verify(sig, msg_hash, xy))
+                self.assertFalse(ecc_native.verify(sig, Hash(message + 'x'), xy))
+                # high S
+                r, s = ecdsa.util.sigdecode_string(sig, order)
+                self.assertTrue(ecc_native.verify(ecdsa.util.sigencode_string(r, order - s, order), msg_hash, xy))
+                recovered = [ecc_native.recover(sig, recid, msg_hash) for recid in range(4)]
+                self.assertTrue(xy in recovered)
+                # r + n >= p for recid 2 and 3, which the Python code does not reject
+                for recid in range(2):
+                    try:
+                        self.python_backend()
+                        Q = bitcoin.MyVerifyingKey.from_signature(sig, recid, msg_hash, curve=ecdsa.curves.SECP256k1).pubkey.point
+                        expected = (Q.x(), Q.y())
+                    except Exception:
+                        expected = None
+                    self.assertEqual(expected, recovered[recid])
+                    bitcoin.use_libsecp256k1 = True
+
+    def test_messages(self):
+        order = generator_secp256k1.order()
+        for k in self.secrets:
+            eck = EC_KEY(number_to_string(k, order))
+            addr = public_key_to_bc_address(point_to_ser(eck.pubkey.point, True))
+            for message in self.messages:
+                signature = eck.sign_message(message, True, addr)
+                self.python_backend()
+                self.assertEqual(signature, eck.sign_message(message, True, addr))
+                EC_KEY.verify_message(addr, signature, message)
+                bitcoin.use_libsecp256k1 = True
+                EC_KEY.verify_message(addr, signature, message)
+
+
 class Test_seeds(unittest.TestCase):
     """ Test old and new seeds. """
     
@@ -1,6 +1,11 @@
+import copy
 import unittest
+import mock
 from lib import transaction
-from lib.bitcoin import TYPE_ADDRESS
+from lib.bitcoin import TYPE_ADDRESS, TYPE_SCRIPT, EC_KEY, ASecretToSecret, SecretToASecret, Hash, SECP256k1
+from lib.bitcoin import hash_160, hash_160_to_bc_address
+from lib.util import json_encode
+import ecdsa
 
 import pprint
 
@@ -142,6 +147,319 @@ class TestTransaction(unittest.TestCase):
         res = transaction.parse_xpub('fd007d260305ef27224bbcf6cf5238d2b3638b5a78d5')
         self.assertEquals(res, (None, '1CQj15y1N7LDHp7wTt28eoD1QhHgFgxECH'))
 
+    def _stream_deserialize(self, raw):
+        # the BCDataStream parser that deserialize replaced
+        vds = transaction.BCDataStream()
+        vds.write(raw.decode('hex'))
+        d = {}
+        d['version'] = vds.read_int32()
+        n_vin = vds.read_compact_size()
+        d['inputs'] = list(transaction.parse_input(vds) for i in xrange(n_vin))
+        n_vout = vds.read_compact_size()
+        d['outputs'] = list(transaction.parse_output(vds, i) for i in xrange(n_vout))
+        d['lockTime'] = vds.read_uint32()
+        return d
+
+    def test_deserialize_same_as_stream_parser(self):
+        tx, keypairs = self._multi_input_tx(300)
+        tx.add_outputs([(TYPE_ADDRESS, '3J98t1WpEZ73CNmQviecrnyiWrnqRhWNLy', 3000),
+                        (TYPE_SCRIPT, '6a0568656c6c6f'.decode('hex'), 0),
+                        (TYPE_SCRIPT, ('21' + '02' * 33 + 'ac').decode('hex'), 4000)])
+        unsigned = tx.serialize()
+        tx.sign(keypairs)
+        coinbase = ('01000000' '01' + '00' * 32 + 'ffffffff' '0403a3c205' 'ffffffff'
+                    '01' '00f2052a01000000' '1976a914230ac37834073a42146f11ef8414ae929feaafc388ac' '00000000')
+        for raw in [unsigned_blob, signed_blob, unsigned, tx.raw, coinbase]:
+            self.assertEquals(transaction.deserialize(raw), self._stream_deserialize(raw))
+
+    def test_deserialize_uppercase_and_unicode(self):
+        coinbase = ('01000000' '01' + '00' * 32 + 'ffffffff' '0403a3c205' 'ffffffff'
+                    '01' '00f2052a01000000' '1976a914230ac37834073a42146f11ef8414ae929feaafc388ac' '00000000')
+        for raw in [signed_blob, unsigned_blob, coinbase]:
+            expected = self._stream_deserialize(raw)
+            for r in [raw.upper(), unicode(raw.upper())]:
+                d = transaction.deserialize(r)
+                self.assertEquals(expected, d)
+                self.assertEquals(str, type(d['inputs'][0]['scriptSig']))
+                self.assertEquals(str, type(d['outputs'][0]['scriptPubKey']))
+
+    def _multi_input_tx(self, n):
+        privkey = 'L52XzL2cMkHxqxBXRyEpnPQZGUs3uKiL3R11XbAdHigRzDozKZeW'
+        pubkey = '0339a36013301597daef41fbe593a02cc513d0b55527ec2df1050e2e8ff49c85c2'
+        inputs = [{'prevout_hash': '%064x' % (i + 1), 'prevout_n': i, 'address': '15mKKb2eos1hWa6tisdPwwDC1a5J1y9nma',
+                   'num_sig': 1, 'pubkeys': [pubkey], 'x_pubkeys': [pubkey], 'signatures': [None]}
+                  for i in range(n)]
+        outputs = [(TYPE_ADDRESS, '14CHYaaByjJZpx4oHBpfDMdqhTyXnZ3kVs', 1000), (TYPE_ADDRESS, '1446oU3z268EeFgfcwJv6X2VBXHfoYxfuD', 2000)]
+        return transaction.Transaction.from_io(inputs, outputs), {pubkey: privkey}
+
+    def test_sighash_cache(self):
+        tx, keypairs = self._multi_input_tx(5)
+        sighashes = transaction.SighashCache(tx)
+        for i in [0, 1, 2, 4, 3, 0, 4]:
+            self.assertEquals(sighashes.sighash(i), Hash(tx.tx_for_sig(i).decode('hex')))
+
+    def test_sign_multiple_inputs(self):
+        tx, keypairs = self._multi_input_tx(5)
+        tx.sign(keypairs)
+        self.assertTrue(tx.is_complete())
+        key = EC_KEY(ASecretToSecret(keypairs.values()[0])[0:32])
+        for i, txin in enumerate(tx.inputs()):
+            r, s = ecdsa.util.sigdecode_der(txin['signatures'][0].decode('hex'), SECP256k1.order)
+            # the deterministic signature of the hash of tx_for_sig
+            for_sig = Hash(tx.tx_for_sig(i).decode('hex'))
+            self.assertEquals(ecdsa.util.sigencode_string(r, s, SECP256k1.order), key.sign(for_sig))
+
+
+    def test_signing_pool(self):
+        tx, keypairs = self._multi_input_tx(9)
+        tx.sign(keypairs)
+        min_pool_tasks = transaction.min_pool_tasks
+        transaction.min_pool_tasks = 4
+        transaction.set_signing_processes(2)
+        try:
+            tx2, keypairs = self._multi_input_tx(9)
+            tx2.sign(keypairs)
+            self.assertEquals(tx2.raw, tx.raw)
+        finally:
+            transaction.set_signing_processes(0)
+            transaction.min_pool_tasks = min_pool_tasks
+        self.assertEquals(transaction.signing_pool, None)
+
+    def _p2sh_tx(self):
+        privkeys = ['L52XzL2cMkHxqxBXRyEpnPQZGUs3uKiL3R11XbAdHigRzDozKZeW',
+                    'KwntMbt59tTsj8xqpqYqRRWufyjGunvhSyeMo3NTYpFYzZbXJ5Hp']
+        pubkeys = [EC_KEY(ASecretToSecret(k)[0:32]).get_public_key(True) for k in privkeys]
+        redeem_script = transaction.Transaction.multisig_script(pubkeys, 2)
+        address = hash_160_to_bc_address(hash_160(redeem_script.decode('hex')), 5)
+        inputs = [{'prevout_hash': '%064x' % 1, 'prevout_n': 0, 'address': address, 'num_sig': 2,
+                   'pubkeys': pubkeys, 'x_pubkeys': pubkeys, 'signatures': [None, None],
+                   'redeemScript': redeem_script}]
+        tx = transaction.Transaction.from_io(inputs, [(TYPE_ADDRESS, '14CHYaaByjJZpx4oHBpfDMdqhTyXnZ3kVs', 1000)])
+        return tx, dict(zip(pubkeys, privkeys))
+
+    def test_sign_partially_signed_multisig(self):
+        privkeys = [SecretToASecret(chr(n) * 32, True) for n in (1, 2, 3)]
+        pubkeys = [EC_KEY(ASecretToSecret(k)[0:32]).get_public_key(True) for k in privkeys]
+        redeem_script = transaction.Transaction.multisig_script(pubkeys, 2)
+        address = hash_160_to_bc_address(hash_160(redeem_script.decode('hex')), 5)
+        def make_tx():
+            inputs = [{'prevout_hash': '%064x' % 1, 'prevout_n': 0, 'address': address, 'num_sig': 2,
+                       'pubkeys': list(pubkeys), 'x_pubkeys': list(pubkeys), 'signatures': [None] * 3,
+                       'redeemScript': redeem_script}]
+            return transaction.Transaction.from_io(inputs, [(TYPE_ADDRESS, '14CHYaaByjJZpx4oHBpfDMdqhTyXnZ3kVs', 1000)])
+        keypairs = dict(zip(pubkeys, privkeys))
+        tx = make_tx()
+        tx.sign({pubkeys[0]: privkeys[0]})
+        self.assertFalse(tx.is_complete())
+        # the key of the signed slot does not use up the second signature
+        tx.sign(keypairs)
+        self.assertTrue(tx.is_complete())
+        self.assertEquals(tx.inputs()[0]['signatures'][2], None)
+        expected = make_tx()
+        expected.sign({pubkeys[0]: privkeys[0], pubkeys[1]: privkeys[1]})
+        self.assertEquals(tx.raw, expected.raw)
+
+    def test_scriptSig_parsed_on_demand(self):
+        tx, keypairs = self._p2sh_tx()
+        tx.sign(keypairs)
+        for raw in [unsigned_blob, signed_blob, tx.raw]:
+            d = transaction.deserialize(raw)
+            txin = d['inputs'][0]
+            self.assertEquals((txin['prevout_n'], txin['sequence']), (0, 0xffffffff))
+            self.assertTrue(txin.fields is None)
+            txin['signatures']
+            self.assertTrue(txin.fields is not None)
+            self.assertEquals(d, self._stream_deserialize(raw))
+            # the dict is complete when it is used as a whole
+            d = transaction.deserialize(raw)
+            expected = self._stream_deserialize(raw)
+            self.assertEquals(json_encode(d), json_encode(expected))
+            self.assertEquals(dict(transaction.deserialize(raw)['inputs'][0].items()), expected['inputs'][0])
+            self.assertEquals(copy.deepcopy(transaction.deserialize(raw)['inputs'][0]), expected['inputs'][0])
+
+    def test_address_from_input_script(self):
+        p2sh_tx, keypairs = self._p2sh_tx()
+        p2sh_address = p2sh_tx.inputs()[0]['address']
+        unsigned = p2sh_tx.serialize()
+        p2sh_tx.sign(keypairs)
+        p2pkh_tx, keypairs = self._multi_input_tx(2)
+        p2pkh_tx.sign(keypairs)
+        for raw, address in [(signed_blob, '1446oU3z268EeFgfcwJv6X2VBXHfoYxfuD'),
+                             (p2pkh_tx.raw, '15mKKb2eos1hWa6tisdPwwDC1a5J1y9nma'),
+                             (p2sh_tx.raw, p2sh_address),
+                             (unsigned, p2sh_address),
+                             (unsigned_blob, None)]:
+            txin = transaction.deserialize(raw)['inputs'][0]
+            self.assertEquals(transaction.get_address_from_input_script(txin.script), address)
+            # parse_scriptSig finds the same address
+            self.assertEquals(transaction.get_input_address(txin), txin['address'])
+            if address:
+                self.assertEquals(txin['address'], address)
+
+    def test_tx_input(self):
+        expected = self._stream_deserialize(signed_blob)['inputs'][0]
+        txin = transaction.deserialize(signed_blob)['inputs'][0]
+        self.assertTrue(isinstance(txin, transaction.TxInput))
+        self.assertEquals(len(txin.prevout), 36)
+        self.assertTrue('prevout_hash' in txin)
+        self.assertFalse(txin.parsed)
+        self.assertEquals(txin.get('value'), None)
+        self.assertFalse('value' in txin)
+        self.assertEquals(sorted(txin.keys()), sorted(expected.keys()))
+        self.assertEquals(dict(txin), expected)
+        self.assertTrue(txin == expected and expected == txin)
+        self.assertFalse(txin != expected)
+        txin['value'] = 1000
+        txin['prevout_n'] = 3
+        self.assertEquals((txin['value'], txin['prevout_n'], txin.get('prevout_n')), (1000, 3, 3))
+        self.assertNotEqual(txin, expected)
+        with self.assertRaises(KeyError):
+            txin['foo']
+
+    def test_tx_input_mapping(self):
+        expected = self._stream_deserialize(signed_blob)['inputs'][0]
+        txin = transaction.deserialize(signed_blob)['inputs'][0]
+        # setting keys does not parse the scriptSig
+        txin['sequence'] = 1
+        txin.update({'value': 1000}, height=5)
+        self.assertEquals(5, txin.setdefault('height', 6))
+        self.assertEquals(2, txin.setdefault('num', 2))
+        self.assertFalse(txin.parsed)
+        # a set script key overrides the parsed one
+        txin['num_sig'] = 2
+        self.assertEquals(expected['x_pubkeys'], txin['x_pubkeys'])
+        self.assertEquals(2, txin['num_sig'])
+        # a copy is independent, and still unparsed
+        other = transaction.deserialize(signed_blob)['inputs'][0]
+        for c in [other.copy(), copy.copy(other), copy.deepcopy(other)]:
+            self.assertTrue(isinstance(c, transaction.TxInput))
+            self.assertFalse(c.parsed)
+            c['value'] = 1
+            self.assertEquals(expected, other)
+            self.assertEquals(dict(expected, value=1), c)
+        deep = copy.deepcopy(txin)
+        deep['signatures'].append(None)
+        self.assertNotEqual(deep['signatures'], txin['signatures'])
+        # deleting keys
+        self.assertEquals(expected['signatures'], txin.pop('signatures'))
+        self.assertEquals(None, txin.pop('signatures', None))
+        del txin['prevout_n']
+        del txin['value']
+        self.assertFalse('signatures' in txin or 'prevout_n' in txin or 'value' in txin)
+        self.assertEquals(None, txin.get('prevout_n'))
+        with self.assertRaises(KeyError):
+            del txin['prevout_n']
+        d = dict(expected, sequence=1, height=5, num=2, num_sig=2)
+        for key in ['signatures', 'prevout_n']:
+            d.pop(key)
+        self.assertEquals(d, txin)
+        self.assertEquals(sorted(d.keys()), sorted(txin.keys()))
+        txin['prevout_n'] = 7
+        self.assertEquals(7, txin['prevout_n'])
+        key, value = txin.popitem()
+        self.assertFalse(key in txin)
+        txin.clear()
+        self.assertEquals({}, txin.to_dict())
+        self.assertEquals(0, len(txin))
+
+    def test_tx_output(self):
+        tx = transaction.Transaction(signed_blob)
+        output = tx.outputs()[0]
+        self.assertTrue(isinstance(output, transaction.TxOutput))
+        _type, address, value = output
+        self.assertEquals((_type, address, value), (TYPE_ADDRESS, '14CHYaaByjJZpx4oHBpfDMdqhTyXnZ3kVs', 1000000))
+        self.assertEquals(output[2], 1000000)
+        self.assertEquals(tx.outputs(), [(TYPE_ADDRESS, '14CHYaaByjJZpx4oHBpfDMdqhTyXnZ3kVs', 1000000)])
+        self.assertEquals(output.serialize(), transaction.Transaction.serialize_output(tuple(output)))
+        self.assertEquals(tx.serialize(), signed_blob)
+        tx.add_outputs([(TYPE_SCRIPT, '6a0568656c6c6f'.decode('hex'), 0)])
+        self.assertTrue(all(isinstance(o, transaction.TxOutput) for o in tx.outputs()))
+        self.assertEquals(tx.outputs()[1], transaction.TxOutput(TYPE_SCRIPT, '6a0568656c6c6f'.decode('hex'), 0))
+
+    def test_estimated_size(self):
+        compressed = '02' + '11' * 32
+        uncompressed = '04' + '22' * 64
+        def txin(i, pubkeys, num_sig=1, p2sh=False):
+            d = {'prevout_hash': '%064x' % (i + 1), 'prevout_n': i, 'address': '15mKKb2eos1hWa6tisdPwwDC1a5J1y9nma',
+                 'num_sig': num_sig, 'pubkeys': pubkeys, 'x_pubkeys': pubkeys, 'signatures': [None] * len(pubkeys)}
+            if p2sh:
+                d['redeemScript'] = transaction.Transaction.multisig_script(pubkeys, num_sig)
+            return d
+        p2sh_tx, keypairs = self._p2sh_tx()
+        p2sh_tx.sign(keypairs)
+        # a pay-to-pubkey scriptSig only has a signature
+        p2pk = transaction.TxInput('\x11' * 36, 0xffffffff, '\x48' + '\x30' * 71 + '\x01')
+        inputs = [txin(0, [compressed]), txin(1, [uncompressed]), txin(2, [None]),
+                  txin(3, [compressed], 1, True), txin(4, [compressed, uncompressed, compressed], 2, True),
+                  txin(5, [uncompressed] * 15, 15, True), txin(6, [compressed] * 15, 8, True),
+                  transaction.deserialize(signed_blob)['inputs'][0],
+                  transaction.deserialize(p2sh_tx.raw)['inputs'][0], p2pk]
+        self.assertEquals(p2pk['address'], '(pubkey)')
+        for x in inputs:
+            self.assertEquals(transaction.Transaction.estimated_input_size(x),
+                              len(transaction.Transaction.serialize_input(x, -1, -1)) / 2)
+        outputs = [(TYPE_ADDRESS, '14CHYaaByjJZpx4oHBpfDMdqhTyXnZ3kVs', 1000),
+                   (TYPE_ADDRESS, '3J98t1WpEZ73CNmQviecrnyiWrnqRhWNLy', 2000)]
+        outputs += [(TYPE_SCRIPT, '\x6a' * n, 0) for n in [0, 1, 75, 76, 252, 253, 300]]
+        for x in outputs:
+            self.assertEquals(transaction.Transaction.estimated_output_size(x),
+                              len(transaction.Transaction.serialize_output(x)) / 2)
+        for tx_inputs, tx_outputs in [([], outputs[:1]), (inputs, outputs),
+                                      ([txin(i, [compressed]) for i in range(300)], outputs[:2])]:
+            tx = transaction.Transaction.from_io(tx_inputs, tx_outputs)
+            self.assertEquals(tx.estimated_size(), len(tx.serialize(-1)) / 2)
+
+    def _check_caches(self, tx):
+        raw = tx.serialize()
+        self.assertEquals(str(tx), raw)
+        self.assertEquals(tx.raw_bytes(), raw.decode('hex'))
+        self.assertEquals(tx.hash(), Hash(raw.decode('hex'))[::-1].encode('hex'))
+        self.assertEquals(tx.estimated_size(), len(tx.serialize(-1)) / 2)
+        self.assertEquals(tx.as_dict()['hex'], raw)
+
+    def test_cached_txid_and_size(self):
+        privkey = 'L52XzL2cMkHxqxBXRyEpnPQZGUs3uKiL3R11XbAdHigRzDozKZeW'
+        address = '15mKKb2eos1hWa6tisdPwwDC1a5J1y9nma'
+        # an input without its pubkey, which signing fills in
+        x_pubkey = 'fd00' + transaction.bc_address_to_hash_160(address)[1].encode('hex')
+        inputs = [{'prevout_hash': '%064x' % (3 - i), 'prevout_n': i, 'address': address, 'num_sig': 1,
+                   'pubkeys': [None], 'x_pubkeys': [x_pubkey], 'signatures': [None]} for i in range(3)]
+        tx = transaction.Transaction.from_io(inputs[:1], [(TYPE_ADDRESS, '14CHYaaByjJZpx4oHBpfDMdqhTyXnZ3kVs', 2000)])
+        self._check_caches(tx)
+        tx.add_inputs(inputs[1:])
+        self._check_caches(tx)
+        tx.add_outputs([(TYPE_ADDRESS, '1446oU3z268EeFgfcwJv6X2VBXHfoYxfuD', 1000)])
+        self._check_caches(tx)
+        txid = tx.hash()
+        tx.BIP_LI01_sort()
+        self.assertNotEqual(tx.hash(), txid)
+        self._check_caches(tx)
+        size = tx.estimated_size()
+        tx.sign({x_pubkey: privkey})
+        self.assertTrue(tx.is_complete())
+        self.assertEquals(tx.estimated_size(), size + 3 * 11)
+        self._check_caches(tx)
+
+        tx = transaction.Transaction(unsigned_blob)
+        self._check_caches(tx)
+        tx.update_signatures(signed_blob)
+        self._check_caches(tx)
+        self.assertEquals(tx.hash(), transaction.Transaction(signed_blob).hash())
+        tx.update(unsigned_blob)
+        self._check_caches(tx)
+        # raw set from outside the class
+        tx.raw = signed_blob
+        self.assertEquals(tx.hash(), transaction.Transaction(signed_blob).hash())
+        self.assertEquals(tx.raw_bytes(), signed_blob.decode('hex'))
+
+    def test_txid_is_computed_once(self):
+        tx = transaction.Transaction(signed_blob)
+        with mock.patch('lib.transaction.Hash', side_effect=transaction.Hash) as hash_mock:
+            txid = tx.hash()
+            self.assertEquals(tx.hash(), txid)
+            self.assertEquals(tx.raw_bytes(), signed_blob.decode('hex'))
+            self.assertEquals(tx.hash(), txid)
+            self.assertEquals(hash_mock.call_count, 1)
 
 class NetworkMock(object):
 
@@ -4,9 +4,16 @@ import sys
 import unittest
 import os
 import json
+import mock
 
 from StringIO import StringIO
-from lib.wallet import WalletStorage, NewWallet
+from lib.wallet import WalletStorage, JournaledWalletStorage, SqliteWalletStorage, NewWallet
+from lib.wallet import Wallet, Multisig_Wallet, OldWallet, Imported_Wallet
+from lib.wallet import is_sqlite_file, get_storage, TransactionStore, SigningSession
+from lib.account import BIP32_Account, OldAccount
+from lib.bitcoin import bip32_private_key, bip32_root, public_key_from_private_key, hash_160
+from lib.transaction import Transaction
+from lib.bitcoin import TYPE_ADDRESS
 
 
 class FakeSynchronizer(object):
@@ -65,6 +72,248 @@ class TestWalletStorage(WalletTestCase):
             contents = f.read()
         self.assertEqual(some_dict, json.loads(contents))
 
+    def test_put_item(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put('txs', {'t1': 'aa'})
+        storage.write()
+        self.assertTrue(storage.put_item('txs', 't2', 'bb'))
+        self.assertFalse(storage.put_item('txs', 't2', 'bb'))
+        self.assertTrue(storage.put_item('txs', 't1', None))
+        self.assertTrue(storage.put_item('other', 'x', [1]))
+        self.assertEqual(['t2'], storage.get_item_keys('txs'))
+        self.assertEqual('bb', storage.get_item('txs', 't2'))
+        self.assertEqual(None, storage.get_item('missing', 't2'))
+        storage.write()
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual({'t2': 'bb'}, storage.get('txs'))
+        self.assertEqual({'x': [1]}, storage.get('other'))
+
+    def test_get_view(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put('hist', {'a': [['t1', 1]]})
+        view = storage.get_view('hist')
+        self.assertTrue(view is storage.get_view('hist'))
+        self.assertTrue(view['a'] is storage.get_item_view('hist', 'a'))
+        self.assertFalse(view is storage.get('hist'))
+        self.assertFalse(view['a'] is storage.get_item('hist', 'a'))
+        self.assertEqual(None, storage.get_view('missing'))
+        self.assertEqual(None, storage.get_item_view('missing', 'a'))
+        # put_item replaces the item instead of changing it
+        item = view['a']
+        storage.put_item('hist', 'a', [['t1', 1], ['t2', 0]])
+        self.assertEqual([['t1', 1]], item)
+        self.assertEqual([['t1', 1], ['t2', 0]], storage.get_view('hist')['a'])
+
+
+class TestJournaledWalletStorage(WalletTestCase):
+
+    def setUp(self):
+        super(TestJournaledWalletStorage, self).setUp()
+        self.journal_path = self.wallet_path + '.journal'
+        self.storage = JournaledWalletStorage(self.wallet_path)
+        self.storage.put('a', 'b')
+        self.storage.put('txs', {'t1': 'aa', 't2': 'bb'})
+        self.storage.write()
+
+    def test_changes_are_journaled(self):
+        with open(self.wallet_path, "r") as f:
+            snapshot = f.read()
+        self.storage.put('txs', {'t1': 'aa', 't3': 'cc'})
+        self.storage.put('a', None)
+        self.storage.write()
+        with open(self.wallet_path, "r") as f:
+            self.assertEqual(snapshot, f.read())
+        with open(self.journal_path, "r") as f:
+            ops = json.loads(f.readlines()[1])
+        self.assertEqual([['del', 'a'], ['set_item', 'txs', 't3', 'cc'],
+                          ['del_item', 'txs', 't2']], ops)
+        for storage_class in [WalletStorage, JournaledWalletStorage]:
+            storage = storage_class(self.wallet_path)
+            self.assertEqual(None, storage.get('a'))
+            self.assertEqual({'t1': 'aa', 't3': 'cc'}, storage.get('txs'))
+
+    def test_put_item_is_journaled(self):
+        self.storage.put_item('txs', 't3', 'cc')
+        self.storage.put_item('txs', 't1', None)
+        self.storage.write()
+        with open(self.journal_path, "r") as f:
+            ops = json.loads(f.readlines()[1])
+        self.assertEqual([['del_item', 'txs', 't1'], ['set_item', 'txs', 't3', 'cc']], ops)
+        storage = JournaledWalletStorage(self.wallet_path)
+        self.assertEqual({'t2': 'bb', 't3': 'cc'}, storage.get('txs'))
+
+    def test_incomplete_entry_is_dropped(self):
+        self.storage.put('c', 'd')
+        self.storage.write()
+        with open(self.journal_path, "r") as f:
+            size = len(f.read())
+        with open(self.journal_path, "a") as f:
+            f.write('[["set", "e"')
+        storage = JournaledWalletStorage(self.wallet_path)
+        self.assertEqual('d', storage.get('c'))
+        self.assertEqual(size, os.path.getsize(self.journal_path))
+        storage.put('e', 'f')
+        storage.write()
+        self.assertEqual('f', WalletStorage(self.wallet_path).get('e'))
+
+    def test_compaction(self):
+        self.storage.min_journal_size = 0
+        for i in range(20):
+            self.storage.put('txs', {'t%d' % i: 'x' * 100})
+            self.storage.write()
+        self.assertTrue(os.path.getsize(self.journal_path) < 2 * os.path.getsize(self.wallet_path))
+        with open(self.wallet_path, "r") as f:
+            self.assertNotEqual({'t1': 'aa', 't2': 'bb'}, json.loads(f.read())['txs'])
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual({'t19': 'x' * 100}, storage.get('txs'))
+
+    def test_stale_journal_is_ignored(self):
+        self.storage.put('a', 'c')
+        self.storage.write()
+        with open(self.journal_path, "r") as f:
+            journal = f.read()
+        # a full rewrite folds the journal into the file
+        storage = WalletStorage(self.wallet_path)
+        storage.put('a', 'd')
+        storage.write()
+        self.assertFalse(os.path.exists(self.journal_path))
+        # as if the journal could not be removed before a crash
+        with open(self.journal_path, "w") as f:
+            f.write(journal)
+        self.assertEqual('d', JournaledWalletStorage(self.wallet_path).get('a'))
+        self.assertFalse(os.path.exists(self.journal_path))
+
+    def test_get_storage_keeps_journaling(self):
+        self.storage.put('a', 'c')
+        self.storage.write()
+        storage = get_storage(self.wallet_path)
+        self.assertTrue(isinstance(storage, JournaledWalletStorage))
+        self.assertEqual('c', storage.get('a'))
+        storage.put('a', 'd')
+        storage.write()
+        self.assertTrue(os.path.exists(self.journal_path))
+        self.assertEqual('d', get_storage(self.wallet_path).get('a'))
+
+
+class TestSqliteWalletStorage(WalletTestCase):
+
+    txi = {'tx1': {'addr1': [['prev:0', 1000], ['prev:1', 2000]]}}
+    txo = {'tx1': {'addr2': [[0, 2500, False]]}, 'tx2': {'addr1': [[1, 7, True]]}}
+    history = {'addr1': [['tx1', 10], ['tx2', 0]]}
+
+    def setUp(self):
+        super(TestSqliteWalletStorage, self).setUp()
+        storage = SqliteWalletStorage(self.wallet_path)
+        storage.put('seed_version', 11)
+        storage.put('txi', self.txi)
+        storage.put('txo', self.txo)
+        storage.put('addr_history', self.history)
+        storage.put('transactions', {'tx1': '0100', 'tx2': '0200'})
+        storage.write()
+
+    def test_round_trip(self):
+        self.assertTrue(is_sqlite_file(self.wallet_path))
+        storage = SqliteWalletStorage(self.wallet_path)
+        self.assertFalse('txi' in storage.data)
+        self.assertEqual(11, storage.get('seed_version'))
+        self.assertEqual(self.txi, storage.get('txi'))
+        self.assertEqual(self.txo, storage.get('txo'))
+        self.assertEqual(self.history, storage.get('addr_history'))
+        self.assertEqual({'tx1': '0100', 'tx2': '0200'}, storage.get('transactions'))
+        self.assertEqual({}, storage.get('pruned_txo', {}))
+
+    def test_rows_are_updated(self):
+        storage = SqliteWalletStorage(self.wallet_path)
+        txo = storage.get('txo')
+        txo.pop('tx2')
+        txo['tx3'] = {'addr3': [[0, 5, False], [1, 6, False]]}
+        storage.put('txo', txo)
+        storage.put('seed_version', None)
+        storage.write()
+        rows = storage.db.execute("SELECT tx_hash, n FROM txo ORDER BY rowid").fetchall()
+        self.assertEqual([('tx1', 0), ('tx3', 0), ('tx3', 1)], rows)
+        storage = SqliteWalletStorage(self.wallet_path)
+        self.assertEqual(txo, storage.get('txo'))
+        self.assertEqual(None, storage.get('seed_version'))
+
+    def test_items_are_read_on_demand(self):
+        storage = SqliteWalletStorage(self.wallet_path)
+        self.assertEqual(['tx1', 'tx2'], sorted(storage.get_item_keys('transactions')))
+        self.assertEqual('0200', storage.get_item('transactions', 'tx2'))
+        self.assertEqual('0200', storage.get_item_view('transactions', 'tx2'))
+        self.assertFalse('transactions' in storage.loaded)
+        self.assertEqual(self.history, storage.get_view('addr_history'))
+        self.assertTrue(storage.put_item('transactions', 'tx3', '0300'))
+        self.assertFalse(storage.put_item('transactions', 'tx2', '0200'))
+        self.assertTrue(storage.put_item('transactions', 'tx1', None))
+        self.assertEqual(['tx2', 'tx3'], sorted(storage.get_item_keys('transactions')))
+        self.assertEqual(None, storage.get_item('transactions', 'tx1'))
+        storage.write()
+        # only the changed items were kept in memory, until written
+        self.assertFalse('transactions' in storage.data)
+        self.assertEqual('0300', storage.get_item('transactions', 'tx3'))
+        storage.put_item('transactions', 'tx4', '0400')
+        self.assertEqual({'tx2': '0200', 'tx3': '0300', 'tx4': '0400'}, storage.get('transactions'))
+        storage.write()
+        storage = SqliteWalletStorage(self.wallet_path)
+        self.assertEqual({'tx2': '0200', 'tx3': '0300', 'tx4': '0400'}, storage.get('transactions'))
+
+    def test_convert_json_wallet(self):
+        os.remove(self.wallet_path)
+        storage = WalletStorage(self.wallet_path)
+        storage.put('txi', self.txi)
+        storage.put('labels', {'tx1': 'coffee'})
+        storage.write()
+        storage = SqliteWalletStorage(self.wallet_path)
+        self.assertEqual(self.txi, storage.get('txi'))
+        storage.put('use_encryption', False)
+        storage.write()
+        self.assertTrue(is_sqlite_file(self.wallet_path))
+        storage = SqliteWalletStorage(self.wallet_path)
+        self.assertEqual(self.txi, storage.get('txi'))
+        self.assertEqual({'tx1': 'coffee'}, storage.get('labels'))
+        self.assertEqual(False, storage.get('use_encryption'))
+
+
+class TestTransactionStore(unittest.TestCase):
+
+    def test_parsed_transactions_are_bounded(self):
+        store = TransactionStore({})
+        store.max_parsed = 2
+        txs = [Transaction.from_io([], [(TYPE_ADDRESS, '15mKKb2eos1hWa6tisdPwwDC1a5J1y9nma', i)])
+               for i in range(3)]
+        for i, tx in enumerate(txs):
+            store['%d' % i] = tx
+        self.assertEqual(['1', '2'], store.parsed.keys())
+        self.assertTrue(store.get('2') is txs[2])
+        # evicted transactions are parsed again from the raw tx
+        tx = store.get('0')
+        self.assertFalse(tx is txs[0])
+        tx.deserialize()
+        self.assertEqual(txs[0].outputs(), tx.outputs())
+        self.assertEqual(['2', '0'], store.parsed.keys())
+        self.assertEqual(str(txs[1]), store.get_raw('1'))
+        self.assertEqual(3, len(store))
+        self.assertTrue(store.pop('1') is not None)
+        self.assertFalse('1' in store)
+        self.assertEqual(None, store.pop('1', None))
+        self.assertRaises(KeyError, lambda: store['1'])
+
+    def test_removed_transactions_are_not_parsed(self):
+        loaded = []
+        def load_raw(tx_hash):
+            loaded.append(tx_hash)
+            return 'zz'
+        store = TransactionStore({'a': None, 'b': None, 'c': 'zz'}, load_raw)
+        store.remove('a')
+        self.assertEqual([], loaded)
+        # the popped tx is parsed only when it is used
+        tx = store.pop('c')
+        self.assertEqual('zz', tx.raw)
+        self.assertEqual(None, tx._inputs)
+        self.assertEqual([], store.parsed.keys())
+        self.assertEqual(['b'], store.keys())
+
 
 class TestNewWallet(WalletTestCase):
 
@@ -108,3 +357,361 @@ class TestNewWallet(WalletTestCase):
         new_password = "secret2"
         self.wallet.update_password(self.password, new_password)
         self.wallet.get_seed(new_password)
+
+    def test_address_index(self):
+        account = self.wallet.default_account()
+        receiving = self.wallet.create_new_address(account, 0)
+        change = self.wallet.create_new_address(account, 1)
+        self.assertTrue(self.wallet.is_mine(receiving))
+        self.assertFalse(self.wallet.is_change(receiving))
+        self.assertTrue(self.wallet.is_change(change))
+        n = len(account.get_addresses(0)) - 1
+        self.assertEqual(self.wallet.get_address_index(receiving), ('0', (0, n)))
+        self.assertFalse(self.wallet.is_mine(self.import_key_address))
+        self.assertEqual(self.wallet.get_account_from_address(self.import_key_address), None)
+
+    def test_private_keys_from_xpubkeys(self):
+        account = self.wallet.default_account()
+        x_pubkeys = [account.get_xpubkeys(for_change, n)[0] for for_change in (0, 1) for n in range(3)]
+        keypairs = self.wallet.get_private_keys_from_xpubkeys(x_pubkeys, self.password)
+        self.assertEqual(keypairs, dict((x, self.wallet.get_private_key_from_xpubkey(x, self.password)) for x in x_pubkeys))
+
+    def test_private_keys_from_pubkeys(self):
+        self.wallet.synchronize()
+        account = self.wallet.default_account()
+        x_pubkeys = [account.get_pubkey(for_change, n) for for_change in (0, 1) for n in range(3)]
+        expected = dict((x, self.wallet.get_private_key_from_xpubkey(x, self.password)) for x in x_pubkeys)
+        with mock.patch.object(self.wallet, 'get_master_private_key',
+                               side_effect=self.wallet.get_master_private_key) as get_master_private_key:
+            self.assertEqual(expected, self.wallet.get_private_keys_from_xpubkeys(x_pubkeys, self.password))
+        get_master_private_key.assert_called_once_with(self.wallet.root_name, self.password)
+
+    def test_private_keys_from_imported_keys(self):
+        wallet = Imported_Wallet(WalletStorage(os.path.join(self.user_dir, "imported")))
+        wallet.import_key(self.import_private_key, None)
+        pubkey = public_key_from_private_key(self.import_private_key)
+        x_pubkeys = [pubkey, 'fd00' + hash_160(pubkey.decode('hex')).encode('hex')]
+        expected = dict((x, self.import_private_key) for x in x_pubkeys)
+        self.assertEqual(expected, wallet.get_private_keys_from_xpubkeys(x_pubkeys, None))
+
+    def test_signing_session(self):
+        account = self.wallet.default_account()
+        x_pubkeys = [account.get_xpubkeys(for_change, n)[0] for for_change in (0, 1) for n in range(3)]
+        expected = [self.wallet.get_private_key_from_xpubkey(x_pubkey, self.password) for x_pubkey in x_pubkeys]
+        session = SigningSession(self.wallet, self.password)
+        root = self.wallet.root_name
+        with mock.patch.object(self.wallet, 'get_master_private_key',
+                               side_effect=self.wallet.get_master_private_key) as get_master_private_key:
+            for x_pubkey, sec in zip(x_pubkeys, expected):
+                xpub, sequence = BIP32_Account.parse_xpubkey(x_pubkey)
+                k, c = session.get_node(root, tuple(sequence[:-1]))
+                self.assertEqual(sec, bip32_private_key(sequence[-1:], k, c))
+        get_master_private_key.assert_called_once_with(root, self.password)
+        self.assertEqual(2, len(session.nodes))  # the receiving and change branches
+        session.close()
+        self.assertEqual({}, session.nodes)
+        self.assertEqual({}, session.master_keys)
+
+    def _txin(self, prevout_hash, prevout_n, address):
+        return {'prevout_hash': prevout_hash, 'prevout_n': prevout_n,
+                'address': address, 'is_coinbase': False, 'num_sig': 1,
+                'pubkeys': [None], 'x_pubkeys': [None], 'signatures': [None]}
+
+    def test_address_cache_is_saved_with_transactions(self):
+        self.wallet.save_transactions(write=True)
+        cache = self.storage.get('address_cache')
+        self.assertEqual(self.wallet.default_account().get_address_cache(), cache['0'])
+        # new addresses do not rewrite the cache
+        self.wallet.create_new_address(self.wallet.default_account(), 0)
+        self.assertEqual(cache, self.storage.get('address_cache'))
+        self.wallet.save_transactions(write=True)
+        storage = WalletStorage(self.wallet_path)
+        self.assertTrue(NewWallet(storage).default_account().address_cache_valid)
+
+    def test_addr_balance_cache(self):
+        account = self.wallet.default_account()
+        addr = self.wallet.create_new_address(account, 0)
+        other = self.import_key_address
+        funding = Transaction.from_io(
+            [self._txin('11' * 32, 0, other)],
+            [(TYPE_ADDRESS, addr, 100000)])
+        funding_hash = '22' * 32
+        self.wallet.receive_tx_callback(funding_hash, funding, 0)
+        self.wallet.receive_history_callback(addr, [(funding_hash, 0)])
+        self.assertEqual(self.wallet.get_addr_balance(addr), (0, 100000, 0))
+        self.assertEqual(self.wallet.get_addr_utxo(addr),
+                         {funding_hash + ':0': (0, 100000, False)})
+
+        # confirmation comes through a new history
+        self.wallet.receive_history_callback(addr, [(funding_hash, 10)])
+        self.assertEqual(self.wallet.get_addr_balance(addr), (100000, 0, 0))
+
+        spending = Transaction.from_io(
+            [self._txin(funding_hash, 0, addr)],
+            [(TYPE_ADDRESS, other, 90000)])
+        spending_hash = '33' * 32
+        self.wallet.receive_tx_callback(spending_hash, spending, 0)
+        self.wallet.receive_history_callback(addr, [(funding_hash, 10), (spending_hash, 0)])
+        self.assertEqual(self.wallet.get_addr_balance(addr), (100000, -100000, 0))
+        self.assertEqual(self.wallet.get_addr_utxo(addr), {})
+        self.assertEqual(self.wallet.get_addr_received(addr), 100000)
+        self.assertEqual(self.wallet.get_spendable_coins([addr]), [])
+
+        # the server drops the spending tx
+        self.wallet.receive_history_callback(addr, [(funding_hash, 10)])
+        self.assertEqual(self.wallet.get_addr_balance(addr), (100000, 0, 0))
+        self.assertEqual(len(self.wallet.get_spendable_coins([addr])), 1)
+
+    def test_foreign_inputs_are_not_parsed(self):
+        addr = self.wallet.create_new_address(self.wallet.default_account(), 0)
+        pubkey = public_key_from_private_key(self.import_private_key)
+        txin = self._txin('11' * 32, 0, self.import_key_address)
+        txin.update({'pubkeys': [pubkey], 'x_pubkeys': [pubkey]})
+        funding = Transaction.from_io([txin], [(TYPE_ADDRESS, addr, 100000)])
+        funding.sign({pubkey: self.import_private_key})
+        funding = Transaction(funding.raw)
+        self.wallet.receive_tx_callback('22' * 32, funding, 0)
+        self.assertEqual(self.wallet.get_wallet_delta(funding)[:3], (True, False, 100000))
+        self.assertEqual(self.wallet.txi['22' * 32], {})
+        self.assertTrue(funding.inputs()[0].fields is None)
+        self.assertEqual(self.wallet.get_txin_address(funding.inputs()[0]), self.import_key_address)
+
+    def test_estimated_size_after_input_info(self):
+        addr = self.wallet.create_new_address(self.wallet.default_account(), 0)
+        txin = self._txin('11' * 32, 0, addr)
+        txin['scriptSig'] = ''
+        tx = Transaction.from_io([txin], [(TYPE_ADDRESS, self.import_key_address, 90000)])
+        size = tx.estimated_size()
+        coins = [{'prevout_hash': '11' * 32, 'prevout_n': 0, 'address': addr}]
+        with mock.patch.object(self.wallet, 'get_spendable_coins', return_value=coins), \
+             mock.patch.object(self.wallet, 'get_private_keys_from_xpubkeys', return_value={}):
+            self.wallet.sign_transaction(tx, self.password)
+        self.assertTrue(tx.inputs()[0]['x_pubkeys'][0] is not None)
+        self.assertEqual(Transaction.from_io(tx.inputs(), tx.outputs()).estimated_size(),
+                         tx.estimated_size())
+        self.assertNotEqual(size, tx.estimated_size())
+
+    def test_remove_funding_transaction(self):
+        account = self.wallet.default_account()
+        addr = self.wallet.create_new_address(account, 0)
+        other = self.import_key_address
+        funding = Transaction.from_io([self._txin('11' * 32, 0, other)],
+                                      [(TYPE_ADDRESS, addr, 100000)])
+        spending = Transaction.from_io([self._txin('22' * 32, 0, addr)],
+                                       [(TYPE_ADDRESS, other, 90000)])
+        self.wallet.receive_tx_callback('22' * 32, funding, 10)
+        self.wallet.receive_tx_callback('33' * 32, spending, 11)
+        self.wallet.receive_history_callback(addr, [('22' * 32, 10), ('33' * 32, 11)])
+        self.assertEqual(self.wallet.txi['33' * 32], {addr: [('22' * 32 + ':0', 100000)]})
+        self.assertEqual(self.wallet.spending_txs, {'22' * 32: set(['33' * 32])})
+
+        self.wallet.remove_transaction('22' * 32)
+        self.assertEqual(self.wallet.txi['33' * 32], {})
+        self.assertEqual(self.wallet.pruned_txo, {'22' * 32 + ':0': '33' * 32})
+        self.assertEqual(self.wallet.pruned_txo_by_tx, {'33' * 32: set(['22' * 32 + ':0'])})
+        self.assertEqual(self.wallet.spending_txs, {})
+
+        # adding it back fills the pruned input
+        self.wallet.add_transaction('22' * 32, funding)
+        self.assertEqual(self.wallet.txi['33' * 32], {addr: [('22' * 32 + ':0', 100000)]})
+        self.assertEqual(self.wallet.pruned_txo, {})
+        self.assertEqual(self.wallet.pruned_txo_by_tx, {})
+        self.assertEqual(self.wallet.spending_txs, {'22' * 32: set(['33' * 32])})
+
+    def test_save_transactions(self):
+        addr = self.wallet.create_new_address(self.wallet.default_account(), 0)
+        funding = Transaction.from_io([self._txin('11' * 32, 0, self.import_key_address)],
+                                      [(TYPE_ADDRESS, addr, 100000)])
+        spending = Transaction.from_io([self._txin('22' * 32, 0, addr)],
+                                       [(TYPE_ADDRESS, self.import_key_address, 90000)])
+        # the spending tx is received first: its input is pruned
+        self.wallet.receive_tx_callback('33' * 32, spending, 11)
+        self.wallet.receive_history_callback(addr, [('33' * 32, 11)])
+        self.wallet.save_transactions()
+        self.assertEqual({'22' * 32 + ':0': '33' * 32}, self.storage.get('pruned_txo'))
+        self.wallet.receive_tx_callback('22' * 32, funding, 10)
+        self.wallet.receive_history_callback(addr, [('22' * 32, 10), ('33' * 32, 11)])
+        self.wallet.save_transactions()
+        self.assertEqual({}, self.storage.get('pruned_txo'))
+        self.assertEqual(self.wallet.txi, self.storage.get('txi'))
+        self.assertEqual(self.wallet.txo, self.storage.get('txo'))
+        self.assertEqual(set(['22' * 32, '33' * 32]), set(self.storage.get('transactions')))
+        self.assertEqual([['22' * 32, 10], ['33' * 32, 11]],
+                         [list(x) for x in self.storage.get('addr_history')[addr]])
+
+        self.wallet.receive_history_callback(addr, [('33' * 32, 11)])
+        self.wallet.save_transactions()
+        self.assertEqual(self.wallet.txi, self.storage.get('txi'))
+        self.assertFalse('22' * 32 in self.storage.get('txo'))
+        self.assertEqual({'22' * 32 + ':0': '33' * 32}, self.storage.get('pruned_txo'))
+
+        # a loaded wallet shares the history lists with the storage, and
+        # still saves a new history
+        wallet = NewWallet(self.storage)
+        hist = wallet.history[addr]
+        self.assertTrue(hist is self.storage.get_view('addr_history')[addr])
+        wallet.receive_history_callback(addr, [('33' * 32, 12)])
+        wallet.save_transactions()
+        self.assertEqual([['33' * 32, 11]], [list(x) for x in hist])
+        self.assertEqual([['33' * 32, 12]], [list(x) for x in self.storage.get('addr_history')[addr]])
+
+    def test_write_behind(self):
+        self.wallet.create_new_address(self.wallet.default_account(), 0)
+        self.wallet.save_transactions(write=True)
+        self.storage = JournaledWalletStorage(self.wallet_path)
+        self.wallet = NewWallet(self.storage)
+        addr = self.wallet.get_account_addresses(None)[-1]
+        self.wallet.save_batch_size = 3
+        for i in range(2):
+            tx = Transaction.from_io([self._txin('%064x' % i, 0, self.import_key_address)],
+                                     [(TYPE_ADDRESS, addr, 1000)])
+            self.wallet.receive_tx_callback('%064x' % (i + 100), tx, 0)
+        self.assertEqual(None, self.storage.get('transactions'))
+        self.assertFalse(self.storage.modified)
+        # the batch is full
+        self.wallet.receive_history_callback(addr, [('%064x' % 100, 0), ('%064x' % 101, 0)])
+        self.assertEqual(2, len(self.storage.get('transactions')))
+        self.assertFalse(self.storage.modified)
+        # old changes are saved
+        self.wallet.receive_tx_callback('%064x' % 102, tx, 0)
+        self.assertEqual(2, len(self.storage.get('transactions')))
+        self.wallet.unsaved_since -= self.wallet.save_interval
+        self.wallet.maybe_save_transactions()
+        self.assertEqual(3, len(WalletStorage(self.wallet_path).get('transactions')))
+
+    def test_no_write_behind_for_whole_file_storage(self):
+        addr = self.wallet.create_new_address(self.wallet.default_account(), 0)
+        self.wallet.save_transactions(write=True)
+        tx = Transaction.from_io([self._txin('11' * 32, 0, self.import_key_address)],
+                                 [(TYPE_ADDRESS, addr, 1000)])
+        self.wallet.receive_tx_callback('22' * 32, tx, 0)
+        self.wallet.unsaved_since = 0
+        self.wallet.maybe_save_transactions()
+        self.assertEqual(None, WalletStorage(self.wallet_path).get('transactions'))
+        self.wallet.set_up_to_date(True)
+        self.assertEqual(1, len(WalletStorage(self.wallet_path).get('transactions')))
+
+    def test_clean_shutdown(self):
+        addr = self.wallet.create_new_address(self.wallet.default_account(), 0)
+        tx = Transaction.from_io([self._txin('11' * 32, 0, self.import_key_address)],
+                                 [(TYPE_ADDRESS, addr, 1000)])
+        self.wallet.receive_tx_callback('22' * 32, tx, 10)
+        self.wallet.receive_history_callback(addr, [('22' * 32, 10)])
+        self.wallet.stop_threads()
+        storage = WalletStorage(self.wallet_path)
+        self.assertTrue(storage.get('clean_shutdown') is not None)
+        self.assertEqual({'22' * 32: [addr]}, storage.get('tx_addr_hist'))
+        # the saved reverse history is used as it is
+        storage.put('tx_addr_hist', {'22' * 32: [addr, 'x']})
+        wallet = NewWallet(storage)
+        self.assertEqual({'22' * 32: set([addr, 'x'])}, wallet.tx_addr_hist)
+        # a crash from now on leaves no marker
+        self.assertEqual(None, storage.get('clean_shutdown'))
+        storage.write()
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual(None, storage.get('clean_shutdown'))
+        storage.put('tx_addr_hist', {})
+        self.assertEqual({'22' * 32: set([addr])}, NewWallet(storage).tx_addr_hist)
+
+    def test_clean_shutdown_marker_mismatch(self):
+        addr = self.wallet.create_new_address(self.wallet.default_account(), 0)
+        self.wallet.stop_threads()
+        storage = WalletStorage(self.wallet_path)
+        storage.put('addr_history', {addr: [['22' * 32, 10]]})
+        storage.put('tx_addr_hist', {})
+        wallet = NewWallet(storage)
+        self.assertEqual({'22' * 32: set([addr])}, wallet.tx_addr_hist)
+
+    def test_get_history(self):
+        account = self.wallet.default_account()
+        addr = self.wallet.create_new_address(account, 0)
+        other = self.import_key_address
+        funding = Transaction.from_io([self._txin('11' * 32, 0, other)],
+                                      [(TYPE_ADDRESS, addr, 100000)])
+        spending = Transaction.from_io([self._txin('22' * 32, 0, addr)],
+                                       [(TYPE_ADDRESS, other, 90000)])
+        self.assertEqual(self.wallet.get_history(), [])
+        self.wallet.receive_tx_callback('22' * 32, funding, 10)
+        self.wallet.receive_history_callback(addr, [('22' * 32, 10)])
+        self.assertEqual([(h[0], h[2], h[4]) for h in self.wallet.get_history()],
+                         [('22' * 32, 100000, 100000)])
+
+        self.wallet.receive_tx_callback('33' * 32, spending, 11)
+        self.wallet.receive_history_callback(addr, [('22' * 32, 10), ('33' * 32, 11)])
+        self.assertEqual([(h[0], h[2], h[4]) for h in self.wallet.get_history()],
+                         [('22' * 32, 100000, 100000), ('33' * 32, -100000, 0)])
+        # a new address in the domain reuses the view
+        self.wallet.create_new_address(account, 0)
+        self.assertEqual(len(self.wallet.get_history()), 2)
+        self.assertEqual(len(self.wallet.history_views), 1)
+        # the history of a single address has its own view
+        self.assertEqual(len(self.wallet.get_history([other])), 0)
+        self.assertEqual(len(self.wallet.history_views), 2)
+
+        # alternating between overlapping domains keeps a view for each
+        domain = set(self.wallet.get_account_addresses(None)) | set(['x%d' % i for i in range(10)])
+        domains = [domain, domain - set([addr])]
+        views = [self.wallet.get_history_view(domain) for domain in domains]
+        self.assertFalse(views[0] is views[1])
+        for i in range(3):
+            for domain, view in zip(domains, views):
+                self.assertTrue(self.wallet.get_history_view(domain) is view)
+                self.assertEqual(domain, view.domain)
+
+        # the funding tx is removed: the delta of its spender is unknown
+        self.wallet.receive_history_callback(addr, [('33' * 32, 11)])
+        self.assertEqual([(h[0], h[2], h[4]) for h in self.wallet.get_history()],
+                         [('33' * 32, None, 0)])
+
+
+class TestMultisigWallet(WalletTestCase):
+
+    def test_address_cache_is_rebuilt_once(self):
+        xpubs = [bip32_root(seed)[1] for seed in ['seed1' * 4, 'seed2' * 4]]
+        storage = WalletStorage(self.wallet_path)
+        wallet = Wallet.from_multisig(xpubs, None, storage, '2of2')
+        wallet.create_main_account()
+        wallet.synchronize()
+        wallet.save_transactions()
+        storage.put('address_cache', None)
+        storage.write()
+        # the missing cache is saved by the first load
+        storage = WalletStorage(self.wallet_path)
+        wallet = Multisig_Wallet(storage)
+        self.assertFalse(wallet.accounts['0'].address_cache_valid)
+        wallet.save_transactions(write=True)
+        wallet = Multisig_Wallet(WalletStorage(self.wallet_path))
+        self.assertTrue(wallet.accounts['0'].address_cache_valid)
+
+
+class TestOldWallet(WalletTestCase):
+
+    def test_seed_is_stretched_once(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put('wallet_type', 'old')
+        wallet = OldWallet(storage)
+        wallet.add_seed('00000000000000000000000000000000', None)
+        wallet.create_master_keys(None)
+        wallet.create_main_account()
+        wallet.synchronize()
+        account = wallet.accounts['0']
+        x_pubkeys = [account.get_xpubkeys(0, n)[0] for n in range(3)]
+        x_pubkeys.append(account.get_pubkey(1, 0))
+        expected = dict((x, wallet.get_private_key_from_xpubkey(x, None)) for x in x_pubkeys)
+        with mock.patch.object(OldAccount, 'stretch_key', side_effect=OldAccount.stretch_key) as stretch_key:
+            self.assertEqual(expected, wallet.get_private_keys_from_xpubkeys(x_pubkeys, None))
+        self.assertEqual(1, stretch_key.call_count)
+
+    def test_private_keys_with_imported_keys(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put('wallet_type', 'old')
+        wallet = OldWallet(storage)
+        wallet.add_seed('00000000000000000000000000000000', None)
+        wallet.create_master_keys(None)
+        wallet.create_main_account()
+        wallet.import_key(TestNewWallet.import_private_key, None)
+        x_pubkeys = [wallet.accounts['0'].get_xpubkeys(0, 0)[0],
+                     public_key_from_private_key(TestNewWallet.import_private_key)]
+        expected = dict((x, wallet.get_private_key_from_xpubkey(x, None)) for x in x_pubkeys)
+        self.assertEqual(TestNewWallet.import_private_key, expected[x_pubkeys[1]])
+        self.assertEqual(expected, wallet.get_private_keys_from_xpubkeys(x_pubkeys, None))
@@ -385,6 +385,267 @@ def parse_scriptSig(d, bytes):
     d['address'] = hash_160_to_bc_address(hash_160(redeemScript.decode('hex')), 5)
 
 
+def is_pubkey_push(x):
+    return (len(x) == 33 and x[0] in '\x02\x03') or (len(x) == 65 and x[0] == '\x04')
+
+
+def get_address_from_input_script(bytes):
+    '''The address of a signed p2pkh or p2sh input, from the hash160 of
+    the last push of its script, without parsing the pubkeys and
+    signatures.  None if the script has another form; parse_scriptSig
+    must then be used.'''
+    if not bytes:
+        return None
+    # p2pkh: a signature push and a pubkey push, with one byte lengths
+    n = ord(bytes[0])
+    if n < opcodes.OP_PUSHDATA1 and len(bytes) > n + 1 and len(bytes) == n + 2 + ord(bytes[n + 1]):
+        pubkey = bytes[n + 2:]
+        if n and bytes[n] == '\x01' and is_pubkey_push(pubkey):
+            return hash_160_to_bc_address(hash_160(pubkey))
+        return None
+    try:
+        decoded = [ x for x in script_GetOp(bytes) ]
+    except Exception:
+        return None
+    if len(decoded) > 2 and match_decoded(decoded, [ opcodes.OP_0 ] + [ opcodes.OP_PUSHDATA4 ] * (len(decoded) - 1)):
+        redeem_script = decoded[-1][1]
+        try:
+            dec2 = [ x for x in script_GetOp(redeem_script) ]
+        except Exception:
+            return None
+        if len(dec2) > 3 and dec2[-1][0] == opcodes.OP_CHECKMULTISIG \
+           and all(is_pubkey_push(x[1] or '') for x in dec2[1:-2]):
+            return hash_160_to_bc_address(hash_160(redeem_script), 5)
+    return None
+
+
+class TxInput(object):
+    '''A non-coinbase input of a deserialized transaction.  The outpoint
+    and the scriptSig are kept in binary; the scriptSig is parsed by
+    parse_scriptSig when one of the keys it sets is first read.
+
+    A TxInput is used like the input dicts of the rest of Electrum: it has
+    the methods of dict, and it is equal to the dict with the same items.
+    Keys can be set and deleted without parsing the scriptSig.'''
+
+    __slots__ = ['prevout', 'sequence', 'script', 'fields', 'parsed', 'removed']
+    base_keys = ('prevout_hash', 'prevout_n', 'sequence', 'scriptSig', 'is_coinbase')
+    script_keys = frozenset(['address', 'signatures', 'num_sig', 'x_pubkeys', 'pubkeys', 'redeemScript'])
+
+    def __init__(self, prevout, sequence, script):
+        self.prevout = prevout      # hash and index, as serialized
+        self.sequence = sequence
+        self.script = script
+        # the keys set by callers, and the parsed scriptSig once parsed
+        self.fields = None
+        self.parsed = False
+        # the base keys that were deleted
+        self.removed = None
+
+    def parse(self):
+        if not self.parsed:
+            fields = {'pubkeys': [], 'signatures': {}, 'address': None}
+            if self.script:
+                parse_scriptSig(fields, self.script)
+            # keys set before the parse override it
+            fields.update(self.fields or {})
+            self.fields = fields
+            self.parsed = True
+        return self.fields
+
+    def base_value(self, key):
+        if key == 'prevout_hash':
+            return self.prevout[31::-1].encode('hex')
+        elif key == 'prevout_n':
+            return struct.unpack_from('<I', self.prevout, 32)[0]
+        elif key == 'sequence':
+            return self.sequence
+        elif key == 'scriptSig':
+            return self.script.encode('hex')
+        elif key == 'is_coinbase':
+            return False
+        raise KeyError(key)
+
+    def __getitem__(self, key):
+        if not self.parsed and key in self.script_keys:
+            self.parse()
+        fields = self.fields
+        if fields is not None and key in fields:
+            return fields[key]
+        if self.removed and key in self.removed:
+            raise KeyError(key)
+        return self.base_value(key)
+
+    def __setitem__(self, key, value):
+        if self.fields is None:
+            self.fields = {}
+        self.fields[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        if self.fields is not None:
+            self.fields.pop(key, None)
+        if key in self.base_keys:
+            if self.removed is None:
+                self.removed = set()
+            self.removed.add(key)
+
+    def __contains__(self, key):
+        if not self.parsed and key in self.script_keys:
+            self.parse()
+        if self.fields is not None and key in self.fields:
+            return True
+        return key in self.base_keys and not (self.removed and key in self.removed)
+
+    has_key = __contains__
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def pop(self, key, *default):
+        try:
+            value = self[key]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        del self[key]
+        return value
+
+    def popitem(self):
+        for key in self.keys():
+            return key, self.pop(key)
+        raise KeyError('popitem(): dictionary is empty')
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).iteritems():
+            self[key] = value
+
+    def clear(self):
+        self.fields = {}
+        self.parsed = True
+        self.removed = set(self.base_keys)
+
+    def copy(self):
+        txin = TxInput(self.prevout, self.sequence, self.script)
+        txin.fields = None if self.fields is None else dict(self.fields)
+        txin.parsed = self.parsed
+        txin.removed = None if self.removed is None else set(self.removed)
+        return txin
+
+    def to_dict(self):
+        d = dict((key, self.base_value(key)) for key in self.base_keys
+                 if not (self.removed and key in self.removed))
+        d.update(self.parse())
+        return d
+
+    def keys(self):
+        return self.to_dict().keys()
+
+    def values(self):
+        return self.to_dict().values()
+
+    def items(self):
+        return self.to_dict().items()
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    iterkeys = __iter__
+
+    def itervalues(self):
+        return iter(self.values())
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        if isinstance(other, TxInput):
+            other = other.to_dict()
+        return isinstance(other, dict) and self.to_dict() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+    def __reduce__(self):
+        # copy.copy, copy.deepcopy and pickle keep a TxInput
+        return TxInput, (self.prevout, self.sequence, self.script), (self.fields, self.parsed, self.removed)
+
+    def __setstate__(self, state):
+        self.fields, self.parsed, self.removed = state
+
+
+class TxOutput(object):
+    '''An output (type, address, value).  It unpacks and compares like
+    the tuple, and caches its serialization.'''
+
+    __slots__ = ['type', 'address', 'value', 'serialized']
+
+    def __init__(self, type, address, value):
+        self.type = type
+        self.address = address
+        self.value = value
+        self.serialized = None
+
+    def serialize(self):
+        if self.serialized is None:
+            self.serialized = Transaction.serialize_output(tuple(self))
+        return self.serialized
+
+    def __iter__(self):
+        return iter((self.type, self.address, self.value))
+
+    def __len__(self):
+        return 3
+
+    def __getitem__(self, i):
+        return (self.type, self.address, self.value)[i]
+
+    def __eq__(self, other):
+        return isinstance(other, (tuple, TxOutput)) and tuple(self) == tuple(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(tuple(self))
+
+    def __repr__(self):
+        return repr(tuple(self))
+
+    def __reduce__(self):
+        return TxOutput, tuple(self)
+
+
+def make_output(output):
+    return output if isinstance(output, TxOutput) else TxOutput(*output)
+
+
+def get_input_address(txin):
+    '''txin['address'], found with get_address_from_input_script if the
+    scriptSig of txin has not been parsed yet'''
+    if isinstance(txin, TxInput) and not txin.parsed and 'address' not in (txin.fields or ()):
+        address = get_address_from_input_script(txin.script)
+        if address is not None:
+            return address
+    return txin.get('address')
 
 
 def get_address_from_output_script(bytes):
@@ -445,17 +706,62 @@ def parse_output(vds, i):
     return d
 
 
+def read_compact_size(b, pos):
+    size = ord(b[pos])
+    if size < 253:
+        return size, pos + 1
+    elif size == 253:
+        return struct.unpack_from('<H', b, pos + 1)[0], pos + 3
+    elif size == 254:
+        return struct.unpack_from('<I', b, pos + 1)[0], pos + 5
+    return struct.unpack_from('<Q', b, pos + 1)[0], pos + 9
+
+
 def deserialize(raw):
-    vds = BCDataStream()
-    vds.write(raw.decode('hex'))
+    # Numbers are unpacked at their offset in the binary tx, and the hex
+    # output scripts are sliced from raw.  Inputs are TxInput objects,
+    # which parse their scriptSig when it is needed.  Same result as
+    # parse_input and parse_output on a BCDataStream.
+    # raw is sliced as it is, so it must be lowercase str like the hex
+    # that decode('hex') produced
+    raw = str(raw).lower()
+    b = raw.decode('hex')
     d = {}
-    start = vds.read_cursor
-    d['version'] = vds.read_int32()
-    n_vin = vds.read_compact_size()
-    d['inputs'] = list(parse_input(vds) for i in xrange(n_vin))
-    n_vout = vds.read_compact_size()
-    d['outputs'] = list(parse_output(vds,i) for i in xrange(n_vout))
-    d['lockTime'] = vds.read_uint32()
+    d['version'], = struct.unpack_from('<i', b, 0)
+    n_vin, pos = read_compact_size(b, 4)
+    inputs = []
+    for i in xrange(n_vin):
+        prevout = b[pos:pos+36]
+        size, start = read_compact_size(b, pos + 36)
+        pos = start + size
+        sequence, = struct.unpack_from('<I', b, pos)
+        pos += 4
+        if prevout[0:32] == '\x00'*32:
+            txin = {'scriptSig': raw[2*start:2*(start+size)], 'is_coinbase': True}
+        else:
+            txin = TxInput(prevout, sequence, b[start:start+size])
+        inputs.append(txin)
+    d['inputs'] = inputs
+    n_vout, pos = read_compact_size(b, pos)
+    outputs = []
+    for i in xrange(n_vout):
+        txout = {}
+        txout['value'], = struct.unpack_from('<q', b, pos)
+        size, pos = read_compact_size(b, pos + 8)
+        start, pos = pos, pos + size
+        script = raw[2*start:2*pos]
+        # the usual scripts are recognized without decoding them
+        if size == 25 and script[0:6] == '76a914' and script[46:50] == '88ac':
+            txout['type'], txout['address'] = TYPE_ADDRESS, hash_160_to_bc_address(b[start+3:start+23])
+        elif size == 23 and script[0:4] == 'a914' and script[44:46] == '87':
+            txout['type'], txout['address'] = TYPE_ADDRESS, hash_160_to_bc_address(b[start+2:start+22], 5)
+        else:
+            txout['type'], txout['address'] = get_address_from_output_script(b[start:pos])
+        txout['scriptPubKey'] = script
+        txout['prevout_n'] = i
+        outputs.append(txout)
+    d['outputs'] = outputs
+    d['lockTime'], = struct.unpack_from('<I', b, pos)
     return d
 
 
@@ -463,6 +769,141 @@ def push_script(x):
     return op_push(len(x)/2) + x
 
 
+def push_size(n):
+    return op_push_size(n) + n
+
+
+# Sizes in bytes of the inputs and outputs written by serialize(-1),
+# where a signature counts as 0x48 bytes.  They only depend on the type
+# of script, so that the coin chooser does not serialize every coin.
+
+def input_script_size(num_sig, pubkey_sizes, p2sh):
+    '''A p2pkh or pay-to-pubkey scriptSig has one pubkey and one
+    signature; a p2sh one has num_sig of len(pubkey_sizes) signatures.'''
+    sigs = num_sig * push_size(0x48)
+    if not p2sh:
+        return sigs + push_size(pubkey_sizes[0])
+    # m, the pushed pubkeys, n and OP_CHECKMULTISIG
+    redeem_script = 3 + sum(push_size(n) for n in pubkey_sizes)
+    return 1 + sigs + push_size(redeem_script)
+
+def input_size(txin):
+    if txin.get('redeemScript') is not None:
+        script = input_script_size(txin['num_sig'], [len(k)/2 for k in txin['pubkeys']], True)
+    else:
+        x_pubkey = txin['pubkeys'][0]
+        # without the pubkey, 'fd', the address type and the hash160
+        script = input_script_size(1, [22 if x_pubkey is None else len(x_pubkey)/2], False)
+    # outpoint, script and sequence
+    return 36 + var_int_size(script) + script + 4
+
+def output_script_size(output_type, addr):
+    if output_type == TYPE_SCRIPT:
+        return len(addr)
+    elif output_type == TYPE_ADDRESS:
+        addrtype = bc_address_to_hash_160(addr)[0]
+        if addrtype == 0:
+            return 25
+        elif addrtype == 5:
+            return 23
+    raise BaseException("cannot estimate the size of output", output_type, addr)
+
+def output_size(output):
+    output_type, addr, amount = output
+    script = output_script_size(output_type, addr)
+    return 8 + var_int_size(script) + script
+
+
+# optional process pool for signing, see set_signing_processes
+signing_pool = None
+signing_processes = 0
+# fewer tasks than this are done in the calling process
+min_pool_tasks = 20
+
+def set_signing_processes(n):
+    '''Derives the private keys and makes the signatures of transactions
+    with many inputs in a pool of n processes.  n = 0 disables the pool.
+    The pool should be created before any thread is started.'''
+    global signing_pool, signing_processes
+    if signing_pool is not None:
+        signing_pool.terminate()
+        signing_pool = None
+    signing_processes = n
+    if n > 0:
+        import multiprocessing
+        signing_pool = multiprocessing.Pool(n)
+
+def run_in_pool(f, tasks):
+    '''f(tasks), where f maps a list of tasks to a list of results.  Long
+    lists are split between the processes of the signing pool.'''
+    pool = signing_pool
+    if pool is None or len(tasks) < min_pool_tasks:
+        return f(tasks)
+    size = -(-len(tasks) // (signing_processes * 4))
+    chunks = [tasks[i:i + size] for i in range(0, len(tasks), size)]
+    return sum(pool.map(f, chunks), [])
+
+def derive_private_keys(tasks):
+    return [bip32_private_key(sequence, k, c) for sequence, k, c in tasks]
+
+def sign_digests(tasks):
+    '''Signs (hash, private key) pairs.  Returns (pubkey, signature) pairs,
+    hex encoded.'''
+    keys = {}
+    out = []
+    for for_sig, sec in tasks:
+        if sec not in keys:
+            pkey = regenerate_key(sec)
+            assert pkey
+            pubkey = GetPubKey(pkey.pubkey, is_compressed(sec)).encode('hex')
+            keys[sec] = pubkey, bitcoin.MySigningKey.from_secret_exponent( pkey.secret, curve = SECP256k1 )
+        pubkey, private_key = keys[sec]
+        public_key = private_key.get_verifying_key()
+        sig = private_key.sign_digest_deterministic( for_sig, hashfunc=hashlib.sha256, sigencode = ecdsa.util.sigencode_der )
+        assert public_key.verify_digest( sig, for_sig, sigdecode = ecdsa.util.sigdecode_der)
+        out.append((pubkey, sig.encode('hex')))
+    return out
+
+
+class SighashCache(object):
+    '''Signature hashes (SIGHASH_ALL) of the inputs of a transaction.
+
+    The preimage for input i is the transaction with the scripts of the
+    other inputs blanked.  The blanked inputs, the outputs and the
+    trailer are serialized once, and the SHA256 state of the part before
+    input i is carried over from input i-1, so that hashing the inputs
+    in order costs O(1) serialization per input.'''
+
+    def __init__(self, tx):
+        self.tx = tx
+        self.inputs = tx.inputs()
+        head = int_to_hex(1,4) + var_int(len(self.inputs))
+        self.head = head.decode('hex')
+        # blanked inputs all have the same size
+        blanked = [txin['prevout_hash'].decode('hex')[::-1] + int_to_hex(txin['prevout_n'], 4).decode('hex') + '\x00\xff\xff\xff\xff'
+                   for txin in self.inputs]
+        self.input_size = 41
+        tail = var_int(len(tx.outputs())) + ''.join(tx.serialize_output(o) for o in tx.outputs())
+        tail += int_to_hex(0,4) + int_to_hex(1,4)
+        self.rest = ''.join(blanked) + tail.decode('hex')
+        self.reset()
+
+    def reset(self):
+        self.midstate = hashlib.sha256(self.head)
+        self.position = 0
+
+    def sighash(self, i):
+        if i < self.position:
+            self.reset()
+        size = self.input_size
+        self.midstate.update(buffer(self.rest, self.position * size, (i - self.position) * size))
+        self.position = i
+        h = self.midstate.copy()
+        h.update(self.tx.serialize_input(self.inputs[i], i, i).decode('hex'))
+        h.update(buffer(self.rest, (i + 1) * size))
+        return hashlib.sha256(h.digest()).digest()
+
+
 class Transaction:
 
     def __str__(self):
@@ -480,12 +921,24 @@ class Transaction:
         else:
             raise BaseException("cannot initialize transaction", raw)
         self._inputs = None
+        self._outputs = None
+        # (raw, value) pairs: they are recomputed when raw is replaced
+        self._raw_bytes = None
+        self._txid = None
+        self._estimated_size = None
 
     def update(self, raw):
         self.raw = raw
         self._inputs = None
+        self._estimated_size = None
         self.deserialize()
 
+    def changed(self):
+        '''Forget raw and the estimated size, after a change to the inputs
+        or the outputs.'''
+        self.raw = None
+        self._estimated_size = None
+
     def inputs(self):
         if self._inputs is None:
             self.deserialize()
@@ -499,13 +952,14 @@ class Transaction:
     def update_signatures(self, raw):
         """Add new signatures to a transaction"""
         d = deserialize(raw)
+        sighashes = SighashCache(self)
         for i, txin in enumerate(self.inputs()):
             sigs1 = txin.get('signatures')
             sigs2 = d['inputs'][i].get('signatures')
             for sig in sigs2:
                 if sig in sigs1:
                     continue
-                for_sig = Hash(self.tx_for_sig(i).decode('hex'))
+                for_sig = sighashes.sighash(i)
                 # der to string
                 order = ecdsa.ecdsa.generator_secp256k1.order()
                 r, s = ecdsa.util.sigdecode_der(sig.decode('hex'), order)
@@ -523,6 +977,7 @@ class Transaction:
                         self._inputs[i]['x_pubkeys'][j] = pubkey
                         break
         # redo raw
+        self.changed()
         self.raw = self.serialize()
 
 
@@ -533,7 +988,7 @@ class Transaction:
             return
         d = deserialize(self.raw)
         self._inputs = d['inputs']
-        self._outputs = [(x['type'], x['address'], x['value']) for x in d['outputs']]
+        self._outputs = [TxOutput(x['type'], x['address'], x['value']) for x in d['outputs']]
         self.locktime = d['lockTime']
         return d
 
@@ -541,7 +996,7 @@ class Transaction:
     def from_io(klass, inputs, outputs, locktime=0):
         self = klass(None)
         self._inputs = inputs
-        self._outputs = outputs
+        self._outputs = map(make_output, outputs)
         self.locktime = locktime
         return self
 
@@ -665,10 +1120,22 @@ class Transaction:
         s += "ffffffff"
         return s
 
+    @classmethod
+    def serialize_output(self, output):
+        if isinstance(output, TxOutput):
+            return output.serialize()
+        output_type, addr, amount = output
+        s = int_to_hex( amount, 8)                                   # amount
+        script = self.pay_script(output_type, addr)
+        s += var_int( len(script)/2 )                               #  script length
+        s += script                                                 #  script
+        return s
+
     def BIP_LI01_sort(self):
         # See https://github.com/kristovatlas/rfc/blob/master/bips/bip-li01.mediawiki
         self._inputs.sort(key = lambda i: (i['prevout_hash'], i['prevout_n']))
         self._outputs.sort(key = lambda o: (o[2], self.pay_script(o[0], o[1])))
+        self.changed()
 
     def serialize(self, for_sig=None):
         inputs = self.inputs()
@@ -679,11 +1146,7 @@ class Transaction:
             s += self.serialize_input(txin, i, for_sig)
         s += var_int( len(outputs) )                                 # number of outputs
         for output in outputs:
-            output_type, addr, amount = output
-            s += int_to_hex( amount, 8)                              # amount
-            script = self.pay_script(output_type, addr)
-            s += var_int( len(script)/2 )                           #  script length
-            s += script                                             #  script
+            s += self.serialize_output(output)
         s += int_to_hex(0,4)                                        #  lock time
         if for_sig is not None and for_sig != -1:
             s += int_to_hex(1, 4)                                   #  hash type
@@ -692,16 +1155,30 @@ class Transaction:
     def tx_for_sig(self,i):
         return self.serialize(for_sig = i)
 
+    def raw_bytes(self):
+        raw = str(self)
+        if self._raw_bytes is None or self._raw_bytes[0] is not raw:
+            self._raw_bytes = raw, raw.decode('hex')
+        return self._raw_bytes[1]
+
     def hash(self):
-        return Hash(self.raw.decode('hex') )[::-1].encode('hex')
+        raw = str(self)
+        if self._txid is None or self._txid[0] is not raw:
+            # raw_bytes is not kept for the txids of the whole history
+            if self._raw_bytes is not None and self._raw_bytes[0] is raw:
+                b = self._raw_bytes[1]
+            else:
+                b = raw.decode('hex')
+            self._txid = raw, Hash(b)[::-1].encode('hex')
+        return self._txid[1]
 
     def add_inputs(self, inputs):
         self._inputs.extend(inputs)
-        self.raw = None
+        self.changed()
 
     def add_outputs(self, outputs):
-        self._outputs.extend(outputs)
-        self.raw = None
+        self._outputs.extend(map(make_output, outputs))
+        self.changed()
 
     def input_value(self):
         return sum(x['value'] for x in self.inputs())
@@ -715,15 +1192,25 @@ class Transaction:
     def is_final(self):
         return not any([x.get('sequence') < 0xffffffff - 1 for x in self.inputs()])
 
-    @profiler
     def estimated_size(self):
         '''Return an estimated tx size in bytes.'''
-        return len(self.serialize(-1)) / 2  # ASCII hex string
+        if self._estimated_size is None:
+            inputs = self.inputs()
+            outputs = self.outputs()
+            # version, counts, inputs, outputs and lock time
+            self._estimated_size = (4 + var_int_size(len(inputs)) + sum(map(input_size, inputs))
+                                    + var_int_size(len(outputs)) + sum(map(output_size, outputs)) + 4)
+        return self._estimated_size
 
     @classmethod
     def estimated_input_size(self, txin):
         '''Return an estimated of serialized input size in bytes.'''
-        return len(self.serialize_input(txin, -1, -1)) / 2
+        return input_size(txin)
+
+    @classmethod
+    def estimated_output_size(self, output):
+        '''Return the serialized size of output in bytes.'''
+        return output_size(output)
 
     def signature_count(self):
         r = 0
@@ -766,35 +1253,32 @@ class Transaction:
         return out
 
     def sign(self, keypairs):
+        # choose the keys first, then sign with all of them at once
+        tasks = []
         for i, txin in enumerate(self.inputs()):
             num = txin['num_sig']
-            for x_pubkey in txin['x_pubkeys']:
-                signatures = filter(None, txin['signatures'])
-                if len(signatures) == num:
+            count = len(filter(None, txin['signatures']))
+            for ii, x_pubkey in enumerate(txin['x_pubkeys']):
+                if count == num:
                     # txin is complete
                     break
-                if x_pubkey in keypairs.keys():
-                    print_error("adding signature for", x_pubkey)
-                    # add pubkey to txin
-                    txin = self._inputs[i]
-                    x_pubkeys = txin['x_pubkeys']
-                    ii = x_pubkeys.index(x_pubkey)
-                    sec = keypairs[x_pubkey]
-                    pubkey = public_key_from_private_key(sec)
-                    txin['x_pubkeys'][ii] = pubkey
-                    txin['pubkeys'][ii] = pubkey
-                    self._inputs[i] = txin
-                    # add signature
-                    for_sig = Hash(self.tx_for_sig(i).decode('hex'))
-                    pkey = regenerate_key(sec)
-                    secexp = pkey.secret
-                    private_key = bitcoin.MySigningKey.from_secret_exponent( secexp, curve = SECP256k1 )
-                    public_key = private_key.get_verifying_key()
-                    sig = private_key.sign_digest_deterministic( for_sig, hashfunc=hashlib.sha256, sigencode = ecdsa.util.sigencode_der )
-                    assert public_key.verify_digest( sig, for_sig, sigdecode = ecdsa.util.sigdecode_der)
-                    txin['signatures'][ii] = sig.encode('hex')
-                    self._inputs[i] = txin
+                if txin['signatures'][ii]:
+                    # already signed, and counted
+                    continue
+                if x_pubkey in keypairs:
+                    tasks.append((i, ii, x_pubkey))
+                    count += 1
+        if tasks:
+            sighashes = SighashCache(self)
+            results = run_in_pool(sign_digests, [(sighashes.sighash(i), keypairs[x_pubkey]) for i, ii, x_pubkey in tasks])
+            for (i, ii, x_pubkey), (pubkey, sig) in zip(tasks, results):
+                print_error("adding signature for", x_pubkey)
+                txin = self._inputs[i]
+                txin['x_pubkeys'][ii] = pubkey
+                txin['pubkeys'][ii] = pubkey
+                txin['signatures'][ii] = sig
         print_error("is_complete", self.is_complete())
+        self.changed()
         self.raw = self.serialize()
 
 
@@ -833,7 +1317,7 @@ class Transaction:
         # see https://en.bitcoin.it/wiki/Transaction_fees
         #
         # size must be smaller than 1 kbyte for free tx
-        size = len(self.serialize(-1))/2
+        size = self.estimated_size()
         if size >= 10000:
             return True
         # all outputs must be 0.01 BTC or larger for free tx
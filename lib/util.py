@@ -27,9 +27,13 @@ class SilentException(Exception):
 
 class MyEncoder(json.JSONEncoder):
     def default(self, obj):
-        from transaction import Transaction
+        from transaction import Transaction, TxInput, TxOutput
         if isinstance(obj, Transaction):
             return obj.as_dict()
+        if isinstance(obj, TxInput):
+            return obj.to_dict()
+        if isinstance(obj, TxOutput):
+            return list(obj)
         return super(MyEncoder, self).default(obj)
 
 class PrintError(object):
@@ -24,7 +24,11 @@ import random
 import time
 import json
 import copy
+import sqlite3
+import stat
 import re
+from bisect import bisect_left
+from collections import OrderedDict
 from functools import partial
 from unicodedata import normalize
 from i18n import _
@@ -35,7 +39,7 @@ from bitcoin import *
 from account import *
 from version import *
 
-from transaction import Transaction
+from transaction import Transaction, run_in_pool, derive_private_keys, get_input_address
 from plugins import run_hook
 import bitcoin
 from coinchooser import COIN_CHOOSERS
@@ -50,10 +54,15 @@ IMPORTED_ACCOUNT = '/x'
 
 class WalletStorage(PrintError):
 
+    # whether a write costs only the changes since the last one
+    incremental = False
+
     def __init__(self, path):
         self.lock = threading.RLock()
         self.data = {}
         self.path = path
+        self.journal_path = path + '.journal' if path else None
+        self.snapshot_hash = None
         self.file_exists = False
         self.modified = False
         self.print_error("wallet path", self.path)
@@ -67,6 +76,7 @@ class WalletStorage(PrintError):
                 data = f.read()
         except IOError:
             return
+        self.snapshot_hash = hashlib.sha256(data).hexdigest()
         try:
             self.data = json.loads(data)
         except:
@@ -91,6 +101,52 @@ class WalletStorage(PrintError):
                     continue
                 self.data[key] = value
         self.file_exists = True
+        self.read_journal()
+
+    def read_journal(self):
+        '''Apply the changes appended by JournaledWalletStorage since the
+        wallet file was written.  The first line of the journal is the hash
+        of the file it applies to; a journal written against another
+        version of the file is stale and is removed.'''
+        try:
+            with open(self.journal_path, "r") as f:
+                lines = f.readlines()
+        except IOError:
+            return
+        try:
+            header = json.loads(lines[0])
+            valid = header['snapshot'] == self.snapshot_hash
+        except Exception:
+            valid = False
+        if not valid:
+            self.print_error("removing stale journal", self.journal_path)
+            os.remove(self.journal_path)
+            return
+        offset = len(lines[0])
+        for line in lines[1:]:
+            try:
+                # a line is only complete once its newline is written
+                if not line.endswith('\n'):
+                    raise ValueError
+                ops = json.loads(line)
+            except ValueError:
+                self.print_error("truncating incomplete journal entry")
+                with open(self.journal_path, "r+") as f:
+                    f.truncate(offset)
+                break
+            self.apply_journal_ops(ops)
+            offset += len(line)
+
+    def apply_journal_ops(self, ops):
+        for op in ops:
+            if op[0] == 'set':
+                self.data[op[1]] = op[2]
+            elif op[0] == 'del':
+                self.data.pop(op[1], None)
+            elif op[0] == 'set_item':
+                self.data.setdefault(op[1], {})[op[2]] = op[3]
+            elif op[0] == 'del_item':
+                self.data.get(op[1], {}).pop(op[2], None)
 
     def get(self, key, default=None):
         with self.lock:
@@ -101,6 +157,54 @@ class WalletStorage(PrintError):
                 v = copy.deepcopy(v)
         return v
 
+    def get_view(self, key, default=None):
+        '''Like get, but returns the stored value itself instead of a
+        copy.  The caller must not modify it; a caller that keeps it and
+        changes it later must copy what it changes, and put it back.'''
+        with self.lock:
+            v = self.data.get(key)
+        return default if v is None else v
+
+    def get_item_keys(self, key):
+        '''Returns the keys of a dict value.'''
+        with self.lock:
+            return self.data.get(key, {}).keys()
+
+    def get_item_view(self, key, item_key, default=None):
+        '''Like get_item, without the copy.'''
+        with self.lock:
+            v = self.data.get(key, {}).get(item_key)
+        return default if v is None else v
+
+    def get_item(self, key, item_key, default=None):
+        '''Returns one item of a dict value.'''
+        return copy.deepcopy(self.get_item_view(key, item_key, default))
+
+    def put_item(self, key, item_key, value):
+        '''Sets one item of a dict value, or removes it if value is None.
+        Only the item is validated and copied, so the cost does not depend
+        on the size of the dict.  Returns whether the value was modified.'''
+        try:
+            json.dumps(item_key)
+            json.dumps(value)
+        except:
+            self.print_error("json error: cannot save", key, item_key)
+            return False
+        with self.lock:
+            d = self.data.get(key)
+            if value is not None:
+                if d is None:
+                    d = self.data[key] = {}
+                elif d.get(item_key) == value:
+                    return False
+                d[item_key] = copy.deepcopy(value)
+            elif d is not None and item_key in d:
+                d.pop(item_key)
+            else:
+                return False
+            self.modified = True
+        return True
+
     def put(self, key, value):
         try:
             json.dumps(key)
@@ -142,10 +246,602 @@ class WalletStorage(PrintError):
         if 'ANDROID_DATA' not in os.environ:
             import stat
             os.chmod(self.path, mode)
+        # the journal, if any, has been folded into the file
+        self.snapshot_hash = hashlib.sha256(s).hexdigest()
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
         self.print_error("saved", self.path)
         self.modified = False
 
 
+class JournaledWalletStorage(WalletStorage):
+    '''Wallet storage that appends the changes made since the last write
+    to a journal next to the wallet file, instead of rewriting the whole
+    file.  Dict values are journaled item by item.  The journal is folded
+    into the wallet file once it grows larger than the file itself
+    (and than min_journal_size).
+    Existing wallet files are used as they are, as the first snapshot.'''
+
+    min_journal_size = 1 << 16
+    incremental = True
+
+    def __init__(self, path):
+        WalletStorage.__init__(self, path)
+        # keys put since the last write, and their values at that write
+        self.dirty = set()
+        self.written = dict(self.data)
+        # (key, item_key) set with put_item since the last write
+        self.dirty_items = set()
+
+    def put(self, key, value):
+        with self.lock:
+            WalletStorage.put(self, key, value)
+            self.dirty.add(key)
+
+    def put_item(self, key, item_key, value):
+        with self.lock:
+            if WalletStorage.put_item(self, key, item_key, value):
+                self.dirty_items.add((key, item_key))
+                return True
+            return False
+
+    def journal_ops(self):
+        '''Returns the changes since the last write, and starts tracking
+        changes from the current data.  Items set with put_item come first,
+        so that a later put of the whole value overrides them.'''
+        ops = []
+        for key, item_key in sorted(self.dirty_items):
+            v = self.data.get(key, {}).get(item_key)
+            if v is None:
+                ops.append(['del_item', key, item_key])
+            else:
+                ops.append(['set_item', key, item_key, v])
+        for key in sorted(self.dirty):
+            old = self.written.get(key)
+            new = self.data.get(key)
+            if type(old) is dict and type(new) is dict:
+                for k, v in new.items():
+                    if k not in old or old[k] != v:
+                        ops.append(['set_item', key, k, v])
+                for k in old:
+                    if k not in new:
+                        ops.append(['del_item', key, k])
+            elif new is None:
+                if old is not None:
+                    ops.append(['del', key])
+            elif new != old:
+                ops.append(['set', key, new])
+        for key in self.dirty:
+            self.written[key] = self.data.get(key)
+        self.dirty = set()
+        self.dirty_items = set()
+        return ops
+
+    def write(self):
+        if threading.currentThread().isDaemon():
+            self.print_error('warning: daemon thread cannot write wallet')
+            return
+        with self.lock:
+            if not self.modified:
+                return
+            if (not os.path.exists(self.path)
+                or not os.path.exists(self.journal_path)
+                or os.path.getsize(self.journal_path) > max(self.min_journal_size, os.path.getsize(self.path))):
+                # compaction: write a new snapshot, and start a new journal
+                WalletStorage.write(self)
+                self.written = dict(self.data)
+                self.dirty = set()
+                self.dirty_items = set()
+                self.start_journal()
+                return
+            ops = self.journal_ops()
+            self.modified = False
+            if ops:
+                self.append_journal(ops)
+
+    def start_journal(self):
+        fd = os.open(self.journal_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        with os.fdopen(fd, "w") as f:
+            f.write(json.dumps({'snapshot': self.snapshot_hash}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def append_journal(self, ops):
+        line = json.dumps(ops) + '\n'
+        with open(self.journal_path, "a") as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+        self.print_error("journaled %d changes" % len(ops))
+
+
+def _list_rows(d):
+    return [(a, i) + tuple(x) for a, l in d.items() for i, x in enumerate(l)]
+
+def _list_from_rows(rows):
+    d = {}
+    for row in rows:
+        d.setdefault(row[0], []).append(list(row[2:]))
+    return d
+
+# storage key -> (columns, item to rows, rows to item)
+# the first column is the key of the item in the stored dict
+SQLITE_TABLES = {
+    'transactions': (
+        'tx_hash TEXT, raw TEXT',
+        lambda v: [(v,)],
+        lambda rows: str(rows[0][0])),
+    'txi': (
+        'tx_hash TEXT, address TEXT, i INTEGER, prevout TEXT, value INTEGER',
+        _list_rows,
+        _list_from_rows),
+    'txo': (
+        'tx_hash TEXT, address TEXT, i INTEGER, n INTEGER, value INTEGER, is_coinbase INTEGER',
+        _list_rows,
+        lambda rows: dict((a, [[n, v, bool(cb)] for n, v, cb in l])
+                          for a, l in _list_from_rows(rows).items())),
+    'pruned_txo': (
+        'prevout TEXT, tx_hash TEXT',
+        lambda v: [(v,)],
+        lambda rows: rows[0][0]),
+    'addr_history': (
+        'address TEXT, i INTEGER, tx_hash TEXT, height INTEGER',
+        lambda v: [(i,) + tuple(x) for i, x in enumerate(v)],
+        lambda rows: [list(row[1:]) for row in rows]),
+    'verified_tx3': (
+        'tx_hash TEXT, height INTEGER, timestamp INTEGER, pos INTEGER',
+        lambda v: [tuple(v)],
+        lambda rows: list(rows[0])),
+}
+
+
+class SqliteWalletStorage(JournaledWalletStorage):
+    '''Wallet storage in an SQLite database.  The large per-transaction
+    and per-address dicts are kept in indexed tables, one row per item
+    (or per list entry), and updated row by row; other keys are kept as
+    JSON in a key/value table.  A JSON wallet file is converted on the
+    first write.
+    A table is loaded the first time its whole value is used.  Until then
+    get_item and get_item_keys read it from the database, and put_item
+    keeps only the changed items in memory until they are written.'''
+
+    tables = SQLITE_TABLES
+
+    def read(self, path):
+        self.db = None
+        self.loaded = set()
+        if not is_sqlite_file(path):
+            WalletStorage.read(self, path)
+            return
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.text_factory = str
+        for key, value in self.db.execute("SELECT key, value FROM kv"):
+            self.data[key] = json.loads(value)
+        self.file_exists = True
+
+    def is_loaded(self, key):
+        return self.db is None or key not in self.tables or key in self.loaded
+
+    def load_table(self, key):
+        if self.is_loaded(key):
+            return
+        self.loaded.add(key)
+        from_rows = self.tables[key][2]
+        rows = {}
+        for row in self.db.execute("SELECT * FROM %s ORDER BY rowid" % key):
+            rows.setdefault(row[0], []).append(row[1:])
+        value = dict((k, from_rows(r)) for k, r in rows.items())
+        self.written[key] = dict(value)
+        # items put before the table was loaded, None if removed
+        for k, v in self.data.get(key, {}).items():
+            if v is None:
+                value.pop(k, None)
+            else:
+                value[k] = v
+        if value:
+            self.data[key] = value
+        else:
+            self.data.pop(key, None)
+
+    def select_item(self, key, item_key):
+        column = self.tables[key][0].split()[0]
+        rows = self.db.execute("SELECT * FROM %s WHERE %s=? ORDER BY rowid" % (key, column),
+                               (item_key,)).fetchall()
+        return self.tables[key][2]([row[1:] for row in rows]) if rows else None
+
+    def get_item_keys(self, key):
+        with self.lock:
+            if self.is_loaded(key):
+                return WalletStorage.get_item_keys(self, key)
+            column = self.tables[key][0].split()[0]
+            keys = set(row[0] for row in self.db.execute("SELECT DISTINCT %s FROM %s" % (column, key)))
+            for k, v in self.data.get(key, {}).items():
+                if v is None:
+                    keys.discard(k)
+                else:
+                    keys.add(k)
+            return list(keys)
+
+    def get_item_view(self, key, item_key, default=None):
+        with self.lock:
+            if self.is_loaded(key):
+                return WalletStorage.get_item_view(self, key, item_key, default)
+            d = self.data.get(key, {})
+            v = d[item_key] if item_key in d else self.select_item(key, item_key)
+            return default if v is None else v
+
+    def get(self, key, default=None):
+        with self.lock:
+            self.load_table(key)
+            return WalletStorage.get(self, key, default)
+
+    def get_view(self, key, default=None):
+        with self.lock:
+            self.load_table(key)
+            return WalletStorage.get_view(self, key, default)
+
+    def put(self, key, value):
+        with self.lock:
+            self.load_table(key)
+            JournaledWalletStorage.put(self, key, value)
+
+    def put_item(self, key, item_key, value):
+        with self.lock:
+            if self.is_loaded(key):
+                return JournaledWalletStorage.put_item(self, key, item_key, value)
+            try:
+                json.dumps(item_key)
+                json.dumps(value)
+            except:
+                self.print_error("json error: cannot save", key, item_key)
+                return False
+            if self.get_item_view(key, item_key) == value:
+                return False
+            self.data.setdefault(key, {})[item_key] = copy.deepcopy(value)
+            self.dirty_items.add((key, item_key))
+            self.modified = True
+            return True
+
+    def insert_rows(self, db, key, k, v):
+        to_rows = self.tables[key][1]
+        n = len(self.tables[key][0].split(','))
+        db.executemany("INSERT INTO %s VALUES (%s)" % (key, ','.join('?' * n)),
+                       [(k,) + row for row in to_rows(v)])
+
+    def apply_ops(self, db, ops):
+        for op in ops:
+            key = op[1]
+            if key not in self.tables:
+                continue
+            column = self.tables[key][0].split()[0]
+            if op[0] in ['set', 'del']:
+                db.execute("DELETE FROM %s" % key)
+                for k, v in (op[2].items() if op[0] == 'set' else []):
+                    self.insert_rows(db, key, k, v)
+            else:
+                db.execute("DELETE FROM %s WHERE %s=?" % (key, column), (op[2],))
+                if op[0] == 'set_item':
+                    self.insert_rows(db, key, op[2], op[3])
+        # other keys are saved whole
+        for key in set(op[1] for op in ops if op[1] not in self.tables):
+            if key in self.data:
+                db.execute("INSERT OR REPLACE INTO kv VALUES (?, ?)",
+                           (key, json.dumps(self.data[key])))
+            else:
+                db.execute("DELETE FROM kv WHERE key=?", (key,))
+
+    def create_database(self, path):
+        db = sqlite3.connect(path)
+        db.text_factory = str
+        db.execute("CREATE TABLE kv (key TEXT PRIMARY KEY, value TEXT)")
+        for key, (columns, _, _) in self.tables.items():
+            column = columns.split()[0]
+            db.execute("CREATE TABLE %s (%s)" % (key, columns))
+            db.execute("CREATE INDEX %s_%s ON %s (%s)" % (key, column, key, column))
+        ops = [['set', key, value] for key, value in self.data.items()]
+        with db:
+            self.apply_ops(db, ops)
+        db.close()
+
+    def write(self):
+        if threading.currentThread().isDaemon():
+            self.print_error('warning: daemon thread cannot write wallet')
+            return
+        with self.lock:
+            if not self.modified:
+                return
+            if self.db is None:
+                # new wallet, or a JSON wallet file: replace it
+                temp_path = "%s.tmp.%s" % (self.path, os.getpid())
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                self.create_database(temp_path)
+                if 'ANDROID_DATA' not in os.environ:
+                    os.chmod(temp_path, stat.S_IREAD | stat.S_IWRITE)
+                try:
+                    os.rename(temp_path, self.path)
+                except:
+                    os.remove(self.path)
+                    os.rename(temp_path, self.path)
+                if os.path.exists(self.journal_path):
+                    os.remove(self.journal_path)
+                self.db = sqlite3.connect(self.path, check_same_thread=False)
+                self.db.text_factory = str
+                self.loaded = set(self.tables)
+                self.print_error("saved", self.path)
+                self.written = dict(self.data)
+                self.dirty = set()
+                self.dirty_items = set()
+            else:
+                ops = self.journal_ops()
+                with self.db:
+                    self.apply_ops(self.db, ops)
+                # the changed items of tables not loaded are now in the database
+                for key in self.tables:
+                    if not self.is_loaded(key):
+                        self.data.pop(key, None)
+            self.modified = False
+
+
+def is_sqlite_file(path):
+    try:
+        with open(path, "rb") as f:
+            return f.read(16) == 'SQLite format 3\x00'
+    except IOError:
+        return False
+
+
+def get_storage(path, config=None):
+    '''Returns the storage for path.  SQLite wallets are opened with the
+    SQLite engine, and the 'sqlite' option converts other wallets to it.
+    The journaled engine is used if the wallet already has a journal, or
+    if the 'journal' option is set.  Wallets should always be opened
+    through this function rather than with a storage class.'''
+    if config is None:
+        config = {}
+    if config.get('sqlite') or is_sqlite_file(path):
+        return SqliteWalletStorage(path)
+    if config.get('journal') or os.path.exists(path + '.journal'):
+        return JournaledWalletStorage(path)
+    return WalletStorage(path)
+
+
+class TransactionStore(object):
+    '''Mapping from tx_hash to Transaction that holds the raw transactions.
+    Transaction objects are built on first access, and only the
+    max_parsed most recently used ones are kept.
+    A raw tx may be None, in which case it is read with load_raw when
+    needed, and not kept.'''
+
+    max_parsed = 1000
+
+    def __init__(self, raw_txs, load_raw=None):
+        self.raw = dict(raw_txs)
+        self.load_raw = load_raw
+        self.parsed = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.raw)
+
+    def __iter__(self):
+        return iter(self.raw.keys())
+
+    def __contains__(self, tx_hash):
+        return tx_hash in self.raw
+
+    def keys(self):
+        return self.raw.keys()
+
+    def get_raw(self, tx_hash):
+        raw = self.raw.get(tx_hash)
+        if raw is None and tx_hash in self.raw:
+            raw = self.load_raw(tx_hash)
+        return raw
+
+    def get(self, tx_hash, default=None):
+        with self.lock:
+            tx = self.parsed.pop(tx_hash, None)
+            if tx is None:
+                raw = self.get_raw(tx_hash)
+                if raw is None:
+                    return default
+                tx = Transaction(raw)
+            self.parsed[tx_hash] = tx
+            if len(self.parsed) > self.max_parsed:
+                self.parsed.popitem(last=False)
+        return tx
+
+    def __getitem__(self, tx_hash):
+        tx = self.get(tx_hash)
+        if tx is None:
+            raise KeyError(tx_hash)
+        return tx
+
+    def __setitem__(self, tx_hash, tx):
+        raw = str(tx)
+        with self.lock:
+            self.raw[tx_hash] = raw
+            self.parsed.pop(tx_hash, None)
+            self.parsed[tx_hash] = tx
+            if len(self.parsed) > self.max_parsed:
+                self.parsed.popitem(last=False)
+
+    def remove(self, tx_hash):
+        '''Removes tx_hash without reading or parsing its raw tx.'''
+        with self.lock:
+            self.raw.pop(tx_hash, None)
+            self.parsed.pop(tx_hash, None)
+
+    def pop(self, tx_hash, *default):
+        with self.lock:
+            if tx_hash not in self.raw:
+                if default:
+                    return default[0]
+                raise KeyError(tx_hash)
+            raw = self.raw.pop(tx_hash)
+            tx = self.parsed.pop(tx_hash, None)
+        if tx is None:
+            # Transaction does not parse raw until it is used
+            tx = Transaction(raw if raw is not None else self.load_raw(tx_hash))
+        return tx
+
+
+class HistoryView(object):
+    '''The transactions of a set of addresses, sorted by position, with
+    their delta on the domain and the running sums of those deltas.
+    The wallet marks addresses and transactions dirty when they change,
+    and update() recomputes only those.'''
+
+    def __init__(self, domain):
+        self.domain = set()
+        self.addr_deltas = {}   # addr -> {tx_hash: delta}
+        self.tx_parts = {}      # tx_hash -> [sum, number of None deltas, number of addresses]
+        self.keys = []          # sorted (height, pos, tx_hash)
+        self.tx_keys = {}       # tx_hash -> its item in self.keys
+        self.sums = []          # running sums of the deltas, None counted as 0
+        self.nones = []         # running counts of None deltas
+        self.dirty_addrs = set()
+        self.dirty_txs = set()
+        self.set_domain(domain)
+
+    def set_domain(self, domain):
+        self.dirty_addrs |= self.domain ^ domain
+        self.domain = domain
+
+    def add_part(self, tx_hash, delta, sign):
+        p = self.tx_parts.setdefault(tx_hash, [0, 0, 0])
+        if delta is None:
+            p[1] += sign
+        else:
+            p[0] += sign * delta
+        p[2] += sign
+        if p[2] == 0:
+            self.tx_parts.pop(tx_hash)
+
+    def get_delta(self, tx_hash):
+        s, nones, n = self.tx_parts[tx_hash]
+        return None if nones else s
+
+    def update(self, wallet, dirty_addrs, dirty_txs):
+        changed = set(dirty_txs)
+        for addr in dirty_addrs:
+            old = self.addr_deltas.pop(addr, {})
+            new = wallet.get_addr_tx_deltas(addr) if addr in self.domain else {}
+            if new:
+                self.addr_deltas[addr] = new
+            for tx_hash, delta in old.items():
+                self.add_part(tx_hash, delta, -1)
+            for tx_hash, delta in new.items():
+                self.add_part(tx_hash, delta, 1)
+            changed.update(old.keys())
+            changed.update(new.keys())
+        # move the changed txs, remembering the first index that moved
+        start = len(self.keys)
+        for tx_hash in changed:
+            key = self.tx_keys.pop(tx_hash, None)
+            if key is not None:
+                i = bisect_left(self.keys, key)
+                self.keys.pop(i)
+                start = min(start, i)
+            if tx_hash in self.tx_parts:
+                height, pos = wallet.get_txpos(tx_hash)
+                key = (height, pos, tx_hash)
+                i = bisect_left(self.keys, key)
+                self.keys.insert(i, key)
+                self.tx_keys[tx_hash] = key
+                start = min(start, i)
+        # the running sums before start are still valid
+        del self.sums[start:]
+        del self.nones[start:]
+        s = self.sums[-1] if self.sums else 0
+        n = self.nones[-1] if self.nones else 0
+        for height, pos, tx_hash in self.keys[start:]:
+            delta = self.get_delta(tx_hash)
+            if delta is None:
+                n += 1
+            else:
+                s += delta
+            self.sums.append(s)
+            self.nones.append(n)
+
+    def items(self):
+        return [(tx_hash, self.get_delta(tx_hash), s, n)
+                for (height, pos, tx_hash), s, n in zip(self.keys, self.sums, self.nones)]
+
+
+class SigningSession(object):
+    '''Master private keys, BIP32 branch nodes, stretched old seeds and
+    other private keys, decrypted and derived once for the signing of a
+    transaction.  close() drops them; Python strings cannot be overwritten
+    in place, so this only shortens their lifetime.'''
+
+    # branch nodes kept at most
+    max_nodes = 64
+
+    def __init__(self, wallet, password):
+        self.wallet = wallet
+        self.password = password
+        self.master_keys = {}   # root -> (k, c), or None
+        self.nodes = {}         # (root, branch) -> (k, c)
+        self.roots = {}         # xpub -> root with a master private key, or None
+        self.secexps = {}       # OldAccount mpk -> stretched seed
+        self.keys = {}          # address -> private key
+
+    def get_master_key(self, root):
+        if root not in self.master_keys:
+            xprv = self.wallet.get_master_private_key(root, self.password)
+            if xprv:
+                _, _, _, c, k = deserialize_xkey(xprv)
+                self.master_keys[root] = k, c
+            else:
+                self.master_keys[root] = None
+        return self.master_keys[root]
+
+    def get_node(self, root, branch):
+        if not branch:
+            return self.get_master_key(root)
+        node = self.nodes.get((root, branch))
+        if node is None:
+            k, c = self.get_node(root, branch[:-1])
+            node = CKD_priv(k, c, branch[-1])
+            if len(self.nodes) < self.max_nodes:
+                self.nodes[(root, branch)] = node
+        return node
+
+    def get_root(self, xpub):
+        if xpub not in self.roots:
+            self.roots[xpub] = None
+            for k, v in self.wallet.master_public_keys.items():
+                if v == xpub and self.get_master_key(k):
+                    self.roots[xpub] = k
+                    break
+        return self.roots[xpub]
+
+    def get_old_private_key(self, account, sequence):
+        # the seed is stretched with 100k rounds of sha256
+        secexp = self.secexps.get(account.mpk)
+        if secexp is None:
+            secexp = account.stretch_key(self.wallet.get_seed(self.password))
+            account.check_stretched_exponent(secexp)
+            self.secexps[account.mpk] = secexp
+        for_change, n = sequence
+        return account.get_private_key_from_stretched_exponent(for_change, n, secexp)
+
+    def get_private_key(self, address):
+        if address not in self.keys:
+            self.keys[address] = self.wallet.get_private_key(address, self.password)[0]
+        return self.keys[address]
+
+    def close(self):
+        self.master_keys.clear()
+        self.nodes.clear()
+        self.roots.clear()
+        self.secexps.clear()
+        self.keys.clear()
+        self.password = None
+
+
 class Abstract_Wallet(PrintError):
     """
     Wallet classes are created to handle various address generation methods.
@@ -153,6 +849,15 @@ class Abstract_Wallet(PrintError):
     """
 
     max_change_outputs = 3
+    max_history_views = 4
+    # a history view is reused for a domain that only adds up to this
+    # many addresses to its own (e.g. newly generated ones)
+    max_history_view_delta = 20
+    # write-behind of the changes received from the network: they are
+    # saved and written once save_batch_size txs, prevouts or addresses
+    # are unsaved, or save_interval seconds after the first change
+    save_batch_size = 500
+    save_interval = 10
 
     def __init__(self, storage):
         self.electrum_version = ELECTRUM_VERSION
@@ -172,14 +877,33 @@ class Abstract_Wallet(PrintError):
         self.labels                = storage.get('labels', {})
         self.frozen_addresses      = set(storage.get('frozen_addresses',[]))
         self.stored_height         = storage.get('stored_height', 0)       # last known height (for offline mode)
-        self.history               = storage.get('addr_history',{})        # address -> list(txid, height)
+        # address -> list(txid, height).  The lists are shared with the
+        # storage, and replaced rather than changed.
+        self.history               = dict(storage.get_view('addr_history', {}))
 
         # imported_keys is deprecated. The GUI should call convert_imported_keys
         self.imported_keys = self.storage.get('imported_keys',{})
 
+        # per-address utxos and balances, see get_addr_cache
+        self.addr_cache = {}
+        self.addr_cache_lock = threading.RLock()
+        # incrementally maintained histories, see get_history
+        self.history_views = []
+        self.history_lock = threading.Lock()
+        # items changed since the last save_transactions
+        self.unsaved_txs = set()
+        self.unsaved_prevouts = set()
+        self.unsaved_addrs = set()
+        self.unsaved_since = None
+        # the address caches are saved with the transactions
+        self.unsaved_address_caches = False
+
         self.load_accounts()
         self.load_transactions()
-        self.build_reverse_history()
+        # the checks are skipped if the wallet was closed cleanly
+        clean_shutdown = self.load_reverse_history()
+        if not clean_shutdown:
+            self.build_reverse_history()
 
         # load requests
         self.receive_requests = self.storage.get('payment_requests', {})
@@ -188,7 +912,7 @@ class Abstract_Wallet(PrintError):
         # height.  Access is not contended so no lock is needed.
         self.unverified_tx = {}
         # Verified transactions.  Each value is a (height, timestamp, block_pos) tuple.  Access with self.lock.
-        self.verified_tx   = storage.get('verified_tx3',{})
+        self.verified_tx   = dict(storage.get_view('verified_tx3', {}))
 
         # there is a difference between wallet.up_to_date and interface.is_up_to_date()
         # interface.is_up_to_date() returns true when all requests have been answered and processed
@@ -198,7 +922,8 @@ class Abstract_Wallet(PrintError):
         self.transaction_lock = threading.Lock()
         self.tx_event = threading.Event()
 
-        self.check_history()
+        if not clean_shutdown:
+            self.check_history()
 
         # save wallet type the first time
         if self.storage.get('wallet_type') is None:
@@ -219,38 +944,136 @@ class Abstract_Wallet(PrintError):
         self.txi = self.storage.get('txi', {})
         self.txo = self.storage.get('txo', {})
         self.pruned_txo = self.storage.get('pruned_txo', {})
-        tx_list = self.storage.get('transactions', {})
-        self.transactions = {}
-        for tx_hash, raw in tx_list.items():
-            tx = Transaction(raw)
-            self.transactions[tx_hash] = tx
-            if self.txi.get(tx_hash) is None and self.txo.get(tx_hash) is None and (tx_hash not in self.pruned_txo.values()):
+        self.build_spent_index()
+        # only the hashes are loaded: raw transactions are read and
+        # parsed when used
+        tx_hashes = set(self.storage.get_item_keys('transactions'))
+        for tx_hash in list(tx_hashes):
+            if self.txi.get(tx_hash) is None and self.txo.get(tx_hash) is None and (tx_hash not in self.pruned_txo_by_tx):
                 self.print_error("removing unreferenced tx", tx_hash)
-                self.transactions.pop(tx_hash)
+                tx_hashes.remove(tx_hash)
+                self.unsaved_txs.add(tx_hash)
+        load_raw = lambda tx_hash: self.storage.get_item_view('transactions', tx_hash)
+        self.transactions = TransactionStore(dict.fromkeys(tx_hashes), load_raw)
 
     @profiler
     def save_transactions(self, write=False):
+        # only the items changed since the last save are put
         with self.transaction_lock:
-            tx = {}
-            for k,v in self.transactions.items():
-                tx[k] = str(v)
-            self.storage.put('transactions', tx)
-            self.storage.put('txi', self.txi)
-            self.storage.put('txo', self.txo)
-            self.storage.put('pruned_txo', self.pruned_txo)
-            self.storage.put('addr_history', self.history)
+            txs, self.unsaved_txs = self.unsaved_txs, set()
+            prevouts, self.unsaved_prevouts = self.unsaved_prevouts, set()
+            addrs, self.unsaved_addrs = self.unsaved_addrs, set()
+            self.unsaved_since = None
+            for tx_hash in txs:
+                self.storage.put_item('transactions', tx_hash, self.transactions.get_raw(tx_hash))
+                self.storage.put_item('txi', tx_hash, self.txi.get(tx_hash))
+                self.storage.put_item('txo', tx_hash, self.txo.get(tx_hash))
+            for ser in prevouts:
+                self.storage.put_item('pruned_txo', ser, self.pruned_txo.get(ser))
+            for addr in addrs:
+                self.storage.put_item('addr_history', addr, self.history.get(addr))
+            if self.unsaved_address_caches:
+                self.unsaved_address_caches = False
+                self.save_address_caches()
             if write:
                 self.storage.write()
 
+    def maybe_save_transactions(self):
+        '''Saves and writes the unsaved changes if there are enough of
+        them, or if they are old enough.  Called from the network thread,
+        since daemon threads cannot write the wallet.
+        With a storage that rewrites the whole file, the changes are only
+        written once the wallet is up to date.'''
+        if not self.storage.incremental:
+            return
+        n = len(self.unsaved_txs) + len(self.unsaved_prevouts) + len(self.unsaved_addrs)
+        if n == 0:
+            return
+        now = time.time()
+        if self.unsaved_since is None:
+            self.unsaved_since = now
+        if n >= self.save_batch_size or now - self.unsaved_since >= self.save_interval:
+            self.save_transactions(write=True)
+
+    def build_spent_index(self):
+        # prevout_hash -> set of the txs whose txi entries spend its outputs
+        self.spending_txs = {}
+        for next_tx, dd in self.txi.items():
+            for addr, l in dd.items():
+                for ser, v in l:
+                    self.add_spent_outpoint(ser, next_tx)
+        # inverse of pruned_txo: tx_hash -> set of ser
+        self.pruned_txo_by_tx = {}
+        for ser, tx_hash in self.pruned_txo.items():
+            self.pruned_txo_by_tx.setdefault(tx_hash, set()).add(ser)
+
+    def add_spent_outpoint(self, ser, tx_hash):
+        prevout_hash = ser.split(':')[0]
+        self.spending_txs.setdefault(prevout_hash, set()).add(tx_hash)
+
+    def remove_spent_outpoints(self, tx_hash):
+        for addr, l in self.txi.get(tx_hash, {}).items():
+            for ser, v in l:
+                prevout_hash = ser.split(':')[0]
+                s = self.spending_txs.get(prevout_hash)
+                if s is not None:
+                    s.discard(tx_hash)
+                    if not s:
+                        self.spending_txs.pop(prevout_hash)
+
+    def add_pruned_txo(self, ser, tx_hash):
+        if ser in self.pruned_txo:
+            self.remove_pruned_txo(ser)
+        if tx_hash not in self.pruned_txo_by_tx:
+            # the delta of tx becomes unknown
+            self.invalidate_addr_cache(self.tx_addr_hist.get(tx_hash, []))
+        self.pruned_txo[ser] = tx_hash
+        self.pruned_txo_by_tx.setdefault(tx_hash, set()).add(ser)
+        self.unsaved_prevouts.add(ser)
+
+    def remove_pruned_txo(self, ser):
+        tx_hash = self.pruned_txo.pop(ser)
+        self.unsaved_prevouts.add(ser)
+        s = self.pruned_txo_by_tx[tx_hash]
+        s.discard(ser)
+        if not s:
+            self.pruned_txo_by_tx.pop(tx_hash)
+            self.invalidate_addr_cache(self.tx_addr_hist.get(tx_hash, []))
+
     def clear_history(self):
         with self.transaction_lock:
             self.txi = {}
             self.txo = {}
             self.pruned_txo = {}
-        self.save_transactions()
+            self.build_spent_index()
+            self.storage.put('txi', self.txi)
+            self.storage.put('txo', self.txo)
+            self.storage.put('pruned_txo', self.pruned_txo)
         with self.lock:
             self.history = {}
             self.tx_addr_hist = {}
+            self.storage.put('addr_history', self.history)
+        with self.addr_cache_lock:
+            self.addr_cache = {}
+            for view in self.history_views:
+                view.dirty_addrs |= view.domain
+
+    def consistency_marker(self):
+        return [ELECTRUM_VERSION, sum(len(hist) for hist in self.history.values())]
+
+    def load_reverse_history(self):
+        '''Loads the reverse history saved by stop_threads.  Returns False
+        if the wallet was not closed cleanly by this version.'''
+        marker = self.storage.get('clean_shutdown')
+        if marker is None:
+            return False
+        # the wallet is no longer in the state it was closed in
+        self.storage.put('clean_shutdown', None)
+        tx_addr_hist = self.storage.get_view('tx_addr_hist')
+        if marker != self.consistency_marker() or tx_addr_hist is None:
+            return False
+        self.tx_addr_hist = dict((k, set(v)) for k, v in tx_addr_hist.items())
+        return True
 
     @profiler
     def build_reverse_history(self):
@@ -267,11 +1090,12 @@ class Abstract_Wallet(PrintError):
         for addr, hist in self.history.items():
             if not self.is_mine(addr):
                 self.history.pop(addr)
+                self.unsaved_addrs.add(addr)
                 save = True
                 continue
 
             for tx_hash, tx_height in hist:
-                if tx_hash in self.pruned_txo.values() or self.txi.get(tx_hash) or self.txo.get(tx_hash):
+                if tx_hash in self.pruned_txo_by_tx or self.txi.get(tx_hash) or self.txo.get(tx_hash):
                     continue
                 tx = self.transactions.get(tx_hash)
                 if tx is not None:
@@ -301,8 +1125,10 @@ class Abstract_Wallet(PrintError):
     def load_accounts(self):
         self.accounts = {}
         d = self.storage.get('accounts', {})
+        address_cache = self.storage.get('address_cache', {})
         removed = False
         for k, v in d.items():
+            v['address_cache'] = address_cache.get(k)
             if self.wallet_type == 'old' and k in [0, '0']:
                 v['mpk'] = self.storage.get('master_public_key')
                 self.accounts['0'] = OldAccount(v)
@@ -314,7 +1140,8 @@ class Abstract_Wallet(PrintError):
                 removed = True
             else:
                 self.print_error("cannot load account", v)
-        if removed:
+        if removed or any(not a.address_cache_valid for a in self.accounts.values()
+                          if not isinstance(a, ImportedAccount)):
             self.save_accounts()
 
     def create_main_account(self):
@@ -344,7 +1171,7 @@ class Abstract_Wallet(PrintError):
     def is_imported(self, addr):
         account = self.accounts.get(IMPORTED_ACCOUNT)
         if account:
-            return addr in account.get_addresses(0)
+            return account.get_address_index(addr) is not None
         else:
             return False
 
@@ -371,6 +1198,8 @@ class Abstract_Wallet(PrintError):
         # force resynchronization, because we need to re-run add_transaction
         if address in self.history:
             self.history.pop(address)
+            self.unsaved_addrs.add(address)
+        self.invalidate_addr_cache([address])
 
         if self.synchronizer:
             self.synchronizer.add(address)
@@ -382,6 +1211,7 @@ class Abstract_Wallet(PrintError):
         if not account.get_addresses(0):
             self.accounts.pop(IMPORTED_ACCOUNT)
         self.save_accounts()
+        self.invalidate_addr_cache([addr])
 
     def set_label(self, name, text = None):
         changed = False
@@ -405,21 +1235,28 @@ class Abstract_Wallet(PrintError):
         return list(addr for acc in self.accounts for addr in self.get_account_addresses(acc, include_change))
 
     def is_mine(self, address):
-        return address in self.addresses(True)
+        return self.find_address(address) is not None
 
     def is_change(self, address):
-        if not self.is_mine(address): return False
-        acct, s = self.get_address_index(address)
-        if s is None: return False
+        r = self.find_address(address)
+        if r is None: return False
+        acct, s = r
         return s[0] == 1
 
+    def find_address(self, address):
+        '''Returns (account_id, (for_change, n)), or None if the address is
+        not in the wallet.  Each account maintains its own address index.'''
+        for acc_id, account in self.accounts.items():
+            sequence = account.get_address_index(address)
+            if sequence is not None:
+                return acc_id, sequence
+        return None
+
     def get_address_index(self, address):
-        for acc_id in self.accounts:
-            for for_change in [0,1]:
-                addresses = self.accounts[acc_id].get_addresses(for_change)
-                if address in addresses:
-                    return acc_id, (for_change, addresses.index(address))
-        raise Exception("Address not found", address)
+        r = self.find_address(address)
+        if r is None:
+            raise Exception("Address not found", address)
+        return r
 
     def get_private_key(self, address, password):
         if self.is_watching_only():
@@ -450,13 +1287,16 @@ class Abstract_Wallet(PrintError):
     def add_unverified_tx(self, tx_hash, tx_height):
         # Only add if confirmed and not verified
         if tx_height > 0 and tx_hash not in self.verified_tx:
-            self.unverified_tx[tx_hash] = tx_height
+            if self.unverified_tx.get(tx_hash) != tx_height:
+                self.unverified_tx[tx_hash] = tx_height
+                self.invalidate_txpos([tx_hash])
 
     def add_verified_tx(self, tx_hash, info):
         # Remove from the unverified map and add to the verified map and
         self.unverified_tx.pop(tx_hash, None)
         with self.lock:
             self.verified_tx[tx_hash] = info  # (tx_height, timestamp, pos)
+        self.invalidate_txpos([tx_hash])
         self.storage.put('verified_tx3', self.verified_tx)
 
         conf, timestamp = self.get_confirmations(tx_hash)
@@ -470,11 +1310,12 @@ class Abstract_Wallet(PrintError):
         '''Used by the verifier when a reorg has happened'''
         txs = []
         with self.lock:
-            for tx_hash, item in self.verified_tx:
+            for tx_hash, item in self.verified_tx.items():
                 tx_height, timestamp, pos = item
                 if tx_height >= height:
                     self.verified_tx.pop(tx_hash, None)
                     txs.append(tx_hash)
+        self.invalidate_txpos(txs)
         return txs
 
     def get_local_height(self):
@@ -520,7 +1361,7 @@ class Abstract_Wallet(PrintError):
     def get_tx_delta(self, tx_hash, address):
         "effect of tx on address"
         # pruned
-        if tx_hash in self.pruned_txo.values():
+        if tx_hash in self.pruned_txo_by_tx:
             return None
         delta = 0
         # substract the value of coins sent from address
@@ -535,15 +1376,14 @@ class Abstract_Wallet(PrintError):
 
     def get_wallet_delta(self, tx):
         """ effect of tx on wallet """
-        addresses = self.addresses(True)
         is_relevant = False
         is_send = False
         is_pruned = False
         is_partial = False
         v_in = v_out = v_out_mine = 0
         for item in tx.inputs():
-            addr = item.get('address')
-            if addr in addresses:
+            addr = self.get_txin_address(item)
+            if addr and self.is_mine(addr):
                 is_send = True
                 is_relevant = True
                 d = self.txo.get(item['prevout_hash'], {}).get(addr, [])
@@ -563,7 +1403,7 @@ class Abstract_Wallet(PrintError):
             is_partial = False
         for addr, value in tx.get_outputs():
             v_out += value
-            if addr in addresses:
+            if self.is_mine(addr):
                 v_out_mine += value
                 is_relevant = True
         if is_pruned:
@@ -599,30 +1439,77 @@ class Abstract_Wallet(PrintError):
                 sent[txi] = height
         return received, sent
 
+    def get_addr_cache(self, address):
+        '''Returns (utxo, received, c, u, coinbase) for address.  utxo maps
+        unspent outpoints to (height, value, is_cb), received is the total
+        amount ever received, c and u are the confirmed and unconfirmed
+        balance of non-coinbase coins, and coinbase lists the coinbase
+        outputs as (height, value, spent_height), because their maturity
+        depends on the local height.  The entry is computed once from the
+        address history and kept until invalidate_addr_cache is called.'''
+        with self.addr_cache_lock:
+            r = self.addr_cache.get(address)
+            if r is None:
+                r = self.addr_cache[address] = self.compute_addr_cache(address)
+            return r
+
+    def compute_addr_cache(self, address):
+        received, sent = self.get_addr_io(address)
+        utxo = {}
+        coinbase = []
+        total = c = u = 0
+        for txo, (tx_height, v, is_cb) in received.items():
+            total += v
+            if txo not in sent:
+                utxo[txo] = (tx_height, v, is_cb)
+            if is_cb:
+                coinbase.append((tx_height, v, sent.get(txo)))
+                continue
+            if tx_height > 0:
+                c += v
+            else:
+                u += v
+            if txo in sent:
+                if sent[txo] > 0:
+                    c -= v
+                else:
+                    u -= v
+        return utxo, total, c, u, coinbase
+
+    def invalidate_addr_cache(self, addresses):
+        with self.addr_cache_lock:
+            for addr in addresses:
+                self.addr_cache.pop(addr, None)
+                for view in self.history_views:
+                    if addr in view.domain:
+                        view.dirty_addrs.add(addr)
+
+    def invalidate_txpos(self, tx_hashes):
+        with self.addr_cache_lock:
+            for view in self.history_views:
+                view.dirty_txs.update(tx_hashes)
+
     def get_addr_utxo(self, address):
-        coins, spent = self.get_addr_io(address)
-        for txi in spent:
-            coins.pop(txi)
-        return coins
+        utxo = self.get_addr_cache(address)[0]
+        return dict(utxo)
 
     # return the total amount ever received by an address
     def get_addr_received(self, address):
-        received, sent = self.get_addr_io(address)
-        return sum([v for height, v, is_cb in received.values()])
+        return self.get_addr_cache(address)[1]
 
     # return the balance of a bitcoin address: confirmed and matured, unconfirmed, unmatured
     def get_addr_balance(self, address):
-        received, sent = self.get_addr_io(address)
-        c = u = x = 0
-        for txo, (tx_height, v, is_cb) in received.items():
-            if is_cb and tx_height + COINBASE_MATURITY > self.get_local_height():
+        utxo, received, c, u, coinbase = self.get_addr_cache(address)
+        x = 0
+        for tx_height, v, spent_height in coinbase:
+            if tx_height + COINBASE_MATURITY > self.get_local_height():
                 x += v
             elif tx_height > 0:
                 c += v
             else:
                 u += v
-            if txo in sent:
-                if sent[txo] > 0:
+            if spent_height is not None:
+                if spent_height > 0:
                     c -= v
                 else:
                     u -= v
@@ -636,7 +1523,7 @@ class Abstract_Wallet(PrintError):
         if exclude_frozen:
             domain = set(domain) - self.frozen_addresses
         for addr in domain:
-            c = self.get_addr_utxo(addr)
+            c = self.get_addr_cache(addr)[0]
             for txo, v in c.items():
                 tx_height, value, is_cb = v
                 if is_cb and tx_height + COINBASE_MATURITY > self.get_local_height():
@@ -682,10 +1569,8 @@ class Abstract_Wallet(PrintError):
 
     def get_account_from_address(self, addr):
         "Returns the account that contains this address, or None"
-        for acc_id in self.accounts:    # similar to get_address_index but simpler
-            if addr in self.get_account_addresses(acc_id):
-                return acc_id
-        return None
+        r = self.find_address(addr)
+        return r[0] if r else None
 
     def get_account_balance(self, account):
         return self.get_balance(self.get_account_addresses(account))
@@ -724,13 +1609,24 @@ class Abstract_Wallet(PrintError):
                     self.print_error("found pay-to-pubkey address:", addr)
                     return addr
 
+    def get_txin_address(self, txin):
+        # the inputs of other wallets are ruled out by the hash160 in their
+        # scriptSig, without parsing their pubkeys and signatures
+        addr = get_input_address(txin)
+        if addr is not None and not self.is_mine(addr):
+            return addr
+        return txin.get('address')
+
     def add_transaction(self, tx_hash, tx):
         is_coinbase = tx.inputs()[0].get('is_coinbase') == True
+        touched = set()
         with self.transaction_lock:
+            # forget the spends recorded by a previous run on this tx
+            self.remove_spent_outpoints(tx_hash)
             # add inputs
             self.txi[tx_hash] = d = {}
             for txi in tx.inputs():
-                addr = txi.get('address')
+                addr = self.get_txin_address(txi)
                 if not txi.get('is_coinbase'):
                     prevout_hash = txi['prevout_hash']
                     prevout_n = txi['prevout_n']
@@ -745,9 +1641,11 @@ class Abstract_Wallet(PrintError):
                             if d.get(addr) is None:
                                 d[addr] = []
                             d[addr].append((ser, v))
+                            self.add_spent_outpoint(ser, tx_hash)
+                            touched.add(addr)
                             break
                     else:
-                        self.pruned_txo[ser] = tx_hash
+                        self.add_pruned_txo(ser, tx_hash)
 
             # add outputs
             self.txo[tx_hash] = d = {}
@@ -764,47 +1662,60 @@ class Abstract_Wallet(PrintError):
                     if d.get(addr) is None:
                         d[addr] = []
                     d[addr].append((n, v, is_coinbase))
+                    touched.add(addr)
                 # give v to txi that spends me
                 next_tx = self.pruned_txo.get(ser)
                 if next_tx is not None:
-                    self.pruned_txo.pop(ser)
+                    self.remove_pruned_txo(ser)
                     dd = self.txi.get(next_tx, {})
                     if dd.get(addr) is None:
                         dd[addr] = []
                     dd[addr].append((ser, v))
+                    self.add_spent_outpoint(ser, next_tx)
+                    self.unsaved_txs.add(next_tx)
+                    touched.add(addr)
             # save
             self.transactions[tx_hash] = tx
+            self.unsaved_txs.add(tx_hash)
+            self.invalidate_addr_cache(touched)
 
     def remove_transaction(self, tx_hash):
+        touched = set()
         with self.transaction_lock:
             self.print_error("removing tx from history", tx_hash)
             #tx = self.transactions.pop(tx_hash)
-            for ser, hh in self.pruned_txo.items():
-                if hh == tx_hash:
-                    self.pruned_txo.pop(ser)
-            # add tx to pruned_txo, and undo the txi addition
-            for next_tx, dd in self.txi.items():
+            for ser in list(self.pruned_txo_by_tx.get(tx_hash, [])):
+                self.remove_pruned_txo(ser)
+            # add the outputs of tx spent by other txs to pruned_txo,
+            # and undo the txi addition
+            for next_tx in self.spending_txs.pop(tx_hash, set()):
+                dd = self.txi.get(next_tx, {})
                 for addr, l in dd.items():
-                    ll = l[:]
-                    for item in ll:
+                    for item in l[:]:
                         ser, v = item
                         prev_hash, prev_n = ser.split(':')
                         if prev_hash == tx_hash:
                             l.remove(item)
-                            self.pruned_txo[ser] = next_tx
+                            self.add_pruned_txo(ser, next_tx)
+                            self.unsaved_txs.add(next_tx)
+                            touched.add(addr)
                     if l == []:
                         dd.pop(addr)
-                    else:
-                        dd[addr] = l
+            # the outputs spent by tx are no longer spent
+            self.remove_spent_outpoints(tx_hash)
+            touched.update(self.txi.get(tx_hash, {}).keys())
+            touched.update(self.txo.get(tx_hash, {}).keys())
+            self.unsaved_txs.add(tx_hash)
             try:
                 self.txi.pop(tx_hash)
                 self.txo.pop(tx_hash)
             except KeyError:
                 self.print_error("tx was not in history", tx_hash)
+            self.invalidate_addr_cache(touched)
 
     def receive_tx_callback(self, tx_hash, tx, tx_height):
         self.add_transaction(tx_hash, tx)
-        self.save_transactions()
+        self.maybe_save_transactions()
         self.add_unverified_tx(tx_hash, tx_height)
 
 
@@ -819,6 +1730,9 @@ class Abstract_Wallet(PrintError):
                         self.remove_transaction(tx_hash)
 
             self.history[addr] = hist
+            self.unsaved_addrs.add(addr)
+        # heights of the address history may have changed
+        self.invalidate_addr_cache([addr])
 
         for tx_hash, tx_height in hist:
             # add it in case it was previously unconfirmed
@@ -833,52 +1747,67 @@ class Abstract_Wallet(PrintError):
                 self.add_transaction(tx_hash, tx)
 
         # Write updated TXI, TXO etc.
-        self.save_transactions()
+        self.maybe_save_transactions()
+
+    def get_addr_tx_deltas(self, address):
+        return dict((tx_hash, self.get_tx_delta(tx_hash, address))
+                    for tx_hash, height in self.get_address_history(address))
+
+    def get_history_view(self, domain):
+        '''Returns a HistoryView for domain.  A view whose domain lacks
+        only a few addresses of domain (e.g. newly generated ones) is
+        reused; other domains get their own view, so that callers that
+        alternate between domains do not recompute a shared one.'''
+        best = None
+        candidates = [v for v in self.history_views if v.domain <= domain]
+        if candidates:
+            best = max(candidates, key=lambda v: len(v.domain))
+        with self.addr_cache_lock:
+            if best is None or len(domain) - len(best.domain) > self.max_history_view_delta:
+                best = HistoryView(domain)
+                self.history_views.append(best)
+                if len(self.history_views) > self.max_history_views:
+                    self.history_views.pop(0)
+            else:
+                best.set_domain(domain)
+                # most recently used last
+                self.history_views.remove(best)
+                self.history_views.append(best)
+        return best
 
     def get_history(self, domain=None):
-        from collections import defaultdict
         # get domain
         if domain is None:
             domain = self.get_account_addresses(None)
-
-        # 1. Get the history of each address in the domain, maintain the
-        #    delta of a tx as the sum of its deltas on domain addresses
-        tx_deltas = defaultdict(int)
-        for addr in domain:
-            h = self.get_address_history(addr)
-            for tx_hash, height in h:
-                delta = self.get_tx_delta(tx_hash, addr)
-                if delta is None or tx_deltas[tx_hash] is None:
-                    tx_deltas[tx_hash] = None
-                else:
-                    tx_deltas[tx_hash] += delta
-
-        # 2. create sorted history
-        history = []
-        for tx_hash, delta in tx_deltas.items():
-            conf, timestamp = self.get_confirmations(tx_hash)
-            history.append((tx_hash, conf, delta, timestamp))
-        history.sort(key = lambda x: self.get_txpos(x[0]))
-        history.reverse()
-
-        # 3. add balance
+        domain = set(domain)
+
+        # 1. Bring the view up to date, recomputing the deltas of the
+        #    addresses and the positions of the txs that have changed
+        with self.history_lock:
+            view = self.get_history_view(domain)
+            with self.addr_cache_lock:
+                dirty_addrs, view.dirty_addrs = view.dirty_addrs, set()
+                dirty_txs, view.dirty_txs = view.dirty_txs, set()
+            view.update(self, dirty_addrs, dirty_txs)
+            items = view.items()
+
+        # 2. The balance before the first tx must be zero, unless the
+        #    history contains txs with unknown delta
         c, u, x = self.get_balance(domain)
         balance = c + u + x
-        h2 = []
-        for item in history:
-            tx_hash, conf, delta, timestamp = item
-            h2.append((tx_hash, conf, delta, timestamp, balance))
-            if balance is None or delta is None:
-                balance = None
-            else:
-                balance -= delta
-        h2.reverse()
-
-        # fixme: this may happen if history is incomplete
-        if balance not in [None, 0]:
+        if not items:
+            return []
+        total, total_nones = items[-1][2:]
+        if total_nones == 0 and balance != total:
             self.print_error("Error: history not synchronized")
             return []
 
+        # 3. add balance: known back to the most recent tx with unknown delta
+        h2 = []
+        for tx_hash, delta, s, n in items:
+            conf, timestamp = self.get_confirmations(tx_hash)
+            b = balance - (total - s) if n == total_nones else None
+            h2.append((tx_hash, conf, delta, timestamp, b))
         return h2
 
     def get_label(self, tx_hash):
@@ -1014,16 +1943,16 @@ class Abstract_Wallet(PrintError):
         # Raise if password is not correct.
         self.check_password(password)
         # Add derivation for utxo in wallets
-        for i, addr in self.utxo_can_sign(tx):
+        utxos = self.utxo_can_sign(tx)
+        for i, addr in utxos:
             txin = tx.inputs()[i]
             txin['address'] = addr
             self.add_input_info(txin)
+        if utxos:
+            # the inputs changed in place; forget the estimated size
+            tx.changed()
         # Add private keys
-        keypairs = {}
-        for x in self.xkeys_can_sign(tx):
-            sec = self.get_private_key_from_xpubkey(x, password)
-            if sec:
-                keypairs[x] = sec
+        keypairs = self.get_private_keys_from_xpubkeys(self.xkeys_can_sign(tx), password)
         # Sign
         if keypairs:
             tx.sign(keypairs)
@@ -1104,7 +2033,8 @@ class Abstract_Wallet(PrintError):
         for tx_hash in self.transactions.keys():
             if tx_hash not in vr:
                 self.print_error("removing transaction", tx_hash)
-                self.transactions.pop(tx_hash)
+                self.transactions.remove(tx_hash)
+                self.unsaved_txs.add(tx_hash)
 
     def start_threads(self, network):
         self.network = network
@@ -1126,6 +2056,10 @@ class Abstract_Wallet(PrintError):
             # Now no references to the syncronizer or verifier
             # remain so they will be GC-ed
             self.storage.put('stored_height', self.get_local_height())
+        self.save_transactions()
+        with self.lock:
+            self.storage.put('tx_addr_hist', dict((k, list(v)) for k, v in self.tx_addr_hist.items()))
+            self.storage.put('clean_shutdown', self.consistency_marker())
         self.storage.write()
 
     def wait_until_synchronized(self, callback=None):
@@ -1176,6 +2110,17 @@ class Abstract_Wallet(PrintError):
         for k, v in self.accounts.items():
             d[k] = v.dump()
         self.storage.put('accounts', d)
+        # the address caches grow with every address: they are saved in
+        # the next save_transactions rather than on each new address
+        self.unsaved_address_caches = True
+
+    def save_address_caches(self):
+        for k in self.storage.get_item_keys('address_cache'):
+            if k not in self.accounts:
+                self.storage.put_item('address_cache', k, None)
+        for k, v in self.accounts.items():
+            if not isinstance(v, ImportedAccount):
+                self.storage.put_item('address_cache', k, v.get_address_cache())
 
     def can_import(self):
         return not self.is_watching_only()
@@ -1219,7 +2164,7 @@ class Abstract_Wallet(PrintError):
         out = set()
         coins = self.get_spendable_coins()
         for i in tx.inputs_without_script():
-            txin = tx.inputs[i]
+            txin = tx.inputs()[i]
             for item in coins:
                 if txin.get('prevout_hash') == item.get('prevout_hash') and txin.get('prevout_n') == item.get('prevout_n'):
                     out.add((i, item.get('address')))
@@ -1259,6 +2204,55 @@ class Abstract_Wallet(PrintError):
         else:
             raise BaseException("z")
 
+    def get_private_keys_from_xpubkeys(self, x_pubkeys, password):
+        '''Like get_private_key_from_xpubkey, for several x_pubkeys.  The
+        master private keys, branch nodes and stretched old seeds are
+        derived once, in a SigningSession, and the last BIP32 derivations
+        run in the signing pool, if there is one.'''
+        keypairs = {}
+        tasks = []
+        session = SigningSession(self, password)
+        try:
+            for x_pubkey in x_pubkeys:
+                root = None
+                if x_pubkey[0:2] == 'ff':
+                    xpub, sequence = BIP32_Account.parse_xpubkey(x_pubkey)
+                    root = session.get_root(xpub)
+                elif x_pubkey[0:2] == 'fe':
+                    xpub, sequence = OldAccount.parse_xpubkey(x_pubkey)
+                    for account in self.accounts.values():
+                        if isinstance(account, OldAccount) and xpub in account.get_master_pubkeys():
+                            keypairs[x_pubkey] = session.get_old_private_key(account, sequence)
+                            break
+                else:
+                    if x_pubkey[0:2] == 'fd':
+                        addrtype = ord(x_pubkey[2:4].decode('hex'))
+                        addr = hash_160_to_bc_address(x_pubkey[4:].decode('hex'), addrtype)
+                    else:
+                        addr = bitcoin.public_key_to_bc_address(x_pubkey.decode('hex'))
+                    if not self.is_mine(addr):
+                        continue
+                    account_id, sequence = self.get_address_index(addr)
+                    account = self.accounts[account_id]
+                    if isinstance(account, OldAccount):
+                        keypairs[x_pubkey] = session.get_old_private_key(account, sequence)
+                    elif type(account) is BIP32_Account:
+                        root = session.get_root(account.get_master_pubkeys()[0])
+                    else:
+                        # imported keys, and multisig and other accounts
+                        keypairs[x_pubkey] = session.get_private_key(addr)
+                if root is not None:
+                    k, c = session.get_node(root, tuple(sequence[:-1]))
+                    tasks.append((x_pubkey, (list(sequence[-1:]), k, c)))
+            secs = run_in_pool(derive_private_keys, [task for x_pubkey, task in tasks])
+            for (x_pubkey, task), sec in zip(tasks, secs):
+                keypairs[x_pubkey] = sec
+        finally:
+            session.close()
+            # the tasks hold branch private keys
+            del tasks[:]
+        return keypairs
+
 
     def can_sign_xpubkey(self, x_pubkey):
         if x_pubkey[0:2] in ['02','03','04']:
@@ -1479,6 +2473,7 @@ class Deterministic_Wallet(Abstract_Wallet):
                 n = len(addresses) - k + value
                 account.receiving_pubkeys = account.receiving_pubkeys[0:n]
                 account.receiving_addresses = account.receiving_addresses[0:n]
+                account.build_address_index()
             self.gap_limit = value
             self.storage.put('gap_limit', self.gap_limit)
             self.save_accounts()
@@ -1520,10 +2515,15 @@ class Deterministic_Wallet(Abstract_Wallet):
         return address
 
     def add_address(self, address):
-        if address not in self.history:
-            self.history[address] = []
-        if self.synchronizer:
-            self.synchronizer.add(address)
+        self.add_addresses([address])
+
+    def add_addresses(self, addresses):
+        for address in addresses:
+            if address not in self.history:
+                self.history[address] = []
+                self.unsaved_addrs.add(address)
+            if self.synchronizer:
+                self.synchronizer.add(address)
         self.save_accounts()
 
     def synchronize(self):
@@ -1535,7 +2535,7 @@ class Deterministic_Wallet(Abstract_Wallet):
         if type(account) == ImportedAccount:
             return False
         addr_list = account.get_addresses(is_change)
-        i = addr_list.index(address)
+        i = account.get_address_index(address)[1]
         prev_addresses = addr_list[:max(0, i)]
         limit = self.gap_limit_for_change if is_change else self.gap_limit
         if len(prev_addresses) < limit:
@@ -1822,7 +2822,10 @@ class Multisig_Wallet(BIP32_RD_Wallet, Mnemonic):
                 v['xpubs'] = [v['xpub'], v['xpub2'], v['xpub3']]
             elif v.get('xpub2'):
                 v['xpubs'] = [v['xpub'], v['xpub2']]
+            v['address_cache'] = self.storage.get_item('address_cache', '0')
             self.accounts = {'0': Multisig_Account(v)}
+            if not self.accounts['0'].address_cache_valid:
+                self.save_accounts()
 
     def create_main_account(self):
         account = Multisig_Account({'xpubs': self.master_public_keys.values(), 'm': self.m})
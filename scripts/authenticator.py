@@ -34,7 +34,7 @@ import qrcode
 
 imp.load_module('electrum', *imp.find_module('lib'))
 
-from electrum import SimpleConfig, Wallet, WalletStorage, format_satoshis
+from electrum import SimpleConfig, Wallet, get_storage, format_satoshis
 from electrum import util
 from electrum.transaction import Transaction
 from electrum.bitcoin import base_encode, base_decode
@@ -174,7 +174,7 @@ class Authenticator:
     def __init__(self):
         global wallet
         self.qr_data = None
-        storage = WalletStorage('/sdcard/electrum/authenticator')
+        storage = get_storage('/sdcard/electrum/authenticator')
         if not storage.file_exists:
 
             action = self.restore_or_create()